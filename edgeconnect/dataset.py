@@ -12,7 +12,7 @@ from scipy.misc import imread
 from skimage.feature import canny
 from skimage.color import rgb2gray, gray2rgb
 from .utils import create_mask
-import src.region_fill as rf
+from . import region_fill as rf
 
 class Dataset(torch.utils.data.Dataset):
     def __init__(self, config, flist, edge_flist, mask_flist, augment=True, training=True):
@@ -103,9 +103,9 @@ class Dataset(torch.utils.data.Dataset):
             edge = self.load_edge(img_gray, index, mask)
             img_gray = img_gray / img_gray.max()
 
+            # Both flow channels are filled with one factorisation.
             img_filled = np.zeros(img.shape)
-            img_filled[:, :, 0] = rf.regionfill(img[:, :, 0], mask)
-            img_filled[:, :, 1] = rf.regionfill(img[:, :, 1], mask)
+            img_filled[:, :, 0:2] = rf.regionfill(img[:, :, 0:2], mask)
 
 
         # augment data
@@ -284,11 +284,10 @@ class Contextual_Attention_Module(nn.Module):
         m = m.permute(0, 2, 3, 4, 5, 1)
         m = m.contiguous().view(raw_int_bs[0], raw_int_bs[2] // self.rate, raw_int_bs[3] // self.rate, -1)
         m = m.contiguous().view(raw_int_bs[0], -1, ksize, ksize, 1)
-        m = m.permute(0, 4, 1, 2, 3)
+        m = m.permute(0, 4, 1, 2, 3) # (B, 1, 32*32, 3, 3)
 
-        m = m[0] # (1, 32*32, 3, 3)
-        m = reduce_mean(m) # smoothing, maybe
-        mm = m.eq(0.).float() # (1, 32*32, 1, 1)
+        # Each sample of the batch has its own mask
+        mm_groups = [reduce_mean(mi[0]).eq(0.).float() for mi in torch.split(m, 1, dim=0)] # smoothing, maybe; (1, 32*32, 1, 1)
 
         w_groups = torch.split(w, 1, dim=0) # Split tensors by batch dimension; tuple is returned
         raw_w_groups = torch.split(raw_w, 1, dim=0) # Split tensors by batch dimension; tuple is returned
@@ -298,7 +297,7 @@ class Contextual_Attention_Module(nn.Module):
         scale = softmax_scale
         fuse_weight = Variable(torch.eye(k).view(1, 1, k, k)).cuda(self.device) # 1 x 1 x K x K
         y_test = []
-        for xi, wi, raw_wi in zip(f_groups, w_groups, raw_w_groups):
+        for xi, wi, raw_wi, mm in zip(f_groups, w_groups, raw_w_groups, mm_groups):
             '''
             O => output channel as a conv filter
             I => input channel as a conv filter
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The tool modules import each other by bare name (see tool/video_completion.py).
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'tool'))
+sys.path.insert(0, ROOT)
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+from utils.common_utils import create_array, static_mask, is_static_mask, HoleIndex, \
+    interp, interp_holes, fast_canny, edge_mismatch
+
+
+def test_create_array_in_ram():
+    arr = create_array((4, 5, 3), np.float32, fill=2)
+    assert isinstance(arr, np.ndarray) and not isinstance(arr, np.memmap)
+    assert arr.dtype == np.float32 and np.all(arr == 2)
+
+
+def test_create_array_scratch(tmp_path):
+    arr = create_array((4, 5, 2, 3), np.int8, str(tmp_path), fill=-1)
+    assert isinstance(arr, np.memmap)
+    assert arr.shape == (4, 5, 2, 3) and arr.flags['F_CONTIGUOUS']
+    assert np.all(arr == -1)
+    arr[..., 1] = 7
+    assert np.all(arr[..., 1] == 7) and np.all(arr[..., 0] == -1)
+
+
+def test_create_array_zero_size_scratch(tmp_path):
+    # The non-local flows are (imgH, imgW, 2, 3, 0) without --Nonlocal.
+    arr = create_array((4, 5, 2, 3, 0), np.float32, str(tmp_path))
+    assert arr.shape == (4, 5, 2, 3, 0) and arr.size == 0
+
+
+def test_static_mask():
+    mask_img = np.zeros((6, 8), dtype=np.uint8)
+    mask_img[2:4, 3:6] = 255
+    mask = static_mask(mask_img, 5)
+
+    assert mask.shape == (6, 8, 5) and mask.dtype == bool
+    assert is_static_mask(mask) and not mask.flags.writeable
+    assert np.array_equal(mask, np.repeat(mask_img[:, :, None] > 0, 5, axis=2))
+    assert not is_static_mask(np.array(mask))
+
+
+def test_hole_index_static_matches_dense():
+    mask_img = np.zeros((6, 8), dtype=bool)
+    mask_img[2:4, 3:6] = True
+    mask_img[5, 0] = True
+    mask = static_mask(mask_img, 4)
+    holes, dense = HoleIndex(mask), HoleIndex(np.array(mask))
+
+    assert holes.static and not dense.static
+    np.testing.assert_array_equal(holes.sub, dense.sub)
+    np.testing.assert_array_equal(holes.offsets, dense.offsets)
+    y, x = np.mgrid[0:6, 0:8]
+    for t in range(4):
+        np.testing.assert_array_equal(holes.frame(t), dense.frame(t))
+        np.testing.assert_array_equal(holes.lookup(y, x, t), dense.lookup(y, x, t))
+        rows = holes.lookup(y, x, t)
+        np.testing.assert_array_equal(holes.sub[rows[mask_img]], np.stack((y[mask_img], x[mask_img],
+                                                                          np.full(mask_img.sum(), t)), axis=1))
+
+
+def test_interp_holes_matches_composed_frame():
+    rng = np.random.default_rng(0)
+    mask = np.zeros((20, 30, 3), dtype=bool)
+    mask[5:12, 8:20, :] = True
+    mask[0:3, 25:30, 1] = True
+    holes = HoleIndex(mask)
+    img = rng.random((20, 30, 3)).astype(np.float32)
+    values = rng.random((holes.numPix, 3)).astype(np.float32)
+
+    # Frame 1 with its hole pixels replaced by their values
+    composed = img.copy()
+    sub = holes.frame(1)
+    composed[sub[:, 0], sub[:, 1]] = values[holes.rows(1)]
+
+    # Including positions outside of the frame
+    x = rng.uniform(-2, 31, 2000).astype(np.float32)
+    y = rng.uniform(-2, 21, 2000).astype(np.float32)
+    np.testing.assert_allclose(interp_holes(img, x, y, holes, 1, values),
+                               interp(composed, x, y), atol=1e-6)
+
+
+def flow_magnitude(seed, imgH=120, imgW=200):
+    # Normalised magnitude of a smooth flow with moving objects.
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:imgH, 0:imgW].astype(np.float32)
+    flow = np.stack((1.5 + 0.01 * xx + 0.3 * np.sin(yy / 10.), 0.5 - 0.005 * yy), axis=2)
+    for _ in range(4):
+        cy, cx, r = rng.uniform(0, imgH), rng.uniform(0, imgW), rng.uniform(10, 40)
+        flow[(yy - cy) ** 2 + (xx - cx) ** 2 < r * r] += rng.uniform(-8, 8, 2)
+    flow += rng.standard_normal(flow.shape).astype(np.float32) * 0.2
+    flow_img_gray = np.sqrt((flow ** 2).sum(axis=2))
+    return (flow_img_gray / flow_img_gray.max()).astype(np.float32)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_fast_canny_matches_skimage(seed):
+    canny = pytest.importorskip('skimage.feature').canny
+    flow_img_gray = flow_magnitude(seed)
+    mask = np.ones(flow_img_gray.shape, dtype=bool)
+    mask[40:80, 60:130] = False
+
+    for m in (None, mask):
+        edge = fast_canny(flow_img_gray, sigma=2, mask=m)
+        ref = canny(flow_img_gray, sigma=2, mask=m)
+        assert ref.sum() > 0
+        assert np.array_equal(edge, ref)
+        assert edge_mismatch(edge, ref) == 0
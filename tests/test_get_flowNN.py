@@ -0,0 +1,156 @@
+import argparse
+import os
+
+import numpy as np
+import pytest
+
+from get_flowNN import get_flowNN, FlowCorrespondence, NN_REACHABLE, NN_NOT_HOLE
+from get_flowNN_gradient import get_flowNN_gradient
+
+# Expected propagation of make_clip, computed with the original propagation
+# (before the HoleIndex, FlowCorrespondence, fusion and buffer changes).
+FIXTURE = os.path.join(os.path.dirname(__file__), 'data', 'flowNN_fixture.npz')
+
+
+def make_clip(imgH=24, imgW=32, nFrame=6):
+    """Analytic clip: a moving hole, smooth near-consistent flows.
+    """
+    yy, xx = np.mgrid[0:imgH, 0:imgW].astype(np.float32)
+    video = np.stack([np.stack([np.sin(xx / 5. + 0.4 * t + c) + 0.5 * np.cos(yy / 4. - 0.2 * t)
+                                for c in range(3)], axis=2) for t in range(nFrame)], axis=3)
+    mask = np.zeros((imgH, imgW, nFrame), dtype=bool)
+    for t in range(nFrame):
+        mask[7:16, 8 + 2 * t:18 + 2 * t, t] = True
+
+    flowF = np.stack([np.stack((3.2 + 0.3 * np.sin(yy / 6. + t), 0.4 + 0.2 * np.cos(xx / 7.)), axis=2)
+                      for t in range(nFrame - 1)], axis=3)
+    flowB = -flowF
+    nonLocalF = np.stack([np.stack([np.stack((0.5 * np.sin(yy / 5. + k + t), 0.3 * np.cos(xx / 6. - k)), axis=2)
+                                    for k in range(3)], axis=3) for t in range(nFrame)], axis=4)
+    nonLocalB = -nonLocalF
+
+    gradient_x = np.concatenate((np.diff(video, axis=1), np.zeros_like(video[:, :1])), axis=1)
+    gradient_y = np.concatenate((np.diff(video, axis=0), np.zeros_like(video[:1])), axis=0)
+
+    return (video.astype(np.float32), mask, flowF.astype(np.float32), flowB.astype(np.float32),
+            nonLocalF.astype(np.float32), nonLocalB.astype(np.float32),
+            gradient_x.astype(np.float32), gradient_y.astype(np.float32))
+
+
+def make_args(Nonlocal):
+    return argparse.Namespace(Nonlocal=Nonlocal, consistencyThres=1.0, alpha=0.1, scratch_dir=None)
+
+
+@pytest.fixture(scope='module')
+def expected():
+    return dict(np.load(FIXTURE))
+
+
+@pytest.mark.parametrize('Nonlocal', [False, True])
+def test_get_flowNN_fixture(expected, Nonlocal):
+    video, mask, flowF, flowB, nonLocalF, nonLocalB, _, _ = make_clip()
+    key = 'nonlocal' if Nonlocal else 'local'
+
+    y, x, t = mask.nonzero()
+
+    result, mask_tofill, HaveFlowNN = get_flowNN(make_args(Nonlocal), video.copy(), mask,
+                                                 flowF, flowB, nonLocalF, nonLocalB)
+
+    np.testing.assert_allclose(result[y, x, :, t], expected[key + '_video'], atol=1e-5)
+    known = np.invert(mask)
+    np.testing.assert_array_equal(np.moveaxis(result, 2, 3)[known], np.moveaxis(video, 2, 3)[known])
+    np.testing.assert_array_equal(mask_tofill, expected[key + '_mask_tofill'])
+    assert np.all(HaveFlowNN[~mask] == NN_NOT_HOLE)
+    np.testing.assert_array_equal(HaveFlowNN[mask] == NN_REACHABLE, expected['haveNN'])
+
+
+@pytest.mark.parametrize('Nonlocal', [False, True])
+def test_get_flowNN_gradient_fixture(expected, Nonlocal):
+    _, mask, flowF, flowB, nonLocalF, nonLocalB, gradient_x, gradient_y = make_clip()
+    key = 'nonlocal' if Nonlocal else 'local'
+    y, x, t = mask.nonzero()
+
+    gx, gy, mask_tofill = get_flowNN_gradient(make_args(Nonlocal), gradient_x.copy(), gradient_y.copy(),
+                                              mask, mask, flowF, flowB, nonLocalF, nonLocalB)
+
+    np.testing.assert_allclose(gx[y, x, :, t], expected[key + '_gradient_x'], atol=1e-5)
+    np.testing.assert_allclose(gy[y, x, :, t], expected[key + '_gradient_y'], atol=1e-5)
+    np.testing.assert_array_equal(mask_tofill, expected[key + '_gradient_mask_tofill'])
+
+
+def test_flow_correspondence_update_matches_fresh():
+    _, mask, flowF, flowB, _, _, _, _ = make_clip()
+    args = make_args(False)
+    shrunk = mask.copy()
+    shrunk[7:10] = False
+
+    corr = FlowCorrespondence(args, flowF, flowB)
+    corr.update(mask)
+    corr.update(shrunk)
+    fresh = FlowCorrespondence(args, flowF, flowB)
+    fresh.update(shrunk)
+
+    np.testing.assert_array_equal(corr.holes.sub, fresh.holes.sub)
+    np.testing.assert_array_equal(corr.haveNN, fresh.haveNN)
+    np.testing.assert_array_equal(corr.flowNN, fresh.flowNN)
+    np.testing.assert_array_equal(corr.consistency_uv, fresh.consistency_uv)
+
+    # Nothing to re-trace with the same mask
+    corr.update(shrunk)
+    assert not corr.retraced.any()
+
+
+def test_get_flowNN_incremental():
+    video, mask, flowF, flowB, nonLocalF, nonLocalB, _, _ = make_clip()
+    args = make_args(False)
+
+    corr = FlowCorrespondence(args, flowF, flowB)
+    first, mask_first, _ = get_flowNN(args, video.copy(), mask, flowF, flowB, nonLocalF, nonLocalB, corr=corr)
+
+    # Next iteration: part of a key frame was inpainted.
+    first[7:11, :, :, 2] = video[7:11, :, :, 2]
+    mask_next = mask_first.copy()
+    mask_next[7:11, :, 2] = False
+
+    incremental, mask_incremental, _ = get_flowNN(args, first.copy(), mask_next, flowF, flowB,
+                                                  nonLocalF, nonLocalB, corr=corr, incremental=True)
+    assert 0 < corr.retraced.sum() < corr.holes.numPix
+    full, mask_full, _ = get_flowNN(args, first.copy(), mask_next, flowF, flowB, nonLocalF, nonLocalB)
+
+    np.testing.assert_array_equal(mask_incremental, mask_full)
+    # The incremental mode samples the candidates from the video instead of
+    # the propagated buffers, which only differs near the hole.
+    assert np.mean(np.abs(incremental - full) > 1e-4) < 0.02
+
+
+def test_get_flowNN_torch_matches_numpy():
+    pytest.importorskip('torch')
+    from get_flowNN_torch import get_flowNN_torch
+
+    video, mask, flowF, flowB, nonLocalF, nonLocalB, _, _ = make_clip()
+    for Nonlocal in (False, True):
+        args = make_args(Nonlocal)
+        args.propagation_device = 'cpu'
+        result, mask_tofill, HaveFlowNN = get_flowNN(args, video.copy(), mask, flowF, flowB, nonLocalF, nonLocalB)
+        result_torch, mask_tofill_torch, HaveFlowNN_torch = get_flowNN_torch(
+            args, video.copy(), mask, flowF, flowB, nonLocalF, nonLocalB)
+
+        np.testing.assert_array_equal(np.asarray(mask_tofill_torch), mask_tofill)
+        np.testing.assert_array_equal(np.asarray(HaveFlowNN_torch), HaveFlowNN)
+        # cv2.remap (interp) rounds the sample positions to 1/32 of a pixel,
+        # grid_sample does not.
+        difference = np.abs(np.asarray(result_torch) - result)
+        assert difference.max() < 0.03 and difference.mean() < 1e-3
+
+
+def test_get_flowNN_torch_restores_num_threads():
+    torch = pytest.importorskip('torch')
+    from get_flowNN_torch import get_flowNN_torch
+
+    video, mask, flowF, flowB, nonLocalF, nonLocalB, _, _ = make_clip()
+    args = make_args(False)
+    args.propagation_device = 'cpu'
+    args.num_workers = 3
+    numThreads = torch.get_num_threads()
+    get_flowNN_torch(args, video.copy(), mask, flowF, flowB, nonLocalF, nonLocalB)
+    assert torch.get_num_threads() == numThreads
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from utils.region_fill import regionfill, RegionFill, RingFill, regionfillLaplace, \
+    findBoundaryPixels
+
+
+def smooth_image(imgH, imgW, nCh=2):
+    yy, xx = np.mgrid[0:imgH, 0:imgW]
+    return np.stack([np.sin(xx / 7.0 + ch) * 5 + yy / 4.0 + np.cos(yy / 9.0) * ch
+                     for ch in range(nCh)], axis=2)
+
+
+def reference(I, mask):
+    # One spsolve of the whole mask, per channel.
+    filled = np.array(I, dtype=float)
+    for ch in range(I.shape[2]):
+        filled[:, :, ch] = regionfillLaplace(filled[:, :, ch].copy(), mask, findBoundaryPixels(mask))
+    return filled
+
+
+def holes(imgH=40, imgW=60):
+    # Two components, one of them touching the frame border.
+    mask = np.zeros((imgH, imgW), dtype=bool)
+    mask[8:20, 10:30] = True
+    mask[25:40, 45:60] = True
+    mask[22:26, 5:9] = True
+    return mask
+
+
+@pytest.mark.parametrize('solver, atol', [('direct', 1e-10), ('auto', 1e-10), ('cg', 1e-7)])
+def test_regionfill_matches_laplace(solver, atol):
+    mask = holes()
+    I = smooth_image(*mask.shape)
+    ref = reference(I, mask)
+
+    filled = RegionFill(mask, solver=solver, tol=1e-10).fill(I)
+    np.testing.assert_allclose(filled, ref, atol=atol)
+    np.testing.assert_array_equal(filled[~mask], I[~mask])
+
+    # Single channel, and the regionfill wrapper
+    np.testing.assert_allclose(regionfill(I[:, :, 0], mask, solver=solver, tol=1e-10),
+                               ref[:, :, 0], atol=atol)
+
+
+def test_regionfill_cg_warm_start():
+    mask = holes()
+    I = smooth_image(*mask.shape)
+    ref = reference(I, mask)
+    filler = RegionFill(mask, solver='cg', tol=1e-10)
+    np.testing.assert_allclose(filler.fill(I, x0=ref + 0.01), ref, atol=1e-7)
+
+
+def test_regionfill_workers():
+    mask = holes()
+    I = smooth_image(*mask.shape)
+    np.testing.assert_allclose(RegionFill(mask, workers=3).fill(I), RegionFill(mask).fill(I))
+
+
+@pytest.mark.parametrize('known', [(10, 30, 15, 45), (0, 30, 15, 60), (5, 40, 0, 20)])
+def test_ring_matches_laplace(known):
+    # Extrapolation: the hole is the whole frame but a rectangle.
+    y0, y1, x0, x1 = known
+    mask = np.ones((40, 60), dtype=bool)
+    mask[y0:y1, x0:x1] = False
+    I = smooth_image(*mask.shape)
+
+    filler = RegionFill(mask)
+    assert isinstance(filler.ring, RingFill)
+    np.testing.assert_allclose(filler.fill(I), reference(I, mask), atol=1e-9)
+
+
+def test_regionfill_batch_torch_matches_laplace():
+    pytest.importorskip('torch')
+    from utils.region_fill_torch import regionfill_batch
+
+    masks = np.stack((holes(), np.roll(holes(), 7, axis=1)))
+    images = np.stack((smooth_image(40, 60), smooth_image(40, 60)[:, ::-1]))
+    filled = regionfill_batch(images, masks, tol=1e-7, max_iter=500)
+    for I, mask, result in zip(images, masks, filled):
+        ref = reference(I, mask)
+        assert np.abs(np.asarray(result) - ref).max() < 1e-5 * np.ptp(ref)
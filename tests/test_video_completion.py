@@ -0,0 +1,98 @@
+import argparse
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+# The tool needs the full environment (RAFT, EdgeConnect, imutils, ...).
+vc = pytest.importorskip('video_completion')
+
+
+class RecordingGenerator(torch.nn.Module):
+    """Flow generator that records its input and outputs a zero flow.
+    """
+
+    def __init__(self):
+        super(RecordingGenerator, self).__init__()
+        self.weight = torch.nn.Parameter(torch.zeros(1))
+        self.inputs = []
+
+    def forward(self, x):
+        self.inputs.append(x.detach().cpu().numpy())
+        return torch.zeros((x.shape[0], 2) + x.shape[2:]) + self.weight
+
+
+def make_flows(imgH=24, imgW=32, nFrame=3):
+    yy, xx = np.mgrid[0:imgH, 0:imgW].astype(np.float32)
+    corrFlow = np.stack([np.stack((np.where(xx > 12 + t, 3., 0.5), 0.2 * np.sin(yy / 5.)), axis=2)
+                         for t in range(nFrame)], axis=3).astype(np.float32)
+    flow_mask = np.zeros((imgH, imgW, nFrame + 1), dtype=bool)
+    flow_mask[8:16, 10:20, :] = True
+    return corrFlow, flow_mask
+
+
+def learned_args():
+    return argparse.Namespace(flow_max_hole=0.9, flow_batch_size=2, flow_completion_fill=False,
+                              flow_solver='direct', flow_solver_tol=1e-6)
+
+
+def test_complete_flow_learned_passes_completed_edges():
+    corrFlow, flow_mask = make_flows()
+    nFrame = corrFlow.shape[3]
+    # Completed edges: a line across the hole.
+    edge = np.zeros(corrFlow.shape[:2] + (nFrame, ), dtype=np.float32)
+    edge[12, :, :] = 1
+
+    generator = RecordingGenerator()
+    compFlow = np.zeros_like(corrFlow)
+    vc.complete_flow_learned(learned_args(), generator, corrFlow, flow_mask, 'forward', edge, compFlow)
+
+    imgH, imgW = corrFlow.shape[:2]
+    inputs = np.concatenate(generator.inputs)[:, :, :imgH, :imgW]
+    edges, masks = inputs[:, 2], inputs[:, 3]
+    hole = masks > 0
+    assert hole.any()
+    np.testing.assert_array_equal(edges[hole], np.moveaxis(edge, 2, 0)[hole])
+    assert edges[:, 12][hole[:, 12]].min() == 1
+
+
+def test_complete_flow_learned_known_region_edges():
+    # edge_completion leaves the edge volume empty away from the hole.
+    corrFlow, flow_mask = make_flows()
+    nFrame = corrFlow.shape[3]
+    edge = np.zeros(corrFlow.shape[:2] + (nFrame, ), dtype=np.float32)
+    edge[flow_mask[:, :, :nFrame]] = 1
+
+    generator = RecordingGenerator()
+    compFlow = np.zeros_like(corrFlow)
+    vc.complete_flow_learned(learned_args(), generator, corrFlow, flow_mask, 'forward', edge, compFlow)
+
+    imgH, imgW = corrFlow.shape[:2]
+    inputs = np.concatenate(generator.inputs)[:, :, :imgH, :imgW]
+    for i in range(nFrame):
+        known = np.invert(flow_mask[:, :, i])
+        canny_edges = vc.flow_canny(corrFlow[..., i], flow_mask[:, :, i])[1]
+        assert canny_edges[known].sum() > 0
+        np.testing.assert_array_equal(inputs[i, 2][known], canny_edges[known])
+        assert np.all(inputs[i, 2][flow_mask[:, :, i]] == 1)
+
+
+def test_compute_roi_nonlocal_margin():
+    imgH, imgW, nFrame = 96, 128, 4
+    flow_mask = np.zeros((imgH, imgW, nFrame), dtype=bool)
+    flow_mask[40:50, 60:70, :] = True
+    corrFlowF = np.full((imgH, imgW, 2, nFrame - 1), 0.5, dtype=np.float32)
+    corrFlowB = -corrFlowF
+    # The key frames are 20 pixels away.
+    corrFlowNLF = np.zeros((imgH, imgW, 2, 3, nFrame), dtype=np.float32)
+    corrFlowNLF[:, :, 0] = 20.
+    corrFlowNLB = -corrFlowNLF
+
+    args = argparse.Namespace(Nonlocal=False, roi_margin=0)
+    y0, y1, x0, x1, _, _ = vc.compute_roi(args, flow_mask, corrFlowF, corrFlowB)
+    assert x0 > 60 - 20 and x1 < 70 + 20
+
+    args.Nonlocal = True
+    y0, y1, x0, x1, t0, t1 = vc.compute_roi(args, flow_mask, corrFlowF, corrFlowB, corrFlowNLF, corrFlowNLB)
+    assert (t0, t1) == (0, nFrame)
+    assert y0 <= 40 - 20 and y1 >= 50 + 20 and x0 <= 60 - 20 and x1 >= 70 + 20
@@ -25,16 +25,22 @@ class DeepFillv1(object):
 
     def forward(self, img, mask):
 
-        img, mask, small_mask = self.data_preprocess(img, mask, size=self.image_shape)
+        return self.forward_batch([img], [mask])[0]
 
-        image = torch.stack([img])
-        mask = torch.stack([mask])
-        small_mask = torch.stack([small_mask])
+    def forward_batch(self, imgs, masks):
+        """Inpaints several images, each with its own mask, in one batch.
+        """
+        data = [self.data_preprocess(img, mask, size=self.image_shape) for img, mask in zip(imgs, masks)]
+
+        image = torch.stack([d[0] for d in data])
+        mask = torch.stack([d[1] for d in data])
+        small_mask = torch.stack([d[2] for d in data])
 
         with torch.no_grad():
             _, inpaint_res, _ = self.deepfill(image.to(self.device), mask.to(self.device), small_mask.to(self.device))
 
-        res_complete = self.data_proprocess(image, mask, inpaint_res)
+        res_complete = [self.data_proprocess(image[i : i + 1], mask[i : i + 1], inpaint_res[i : i + 1])
+                        for i in range(len(data))]
 
         return res_complete
 
@@ -4,8 +4,260 @@ import cv2
 import copy
 import numpy as np
 import scipy.io as sio
-from utils.common_utils import interp, BFconsistCheck, \
-    FBconsistCheck, consistCheck, get_KeySourceFrame_flowNN
+from utils.common_utils import interp, interp_holes, BFconsistCheck, \
+    FBconsistCheck, consistCheckAt, create_array, \
+    KeySourceFrame_flowNN, HoleIndex
+
+
+# HaveFlowNN state codes (int8)
+NN_UNREACHABLE = 0
+NN_REACHABLE = 1
+NN_NOT_HOLE = -1
+
+# flowNN coordinates (float32) of the pixels without flow neighbor
+NN_INVALID = 99999
+
+
+class FlowCorrespondence(object):
+    """Transitive flow neighbors (flowNN) of the hole pixels, traced through
+    the completed flows by the forward and backward passes.
+
+    The tracing only depends on the flows, the mask, consistencyThres and
+    border (1 for the gradients, whose last row and column are not valid).
+    update(mask) keeps the entries of the previous mask that are still valid
+    and only re-traces the ones invalidated by the pixels whose hole status
+    changed (retraced), so the map can be reused across the iterations of the
+    completion.
+    """
+    def __init__(self, args, videoFlowF, videoFlowB, border=0):
+        self.args = args
+        self.videoFlowF = videoFlowF
+        self.videoFlowB = videoFlowB
+        self.border = border
+        self.holes = None
+
+    def update(self, mask):
+        """Traces the flow neighbors of the hole pixels of mask.
+        """
+        args = self.args
+        imgH, imgW, nFrame = mask.shape
+        holes = HoleIndex(mask, args.scratch_dir)
+        sub = holes.sub
+        numPix = holes.numPix
+
+        # Per direction [BN, FN], in the order of sub:
+        # neighbor:       numPix x [y, x, t] x 2 | flow neighbor (float32)
+        # link:           numPix x 2 | consistent and inside the frame
+        # uv:             numPix x [u, v] x 2 | |forward-backward difference|
+        # flowNN:         numPix x [y, x, t] x 2 | transitive flow neighbor
+        # haveNN:         numPix x 2 | flowNN is reachable
+        # consistency_uv: numPix x 2 x [u, v] | max uv along the chain
+        neighbor = np.zeros((numPix, 3, 2), dtype=np.float32)
+        link = np.zeros((numPix, 2), dtype=bool)
+        uv = np.zeros((numPix, 2, 2), dtype=np.float32)
+        flowNN = np.full((numPix, 3, 2), NN_INVALID, dtype=np.float32)
+        haveNN = np.zeros((numPix, 2), dtype=bool)
+        consistency_uv = create_array((numPix, 2, 2), np.float32, args.scratch_dir)
+        # filled: numPix | filled by the last propagation
+        filled = np.zeros(numPix, dtype=bool)
+
+        # The flow neighbors of the pixels that were already holes only depend
+        # on the flows, they are carried over with their previous entries.
+        old = self.holes
+        if old is None:
+            oldRows = np.full(numPix, -1, dtype=np.int64)
+        else:
+            oldRows = old.lookup(sub[:, 0], sub[:, 1], sub[:, 2])
+        cached = oldRows >= 0
+        if old is not None:
+            neighbor[cached] = self.neighbor[oldRows[cached]]
+            link[cached] = self.link[oldRows[cached]]
+            uv[cached] = self.uv[oldRows[cached]]
+            flowNN[cached] = self.flowNN[oldRows[cached]]
+            haveNN[cached] = self.haveNN[oldRows[cached]]
+            consistency_uv[cached] = self.consistency_uv[oldRows[cached]]
+            filled[cached] = self.filled[oldRows[cached]]
+
+        # dirty: the entries to (re-)trace
+        dirty = np.repeat(np.invert(cached)[:, None], 2, axis=1)
+
+        # 1. Forward Pass (backward flow propagation), BN:0
+        # 2. Backward Pass (forward flow propagation), FN:1
+        for NN_idx, frameIndSet, passName in ((0, range(1, nFrame), 'Forward Pass'),
+                                              (1, range(nFrame - 2, -1, -1), 'Backward Pass')):
+            print(passName + '......')
+            step = -1 if NN_idx == 0 else 1
+
+            for indFrame in frameIndSet:
+                holeRows = holes.rows(indFrame)
+
+                new = holeRows[np.invert(cached[holeRows])]
+                if len(new) > 0:
+                    neighbor[new, :, NN_idx], link[new, NN_idx], uv[new, :, NN_idx] = \
+                        self.flowNeighbors(sub[new], NN_idx)
+
+                # For each missing pixel [y, x, t], we check its flow neighbor
+                # [y', x', t+step]. Only the consistent ones inside the frame.
+                holeRows = holeRows[link[holeRows, NN_idx]]
+                flow_neighbor = neighbor[holeRows, :, NN_idx]
+                flow_neighbor_int = np.round(flow_neighbor).astype(np.int32)
+                neighborRows = holes.lookup(flow_neighbor_int[:, 0],
+                                            flow_neighbor_int[:, 1],
+                                            indFrame + step)
+
+                # An entry is invalidated when the hole status of its flow
+                # neighbor changed, or when the entry of its flow neighbor is.
+                if old is not None:
+                    oldNeighborRows = old.lookup(flow_neighbor_int[:, 0],
+                                                 flow_neighbor_int[:, 1],
+                                                 indFrame + step)
+                    dirty[holeRows, NN_idx] |= \
+                        ((oldNeighborRows >= 0) != (neighborRows >= 0)) | \
+                        ((neighborRows >= 0) & dirty[np.maximum(neighborRows, 0), NN_idx])
+
+                retrace = dirty[holeRows, NN_idx]
+                holeRows = holeRows[retrace]
+                flow_neighbor = flow_neighbor[retrace]
+                flow_neighbor_int = flow_neighbor_int[retrace]
+                neighborRows = neighborRows[retrace]
+
+                flowNN[holeRows, :, NN_idx] = NN_INVALID
+                haveNN[holeRows, NN_idx] = False
+                consistency_uv[holeRows, NN_idx, :] = 0
+
+                # Case 1: If mask[round(y'), round(x'), t+step] == 0,
+                #         the flow neighbor of [y, x, t] is known.
+                #         [y', x', t+step] is the flow neighbor.
+                KnownInd = neighborRows < 0
+                Known = holeRows[KnownInd]
+
+                flowNN[Known, :, NN_idx] = flow_neighbor[KnownInd]
+                haveNN[Known, NN_idx] = True
+                consistency_uv[Known, NN_idx, :] = uv[Known, :, NN_idx]
+
+                # Case 2: If mask[round(y'), round(x'), t+step] == 1,
+                #  the pixel@[round(y'), round(x'), t+step] is also occluded.
+                #  If it has a flow neighbor, we can borrow the value and
+                #  refine it. Otherwise this is isolated pixel. Do nothing.
+                UnknownInd = np.invert(KnownInd)
+                neighborRows = np.where(UnknownInd, neighborRows, 0)
+                Valid_ = UnknownInd & haveNN[neighborRows, NN_idx]
+
+                refineVec = np.concatenate((
+                    (flow_neighbor[:, 0] - flow_neighbor_int[:, 0]).reshape(-1, 1),
+                    (flow_neighbor[:, 1] - flow_neighbor_int[:, 1]).reshape(-1, 1),
+                    np.zeros((flow_neighbor.shape[0])).reshape(-1, 1)), 1)
+
+                # The transitive flow neighbor may be out-of-boundary
+                # after refinement.
+                flowNN_tmp = flowNN[neighborRows, :, NN_idx] + refineVec
+                flowNN_int = np.round(flowNN_tmp).astype(np.int32)
+                ValidPos_ = self.inside(flowNN_int, imgH, imgW)
+
+                Valid = Valid_ & ValidPos_
+                Transitive = holeRows[Valid]
+
+                flowNN[Transitive, :, NN_idx] = flowNN_tmp[Valid]
+                haveNN[Transitive, NN_idx] = True
+                consistency_uv[Transitive, NN_idx, :] = np.maximum(
+                    uv[Transitive, :, NN_idx],
+                    consistency_uv[neighborRows[Valid], NN_idx, :])
+
+                numHole = len(holes.rows(indFrame))
+                numReach = np.sum(haveNN[holes.rows(indFrame), NN_idx])
+                print("Frame {0:3d}: {1:8d} + {2:8d} = {3:8d} ({4:8d} traced)"
+                .format(indFrame, numReach, numHole - numReach, numHole, len(holeRows)))
+
+        self.shape = mask.shape
+        self.previous = old
+        self.holes = holes
+        self.retraced = dirty.any(axis=1)
+        self.neighbor = neighbor
+        self.link = link
+        self.uv = uv
+        self.flowNN = flowNN
+        self.haveNN = haveNN
+        self.consistency_uv = consistency_uv
+        self.filled = filled
+
+    def flowNeighbors(self, holepixPos, NN_idx):
+        """Flow neighbors of the hole pixels [y, x, t] in the direction NN_idx.
+        """
+        imgH, imgW = self.videoFlowF.shape[:2]
+        indFrame = holepixPos[0, 2]
+
+        if NN_idx == 0:
+            # Backward flow neighbor. Should be located at frame t-1
+            flowTo = self.videoFlowB[:, :, :, indFrame - 1]    # t --> t-1
+            flowBack = self.videoFlowF[:, :, :, indFrame - 1]  # t-1 --> t
+            check = BFconsistCheck
+        else:
+            # Forward flow neighbor. Should be located at frame t+1
+            flowTo = self.videoFlowF[:, :, :, indFrame]        # t --> t+1
+            flowBack = self.videoFlowB[:, :, :, indFrame]      # t+1 --> t
+            check = FBconsistCheck
+
+        flow_neighbor = holepixPos.astype(np.float32)
+        flow_neighbor[:, 0] += flowTo[holepixPos[:, 0], holepixPos[:, 1], 1]
+        flow_neighbor[:, 1] += flowTo[holepixPos[:, 0], holepixPos[:, 1], 0]
+        flow_neighbor[:, 2] += -1 if NN_idx == 0 else 1
+
+        # Check the forward/backward consistency
+        IsConsist, _ = check(flow_neighbor,
+                             flowBack[:, :, 1],
+                             flowBack[:, :, 0],
+                             holepixPos,
+                             self.args.consistencyThres)
+
+        # Check out-of-boundary
+        ValidPos = self.inside(np.round(flow_neighbor).astype(np.int32), imgH, imgW)
+
+        _, uv = consistCheckAt(flowBack, flowTo, holepixPos)
+
+        return flow_neighbor, np.logical_and(IsConsist, ValidPos), np.abs(uv)
+
+    def inside(self, pos, imgH, imgW):
+        """Whether the rounded positions [y, x] are inside the frame.
+        Last column and last row does not have valid gradient (border 1).
+        """
+        return np.logical_and(
+            np.logical_and(pos[:, 0] >= 0,
+                           pos[:, 0] <= imgH - 1 - self.border),
+            np.logical_and(pos[:, 1] >= 0,
+                           pos[:, 1] <= imgW - 1 - self.border))
+
+    def chainExtent(self):
+        """First and last frame reached by each hole pixel through chains of
+        hole pixels, following the backward and the forward flow neighbors.
+        Filling a frame in this range gives the pixel a flow neighbor.
+        """
+        holes = self.holes
+        nFrame = self.shape[2]
+        extent = np.repeat(holes.sub[:, 2:3], 2, axis=1)
+
+        for NN_idx, frameIndSet in ((0, range(1, nFrame)),
+                                    (1, range(nFrame - 2, -1, -1))):
+            step = -1 if NN_idx == 0 else 1
+            for indFrame in frameIndSet:
+                holeRows = holes.rows(indFrame)
+                holeRows = holeRows[self.link[holeRows, NN_idx]]
+                flow_neighbor_int = np.round(self.neighbor[holeRows, :, NN_idx]).astype(np.int32)
+                neighborRows = holes.lookup(flow_neighbor_int[:, 0],
+                                            flow_neighbor_int[:, 1],
+                                            indFrame + step)
+                Unknown = neighborRows >= 0
+                extent[holeRows[Unknown], NN_idx] = extent[neighborRows[Unknown], NN_idx]
+
+        return extent[:, 0], extent[:, 1]
+
+    def HaveFlowNN(self):
+        """Dense imgH x imgW x nFrame x 2 state codes of the flow neighbors.
+        """
+        imgH, imgW, nFrame = self.shape
+        sub = self.holes.sub
+        HaveFlowNN = create_array((imgH, imgW, nFrame, 2), np.int8, self.args.scratch_dir, fill=NN_NOT_HOLE)
+        HaveFlowNN[sub[:, 0], sub[:, 1], sub[:, 2], :] = np.where(self.haveNN, NN_REACHABLE, NN_UNREACHABLE)
+        return HaveFlowNN
 
 
 def get_flowNN(args,
@@ -14,20 +266,25 @@ def get_flowNN(args,
                videoFlowF,
                videoFlowB,
                videoNonLocalFlowF,
-               videoNonLocalFlowB):
+               videoNonLocalFlowB,
+               corr=None,
+               incremental=False):
 
     # video:      imgH x imgW x 3 x nFrame
     # mask:       imgH x imgW x nFrame
     # videoFlowF: imgH x imgW x 2 x (nFrame - 1)
     # videoFlowB: imgH x imgW x 2 x (nFrame - 1)
     # videoNonLocalFlowF: imgH x imgW x 2 x 3 x nFrame
+    # corr:       FlowCorrespondence of videoFlowF/videoFlowB, reused across
+    #             the iterations of the completion (optional)
+    # incremental: only re-propagate the hole pixels affected by the changes
+    #             of the mask since the last call with corr
 
     if args.Nonlocal:
         num_candidate = 5
     else:
         num_candidate = 2
     imgH, imgW, nFrame = mask.shape
-    numPix = np.sum(mask)
 
     # |--------------------|
     # |       y            |
@@ -35,460 +292,227 @@ def get_flowNN(args,
     # |                    |
     # |--------------------|
 
-    # sub: numPix * [y x t]
-    sub = np.concatenate((np.where(mask == 1)[0].reshape(-1, 1),
-                          np.where(mask == 1)[1].reshape(-1, 1),
-                          np.where(mask == 1)[2].reshape(-1, 1)), axis=1)
-
-    # flowNN:      numPix x 3 x 2
-    # HaveFlowNN:  imgH x imgW x nFrame x 2
+    # flowNN:         numPix x 3 x 2 (float32)
+    # consistency_uv: numPix x [BN, FN] x [u, v], in the order of sub
     # First channel stores backward flow neighbor,
     # Second channel stores forward flow neighbor.
-    # numPixInd:   imgH x imgW x nFrame
-
-    flowNN = np.ones((numPix, 3, 2)) * 99999
-    HaveFlowNN = np.ones((imgH, imgW, nFrame, 2)) * 99999
-    HaveFlowNN[mask, :] = 0
-    numPixInd = np.ones((imgH, imgW, nFrame)) * -1
-    consistencyMap = np.zeros((imgH, imgW, num_candidate, nFrame))
-    consistency_uv = np.zeros((imgH, imgW, 2, 2, nFrame))
-
-    # numPixInd[x, y, t] gives the index of the missing pixel@[x, y, t] in sub,
-    # i.e. which row. numPixInd[x, y, t] = idx; sub[idx, :] = [x, y, t]
-    for idx in range(len(sub)):
-        numPixInd[sub[idx, 0], sub[idx, 1], sub[idx, 2]] = idx
-
-    # Initialization
-    frameIndSetF = range(1, nFrame)
-    frameIndSetB = range(nFrame - 2, -1, -1)
-
-    # 1. Forward Pass (backward flow propagation)
-    print('Forward Pass......')
+    if corr is None:
+        corr = FlowCorrespondence(args, videoFlowF, videoFlowB)
+    corr.update(mask)
+    flowNN = corr.flowNN
+    consistency_uv = corr.consistency_uv
 
-    NN_idx = 0 # BN:0
-    for indFrame in frameIndSetF:
+    # sub: numPix * [y x t] (int32), sorted by frame
+    holes = corr.holes
+    sub = holes.sub
 
-        # Bool indicator of missing pixels at frame t
-        holepixPosInd = (sub[:, 2] == indFrame)
+    if incremental and corr.previous is not None:
+        update_flowNN(args, video, mask, corr, videoNonLocalFlowF, videoNonLocalFlowB)
+        return video, unfilled_mask(args, corr), corr.HaveFlowNN()
 
-        # Hole pixel location at frame t, i.e. [y, x, t]
-        holepixPos = sub[holepixPosInd, :]
-
-        # Calculate the backward flow neighbor. Should be located at frame t-1
-        flowB_neighbor = copy.deepcopy(holepixPos)
-        flowB_neighbor = flowB_neighbor.astype(np.float32)
-
-        flowB_vertical = videoFlowB[:, :, 1, indFrame - 1]  # t --> t-1
-        flowB_horizont = videoFlowB[:, :, 0, indFrame - 1]
-        flowF_vertical = videoFlowF[:, :, 1, indFrame - 1]  # t-1 --> t
-        flowF_horizont = videoFlowF[:, :, 0, indFrame - 1]
-
-        flowB_neighbor[:, 0] += flowB_vertical[holepixPos[:, 0], holepixPos[:, 1]]
-        flowB_neighbor[:, 1] += flowB_horizont[holepixPos[:, 0], holepixPos[:, 1]]
-        flowB_neighbor[:, 2] -= 1
-
-        # Round the backward flow neighbor location
-        flow_neighbor_int = np.round(copy.deepcopy(flowB_neighbor)).astype(np.int32)
-
-        # Chen: I should combine the following two operations together
-        # Check the backward/forward consistency
-        IsConsist, _ = BFconsistCheck(flowB_neighbor,
-                                      flowF_vertical,
-                                      flowF_horizont,
-                                      holepixPos,
-                                      args.consistencyThres)
-
-        BFdiff, BF_uv = consistCheck(videoFlowF[:, :, :, indFrame - 1],
-                                     videoFlowB[:, :, :, indFrame - 1])
-
-        # Check out-of-boundary
-        # Last column and last row does not have valid gradient
-        ValidPos = np.logical_and(
-            np.logical_and(flow_neighbor_int[:, 0] >= 0,
-                           flow_neighbor_int[:, 0] <= imgH - 1),
-            np.logical_and(flow_neighbor_int[:, 1] >= 0,
-                           flow_neighbor_int[:, 1] <= imgW - 1))
-
-        # Only work with pixels that are not out-of-boundary
-        holepixPos = holepixPos[ValidPos, :]
-        flowB_neighbor = flowB_neighbor[ValidPos, :]
-        flow_neighbor_int = flow_neighbor_int[ValidPos, :]
-        IsConsist = IsConsist[ValidPos]
-
-        # For each missing pixel in holepixPos|[y, x, t],
-        # we check its backward flow neighbor flowB_neighbor|[y', x', t-1].
-
-        # Case 1: If mask[round(y'), round(x'), t-1] == 0,
-        #         the backward flow neighbor of [y, x, t] is known.
-        #         [y', x', t-1] is the backward flow neighbor.
-
-        # KnownInd: Among all backward flow neighbors, which pixel is known.
-        KnownInd = mask[flow_neighbor_int[:, 0],
-                        flow_neighbor_int[:, 1],
-                        indFrame - 1] == 0
-
-        KnownIsConsist = np.logical_and(KnownInd, IsConsist)
-
-        # We save backward flow neighbor flowB_neighbor in flowNN
-        flowNN[numPixInd[holepixPos[KnownIsConsist, 0],
-                         holepixPos[KnownIsConsist, 1],
-                         indFrame].astype(np.int32), :, NN_idx] = \
-                                                flowB_neighbor[KnownIsConsist, :]
-        # flowNN[np.where(holepixPosInd == 1)[0][ValidPos][KnownIsConsist], :, 0] = \
-        #                                         flowB_neighbor[KnownIsConsist, :]
-
-        # We mark [y, x, t] in HaveFlowNN as 1
-        HaveFlowNN[holepixPos[KnownIsConsist, 0],
-                   holepixPos[KnownIsConsist, 1],
-                   indFrame,
-                   NN_idx] = 1
-
-        # HaveFlowNN[:, :, :, 0]
-        # 0: Backward flow neighbor can not be reached
-        # 1: Backward flow neighbor can be reached
-        # -1: Pixels that do not need to be completed
-
-        consistency_uv[holepixPos[KnownIsConsist, 0], holepixPos[KnownIsConsist, 1], NN_idx, 0, indFrame] = np.abs(BF_uv[holepixPos[KnownIsConsist, 0], holepixPos[KnownIsConsist, 1], 0])
-        consistency_uv[holepixPos[KnownIsConsist, 0], holepixPos[KnownIsConsist, 1], NN_idx, 1, indFrame] = np.abs(BF_uv[holepixPos[KnownIsConsist, 0], holepixPos[KnownIsConsist, 1], 1])
-
-        # Case 2: If mask[round(y'), round(x'), t-1] == 1,
-        #  the pixel@[round(y'), round(x'), t-1] is also occluded.
-        #  We further check if we already assign a backward flow neighbor for the backward flow neighbor
-        #  If HaveFlowNN[round(y'), round(x'), t-1] == 0,
-        #   this is isolated pixel. Do nothing.
-        #  If HaveFlowNN[round(y'), round(x'), t-1] == 1,
-        #   we can borrow the value and refine it.
-
-        UnknownInd = np.invert(KnownInd)
-
-        # If we already assign a backward flow neighbor@[round(y'), round(x'), t-1]
-        HaveNNInd = HaveFlowNN[flow_neighbor_int[:, 0],
-                               flow_neighbor_int[:, 1],
-                               indFrame - 1,
-                               NN_idx] == 1
-
-        # Unknown & IsConsist & HaveNNInd
-        Valid_ = np.logical_and.reduce((UnknownInd, HaveNNInd, IsConsist))
-
-        refineVec = np.concatenate((
-            (flowB_neighbor[:, 0] - flow_neighbor_int[:, 0]).reshape(-1, 1),
-            (flowB_neighbor[:, 1] - flow_neighbor_int[:, 1]).reshape(-1, 1),
-            np.zeros((flowB_neighbor[:, 0].shape[0])).reshape(-1, 1)), 1)
-
-        # Check if the transitive backward flow neighbor of [y, x, t] is known.
-        # Sometimes after refinement, it is no longer known.
-        flowNN_tmp = copy.deepcopy(flowNN[numPixInd[flow_neighbor_int[:, 0],
-                                                    flow_neighbor_int[:, 1],
-                                                    indFrame - 1].astype(np.int32), :, NN_idx] + refineVec[:, :])
-        flowNN_tmp = np.round(flowNN_tmp).astype(np.int32)
-
-        # Check out-of-boundary. flowNN_tmp may be out-of-boundary
-        ValidPos_ = np.logical_and(
-            np.logical_and(flowNN_tmp[:, 0] >= 0,
-                           flowNN_tmp[:, 0] <= imgH - 1),
-            np.logical_and(flowNN_tmp[:, 1] >= 0,
-                           flowNN_tmp[:, 1] <= imgW - 1))
-
-        # Change the out-of-boundary value to 0, in order to run mask[y,x,t]
-        # in the next line. It won't affect anything as ValidPos_ is saved already
-        flowNN_tmp[np.invert(ValidPos_), :] = 0
-        ValidNN = mask[flowNN_tmp[:, 0],
-                       flowNN_tmp[:, 1],
-                       flowNN_tmp[:, 2]] == 0
-
-        # Valid = np.logical_and.reduce((Valid_, ValidNN, ValidPos_))
-        Valid = np.logical_and.reduce((Valid_, ValidPos_))
-
-        # We save the transitive backward flow neighbor flowB_neighbor in flowNN
-        flowNN[numPixInd[holepixPos[Valid, 0],
-                         holepixPos[Valid, 1],
-                         indFrame].astype(np.int32), :, NN_idx] = \
-        flowNN[numPixInd[flow_neighbor_int[Valid, 0],
-                         flow_neighbor_int[Valid, 1],
-                         indFrame - 1].astype(np.int32), :, NN_idx] + refineVec[Valid, :]
-
-        # We mark [y, x, t] in HaveFlowNN as 1
-        HaveFlowNN[holepixPos[Valid, 0],
-                   holepixPos[Valid, 1],
-                   indFrame,
-                   NN_idx] = 1
-
-        consistency_uv[holepixPos[Valid, 0], holepixPos[Valid, 1], NN_idx, 0, indFrame] = np.maximum(np.abs(BF_uv[holepixPos[Valid, 0], holepixPos[Valid, 1], 0]), np.abs(consistency_uv[flow_neighbor_int[Valid, 0], flow_neighbor_int[Valid, 1], NN_idx, 0, indFrame - 1]))
-        consistency_uv[holepixPos[Valid, 0], holepixPos[Valid, 1], NN_idx, 1, indFrame] = np.maximum(np.abs(BF_uv[holepixPos[Valid, 0], holepixPos[Valid, 1], 1]), np.abs(consistency_uv[flow_neighbor_int[Valid, 0], flow_neighbor_int[Valid, 1], NN_idx, 1, indFrame - 1]))
-
-        consistencyMap[:, :, NN_idx, indFrame] = (consistency_uv[:, :, NN_idx, 0, indFrame] ** 2 + consistency_uv[:, :, NN_idx, 1, indFrame] ** 2) ** 0.5
-
-        print("Frame {0:3d}: {1:8d} + {2:8d} = {3:8d}"
-        .format(indFrame,
-                np.sum(HaveFlowNN[:, :, indFrame, NN_idx] == 1),
-                np.sum(HaveFlowNN[:, :, indFrame, NN_idx] == 0),
-                np.sum(HaveFlowNN[:, :, indFrame, NN_idx] != 99999)))
-
-    # 2. Backward Pass (forward flow propagation)
-    print('Backward Pass......')
-
-    NN_idx = 1 # FN:1
-    for indFrame in frameIndSetB:
-
-        # Bool indicator of missing pixels at frame t
-        holepixPosInd = (sub[:, 2] == indFrame)
-
-        # Hole pixel location at frame t, i.e. [y, x, t]
-        holepixPos = sub[holepixPosInd, :]
-
-        # Calculate the forward flow neighbor. Should be located at frame t+1
-        flowF_neighbor = copy.deepcopy(holepixPos)
-        flowF_neighbor = flowF_neighbor.astype(np.float32)
-
-        flowF_vertical = videoFlowF[:, :, 1, indFrame]  # t --> t+1
-        flowF_horizont = videoFlowF[:, :, 0, indFrame]
-        flowB_vertical = videoFlowB[:, :, 1, indFrame]  # t+1 --> t
-        flowB_horizont = videoFlowB[:, :, 0, indFrame]
-
-        flowF_neighbor[:, 0] += flowF_vertical[holepixPos[:, 0], holepixPos[:, 1]]
-        flowF_neighbor[:, 1] += flowF_horizont[holepixPos[:, 0], holepixPos[:, 1]]
-        flowF_neighbor[:, 2] += 1
-
-        # Round the forward flow neighbor location
-        flow_neighbor_int = np.round(copy.deepcopy(flowF_neighbor)).astype(np.int32)
-
-        # Check the forawrd/backward consistency
-        IsConsist, _ = FBconsistCheck(flowF_neighbor,
-                                      flowB_vertical,
-                                      flowB_horizont,
-                                      holepixPos,
-                                      args.consistencyThres)
-
-        FBdiff, FB_uv = consistCheck(videoFlowB[:, :, :, indFrame],
-                                     videoFlowF[:, :, :, indFrame])
-
-        # Check out-of-boundary
-        # Last column and last row does not have valid gradient
-        ValidPos = np.logical_and(
-            np.logical_and(flow_neighbor_int[:, 0] >= 0,
-                           flow_neighbor_int[:, 0] <= imgH - 1),
-            np.logical_and(flow_neighbor_int[:, 1] >= 0,
-                           flow_neighbor_int[:, 1] <= imgW - 1))
-
-        # Only work with pixels that are not out-of-boundary
-        holepixPos = holepixPos[ValidPos, :]
-        flowF_neighbor = flowF_neighbor[ValidPos, :]
-        flow_neighbor_int = flow_neighbor_int[ValidPos, :]
-        IsConsist = IsConsist[ValidPos]
-
-        # Case 1:
-        KnownInd = mask[flow_neighbor_int[:, 0],
-                        flow_neighbor_int[:, 1],
-                        indFrame + 1] == 0
-
-        KnownIsConsist = np.logical_and(KnownInd, IsConsist)
-        flowNN[numPixInd[holepixPos[KnownIsConsist, 0],
-                         holepixPos[KnownIsConsist, 1],
-                         indFrame].astype(np.int32), :, NN_idx] = \
-                                                flowF_neighbor[KnownIsConsist, :]
-
-        HaveFlowNN[holepixPos[KnownIsConsist, 0],
-                   holepixPos[KnownIsConsist, 1],
-                   indFrame,
-                   NN_idx] = 1
-
-        consistency_uv[holepixPos[KnownIsConsist, 0], holepixPos[KnownIsConsist, 1], NN_idx, 0, indFrame] = np.abs(FB_uv[holepixPos[KnownIsConsist, 0], holepixPos[KnownIsConsist, 1], 0])
-        consistency_uv[holepixPos[KnownIsConsist, 0], holepixPos[KnownIsConsist, 1], NN_idx, 1, indFrame] = np.abs(FB_uv[holepixPos[KnownIsConsist, 0], holepixPos[KnownIsConsist, 1], 1])
-
-        # Case 2:
-        UnknownInd = np.invert(KnownInd)
-        HaveNNInd = HaveFlowNN[flow_neighbor_int[:, 0],
-                               flow_neighbor_int[:, 1],
-                               indFrame + 1,
-                               NN_idx] == 1
-
-        # Unknown & IsConsist & HaveNNInd
-        Valid_ = np.logical_and.reduce((UnknownInd, HaveNNInd, IsConsist))
-
-        refineVec = np.concatenate((
-            (flowF_neighbor[:, 0] - flow_neighbor_int[:, 0]).reshape(-1, 1),
-            (flowF_neighbor[:, 1] - flow_neighbor_int[:, 1]).reshape(-1, 1),
-            np.zeros((flowF_neighbor[:, 0].shape[0])).reshape(-1, 1)), 1)
-
-        # Check if the transitive backward flow neighbor of [y, x, t] is known.
-        # Sometimes after refinement, it is no longer known.
-        flowNN_tmp = copy.deepcopy(flowNN[numPixInd[flow_neighbor_int[:, 0],
-                                                    flow_neighbor_int[:, 1],
-                                                    indFrame + 1].astype(np.int32), :, NN_idx] + refineVec[:, :])
-        flowNN_tmp = np.round(flowNN_tmp).astype(np.int32)
-
-        # Check out-of-boundary. flowNN_tmp may be out-of-boundary
-        ValidPos_ = np.logical_and(
-            np.logical_and(flowNN_tmp[:, 0] >= 0,
-                           flowNN_tmp[:, 0] <= imgH - 1),
-            np.logical_and(flowNN_tmp[:, 1] >= 0,
-                           flowNN_tmp[:, 1] <= imgW - 1))
-
-        # Change the out-of-boundary value to 0, in order to run mask[y,x,t]
-        # in the next line. It won't affect anything as ValidPos_ is saved already
-        flowNN_tmp[np.invert(ValidPos_), :] = 0
-        ValidNN = mask[flowNN_tmp[:, 0],
-                       flowNN_tmp[:, 1],
-                       flowNN_tmp[:, 2]] == 0
-
-        # Valid = np.logical_and.reduce((Valid_, ValidNN, ValidPos_))
-        Valid = np.logical_and.reduce((Valid_, ValidPos_))
-
-        # We save the transitive backward flow neighbor flowB_neighbor in flowNN
-        flowNN[numPixInd[holepixPos[Valid, 0],
-                         holepixPos[Valid, 1],
-                         indFrame].astype(np.int32), :, NN_idx] = \
-        flowNN[numPixInd[flow_neighbor_int[Valid, 0],
-                         flow_neighbor_int[Valid, 1],
-                         indFrame + 1].astype(np.int32), :, NN_idx] + refineVec[Valid, :]
-
-        # We mark [y, x, t] in HaveFlowNN as 1
-        HaveFlowNN[holepixPos[Valid, 0],
-                   holepixPos[Valid, 1],
-                   indFrame,
-                   NN_idx] = 1
-
-        consistency_uv[holepixPos[Valid, 0], holepixPos[Valid, 1], NN_idx, 0, indFrame] = np.maximum(np.abs(FB_uv[holepixPos[Valid, 0], holepixPos[Valid, 1], 0]), np.abs(consistency_uv[flow_neighbor_int[Valid, 0], flow_neighbor_int[Valid, 1], NN_idx, 0, indFrame + 1]))
-        consistency_uv[holepixPos[Valid, 0], holepixPos[Valid, 1], NN_idx, 1, indFrame] = np.maximum(np.abs(FB_uv[holepixPos[Valid, 0], holepixPos[Valid, 1], 1]), np.abs(consistency_uv[flow_neighbor_int[Valid, 0], flow_neighbor_int[Valid, 1], NN_idx, 1, indFrame + 1]))
-
-        consistencyMap[:, :, NN_idx, indFrame] = (consistency_uv[:, :, NN_idx, 0, indFrame] ** 2 + consistency_uv[:, :, NN_idx, 1, indFrame] ** 2) ** 0.5
-
-        print("Frame {0:3d}: {1:8d} + {2:8d} = {3:8d}"
-        .format(indFrame,
-                np.sum(HaveFlowNN[:, :, indFrame, NN_idx] == 1),
-                np.sum(HaveFlowNN[:, :, indFrame, NN_idx] == 0),
-                np.sum(HaveFlowNN[:, :, indFrame, NN_idx] != 99999)))
-
-    # Interpolation
-    videoBN = copy.deepcopy(video)
-    videoFN = copy.deepcopy(video)
-
-    for indFrame in range(nFrame):
-        # Index of missing pixel whose backward flow neighbor is from frame indFrame
-        SourceFmInd = np.where(flowNN[:, 2, 0] == indFrame)
-
-        print("{0:8d} pixels are from source Frame {1:3d}"
-                        .format(len(SourceFmInd[0]), indFrame))
-        # The location of the missing pixel whose backward flow neighbor is
-        # from frame indFrame flowNN[SourceFmInd, 0, 0], flowNN[SourceFmInd, 1, 0]
-
-        if len(SourceFmInd[0]) != 0:
-
-            # |--------------------|
-            # |       y            |
-            # |   x   *            |
-            # |                    |
-            # |--------------------|
-            # sub: numPix x 3 [y, x, t]
-            # img: [y, x]
-            # interp(img, x, y)
-
-            videoBN[sub[SourceFmInd[0], :][:, 0],
-                    sub[SourceFmInd[0], :][:, 1],
-                 :, sub[SourceFmInd[0], :][:, 2]] = \
-                interp(videoBN[:, :, :, indFrame],
-                        flowNN[SourceFmInd, 1, 0].reshape(-1),
-                        flowNN[SourceFmInd, 0, 0].reshape(-1))
-
-            assert(((sub[SourceFmInd[0], :][:, 2] - indFrame) <= 0).sum() == 0)
-
-    for indFrame in range(nFrame - 1, -1, -1):
-        # Index of missing pixel whose forward flow neighbor is from frame indFrame
-        SourceFmInd = np.where(flowNN[:, 2, 1] == indFrame)
-        print("{0:8d} pixels are from source Frame {1:3d}"
-                        .format(len(SourceFmInd[0]), indFrame))
-        if len(SourceFmInd[0]) != 0:
-
-            videoFN[sub[SourceFmInd[0], :][:, 0],
-                    sub[SourceFmInd[0], :][:, 1],
-                 :, sub[SourceFmInd[0], :][:, 2]] = \
-                interp(videoFN[:, :, :, indFrame],
-                         flowNN[SourceFmInd, 1, 1].reshape(-1),
-                         flowNN[SourceFmInd, 0, 1].reshape(-1))
-
-            assert(((indFrame - sub[SourceFmInd[0], :][:, 2]) <= 0).sum() == 0)
-
-    # New mask
-    mask_tofill = np.zeros((imgH, imgW, nFrame)).astype(np.bool)
+    # valueNN: numPix x 3 x [BN, FN] | values of the flow neighbors
+    valueNN, = propagate_flowNN(corr, [video])
 
     for indFrame in range(nFrame):
-        if args.Nonlocal:
-            consistencyMap[:, :, 2, indFrame], _ = consistCheck(
-                videoNonLocalFlowB[:, :, :, 0, indFrame],
-                videoNonLocalFlowF[:, :, :, 0, indFrame])
-            consistencyMap[:, :, 3, indFrame], _ = consistCheck(
-                videoNonLocalFlowB[:, :, :, 1, indFrame],
-                videoNonLocalFlowF[:, :, :, 1, indFrame])
-            consistencyMap[:, :, 4, indFrame], _ = consistCheck(
-                videoNonLocalFlowB[:, :, :, 2, indFrame],
-                videoNonLocalFlowF[:, :, :, 2, indFrame])
-
-        HaveNN = np.zeros((imgH, imgW, num_candidate))
-
-        if args.Nonlocal:
-            HaveKeySourceFrameFlowNN, imgKeySourceFrameFlowNN = \
-                get_KeySourceFrame_flowNN(sub,
-                                          indFrame,
-                                          mask,
-                                          videoNonLocalFlowB,
-                                          videoNonLocalFlowF,
-                                          video,
-                                          args.consistencyThres)
-
-            HaveNN[:, :, 2] = HaveKeySourceFrameFlowNN[:, :, 0] == 1
-            HaveNN[:, :, 3] = HaveKeySourceFrameFlowNN[:, :, 1] == 1
-            HaveNN[:, :, 4] = HaveKeySourceFrameFlowNN[:, :, 2] == 1
-
-        HaveNN[:, :, 0] = HaveFlowNN[:, :, indFrame, 0] == 1
-        HaveNN[:, :, 1] = HaveFlowNN[:, :, indFrame, 1] == 1
-
-        NotHaveNN = np.logical_and(np.invert(HaveNN.astype(np.bool)),
-                np.repeat(np.expand_dims((mask[:, :, indFrame]), 2), num_candidate, axis=2))
-
-        if args.Nonlocal:
-            HaveNN_sum = np.logical_or.reduce((HaveNN[:, :, 0],
-                                               HaveNN[:, :, 1],
-                                               HaveNN[:, :, 2],
-                                               HaveNN[:, :, 3],
-                                               HaveNN[:, :, 4]))
-        else:
-            HaveNN_sum = np.logical_or.reduce((HaveNN[:, :, 0],
-                                               HaveNN[:, :, 1]))
-
-        videoCandidate = np.zeros((imgH, imgW, 3, num_candidate))
-        videoCandidate[:, :, :, 0] = videoBN[:, :, :, indFrame]
-        videoCandidate[:, :, :, 1] = videoFN[:, :, :, indFrame]
-
-        if args.Nonlocal:
-            videoCandidate[:, :, :, 2] = imgKeySourceFrameFlowNN[:, :, :, 0]
-            videoCandidate[:, :, :, 3] = imgKeySourceFrameFlowNN[:, :, :, 1]
-            videoCandidate[:, :, :, 4] = imgKeySourceFrameFlowNN[:, :, :, 2]
-
-        consistencyMap[:, :, :, indFrame] = np.exp( - consistencyMap[:, :, :, indFrame] / args.alpha)
-
-        consistencyMap[NotHaveNN[:, :, 0], 0, indFrame] = 0
-        consistencyMap[NotHaveNN[:, :, 1], 1, indFrame] = 0
-
-        if args.Nonlocal:
-            consistencyMap[NotHaveNN[:, :, 2], 2, indFrame] = 0
-            consistencyMap[NotHaveNN[:, :, 3], 3, indFrame] = 0
-            consistencyMap[NotHaveNN[:, :, 4], 4, indFrame] = 0
-
-        # weights = (consistencyMap[HaveNN_sum, :, indFrame] * HaveNN[HaveNN_sum, :]) / ((consistencyMap[HaveNN_sum, :, indFrame] * HaveNN[HaveNN_sum, :]).sum(axis=1, keepdims=True) + 1e-16)
-        weights = (consistencyMap[HaveNN_sum, :, indFrame] * HaveNN[HaveNN_sum, :]) / ((consistencyMap[HaveNN_sum, :, indFrame] * HaveNN[HaveNN_sum, :]).sum(axis=1, keepdims=True))
-
-        # Fix the numerical issue. 0 / 0
-        fix = np.where((consistencyMap[HaveNN_sum, :, indFrame] * HaveNN[HaveNN_sum, :]).sum(axis=1, keepdims=True) == 0)[0]
-        weights[fix, :] = HaveNN[HaveNN_sum, :][fix, :] / HaveNN[HaveNN_sum, :][fix, :].sum(axis=1, keepdims=True)
+        # Hole pixels of the frame, the candidates are fused on their rows only
+        holeRows = holes.rows(indFrame)
+
+        # candidate: numPix(frame) x 3 x num_candidate
+        candidate = np.zeros((len(holeRows), 3, num_candidate), dtype=np.float32)
+        candidate[:, :, :2] = valueNN[holeRows]
+
+        fuse_flowNN(args, video, mask, corr, indFrame, holeRows, candidate,
+                    videoNonLocalFlowF, videoNonLocalFlowB)
+
+    mask_tofill = unfilled_mask(args, corr)
+
+    return video, mask_tofill, corr.HaveFlowNN()
+
+
+def propagate_flowNN(corr, videos):
+    """Values of the flow neighbors of the hole pixels of corr, for each of
+    videos as numPix x C x [BN, FN], in the order of corr.holes.sub (the pixels
+    without flow neighbor keep their own value).
+    Only the hole pixels are buffered: the frames are filled following the
+    propagation order, and their source frame is sampled from the video with
+    its hole pixels taken from the values already propagated.
+    """
+    holes = corr.holes
+    sub = holes.sub
+    flowNN = corr.flowNN
+    nFrame = corr.shape[2]
+
+    valueNN = [np.repeat(video[sub[:, 0], sub[:, 1], :, sub[:, 2], None], 2, axis=2)
+               for video in videos]
+
+    for NN_idx, frameIndSet in ((0, range(nFrame)),
+                                (1, range(nFrame - 1, -1, -1))):
+        for indFrame in frameIndSet:
+            # Index of missing pixel at frame indFrame that has a flow neighbor
+            HaveNNInd = holes.rows(indFrame)
+            HaveNNInd = HaveNNInd[flowNN[HaveNNInd, 2, NN_idx] != NN_INVALID]
+
+            for SourceFrame in np.unique(flowNN[HaveNNInd, 2, NN_idx]).astype(np.int32):
+                TargetInd = HaveNNInd[flowNN[HaveNNInd, 2, NN_idx] == SourceFrame]
+                print("{0:8d} pixels of Frame {1:3d} are from source Frame {2:3d}"
+                                .format(len(TargetInd), indFrame, SourceFrame))
+                assert(SourceFrame < indFrame if NN_idx == 0 else SourceFrame > indFrame)
+
+                # |--------------------|
+                # |       y            |
+                # |   x   *            |
+                # |                    |
+                # |--------------------|
+                # sub: numPix x 3 [y, x, t]
+                # img: [y, x]
+                # interp(img, x, y)
+                for video, value in zip(videos, valueNN):
+                    value[TargetInd, :, NN_idx] = \
+                        interp_holes(video[:, :, :, SourceFrame],
+                                     flowNN[TargetInd, 1, NN_idx],
+                                     flowNN[TargetInd, 0, NN_idx],
+                                     holes, SourceFrame, value[:, :, NN_idx])
+
+    return valueNN
+
+
+def update_flowNN(args, video, mask, corr, videoNonLocalFlowF, videoNonLocalFlowB):
+    """Incremental get_flowNN after corr.update(mask): only the hole pixels
+    whose flow neighbors were re-traced, or whose key source frame neighbor
+    changed status, are propagated again. The others keep the value and the
+    filled state of the previous propagation.
+    The candidates are sampled from video instead of the propagated buffers,
+    which only differs where their bilinear footprint overlaps the hole.
+    """
+    imgH, imgW, nFrame = mask.shape
+    num_candidate = 5 if args.Nonlocal else 2
+    holes = corr.holes
+    sub = holes.sub
+    flowNN = corr.flowNN
 
-        # Fuse RGB channel independently
-        video[HaveNN_sum, 0, indFrame] = \
-            np.sum(np.multiply(videoCandidate[HaveNN_sum, 0, :], weights), axis=1)
-        video[HaveNN_sum, 1, indFrame] = \
-            np.sum(np.multiply(videoCandidate[HaveNN_sum, 1, :], weights), axis=1)
-        video[HaveNN_sum, 2, indFrame] = \
-            np.sum(np.multiply(videoCandidate[HaveNN_sum, 2, :], weights), axis=1)
+    affected = corr.retraced.copy()
+    if args.Nonlocal:
+        KeySourceFrame = [0, nFrame // 2, nFrame - 1]
+        rows = np.where(np.invert(affected))[0]
+        pos = sub[rows]
+        for KeySourceFrameIdx in range(3):
+            flowF_neighbor = pos.astype(np.float32)
+            flowF_neighbor[:, 0] += videoNonLocalFlowF[pos[:, 0], pos[:, 1], 1, KeySourceFrameIdx, pos[:, 2]]
+            flowF_neighbor[:, 1] += videoNonLocalFlowF[pos[:, 0], pos[:, 1], 0, KeySourceFrameIdx, pos[:, 2]]
+            flow_neighbor_int = np.round(flowF_neighbor).astype(np.int32)
+
+            ValidPos = np.logical_and(
+                np.logical_and(flow_neighbor_int[:, 0] >= 0,
+                               flow_neighbor_int[:, 0] < imgH),
+                np.logical_and(flow_neighbor_int[:, 1] >= 0,
+                               flow_neighbor_int[:, 1] < imgW))
+            flow_neighbor_int[np.invert(ValidPos), :2] = 0
+
+            # The key source frame neighbor changed hole status
+            Changed = (corr.previous.lookup(flow_neighbor_int[:, 0],
+                                            flow_neighbor_int[:, 1],
+                                            KeySourceFrame[KeySourceFrameIdx]) >= 0) != \
+                      (holes.lookup(flow_neighbor_int[:, 0],
+                                    flow_neighbor_int[:, 1],
+                                    KeySourceFrame[KeySourceFrameIdx]) >= 0)
+            affected[rows[ValidPos & Changed]] = True
 
-        mask_tofill[np.logical_and(np.invert(HaveNN_sum), mask[:, :, indFrame]), indFrame] = True
+    for indFrame in range(nFrame):
+        holeRows = holes.rows(indFrame)
+        holeRows = holeRows[affected[holeRows]]
+        print("Frame {0:3d}: {1:8d} pixels re-propagated".format(indFrame, len(holeRows)))
+        if len(holeRows) == 0:
+            continue
+
+        # candidate: numPix(affected) x 3 x num_candidate
+        candidate = np.zeros((len(holeRows), 3, num_candidate), dtype=np.float32)
+        for NN_idx in range(2):
+            HaveNNInd = np.where(corr.haveNN[holeRows, NN_idx])[0]
+            for SourceFrame in np.unique(flowNN[holeRows[HaveNNInd], 2, NN_idx]).astype(np.int32):
+                TargetInd = HaveNNInd[flowNN[holeRows[HaveNNInd], 2, NN_idx] == SourceFrame]
+                candidate[TargetInd, :, NN_idx] = \
+                    interp(video[:, :, :, SourceFrame],
+                            flowNN[holeRows[TargetInd], 1, NN_idx],
+                            flowNN[holeRows[TargetInd], 0, NN_idx])
+
+        fuse_flowNN(args, video, mask, corr, indFrame, holeRows, candidate,
+                    videoNonLocalFlowF, videoNonLocalFlowB)
+
+
+def fuse_flowNN(args, video, mask, corr, indFrame, holeRows, candidate,
+                videoNonLocalFlowF, videoNonLocalFlowB):
+    """Fuses the candidates of the hole pixels holeRows (of one frame) into
+    video, weighted by their consistency, and records which ones are filled.
+    candidate: numPix(frame) x 3 x num_candidate, with the flow neighbors
+    """
+    holepixPos = corr.holes.sub[holeRows]
+    num_candidate = candidate.shape[2]
+    consistency_uv = corr.consistency_uv
+
+    # consistencyMap: numPix(frame) x num_candidate
+    consistencyMap = np.zeros((len(holeRows), num_candidate), dtype=np.float32)
+    consistencyMap[:, :2] = (consistency_uv[holeRows, :, 0] ** 2 + consistency_uv[holeRows, :, 1] ** 2) ** 0.5
+
+    HaveNN = np.zeros((len(holeRows), num_candidate), dtype=bool)
+    HaveNN[:, :2] = corr.haveNN[holeRows]
 
-    return video, mask_tofill, HaveFlowNN
+    if args.Nonlocal:
+        for k in range(3):
+            consistencyMap[:, 2 + k] = consistCheckAt(
+                videoNonLocalFlowB[:, :, :, k, indFrame],
+                videoNonLocalFlowF[:, :, :, k, indFrame],
+                holepixPos)[0]
+
+        HaveNN[:, 2:], imgNN = \
+            KeySourceFrame_flowNN(holepixPos,
+                                  indFrame,
+                                  mask,
+                                  videoNonLocalFlowB,
+                                  videoNonLocalFlowF,
+                                  [video],
+                                  args.consistencyThres)
+        candidate[:, :, 2:] = imgNN[0]
+
+    HaveNN_sum, fused = fuse_candidates(args, consistencyMap, HaveNN, candidate)
+
+    # Hole pixels with at least one candidate
+    fillPos = holepixPos[HaveNN_sum]
+    video[fillPos[:, 0], fillPos[:, 1], :, indFrame] = fused
+
+    corr.filled[holeRows] = HaveNN_sum
+
+
+def fuse_candidates(args, consistencyMap, HaveNN, candidate):
+    """Fuses the candidates of the hole pixels, weighted by their consistency,
+    in float32.
+    consistencyMap: numPix x num_candidate
+    HaveNN:         numPix x num_candidate
+    candidate:      numPix x C x num_candidate
+    Returns the pixels with at least one candidate and their fused values.
+    """
+    HaveNN_sum = HaveNN.any(axis=1)
+    HaveNN = HaveNN[HaveNN_sum]
+
+    # Exponential weighting of the candidates, zero without flow neighbor
+    weights = np.exp( - consistencyMap[HaveNN_sum] / np.float32(args.alpha)) * HaveNN
+    weights_sum = weights.sum(axis=1, keepdims=True)
+
+    # Fix the numerical issue. 0 / 0: when all the weights underflow, the
+    # candidates are averaged
+    fix = weights_sum[:, 0] == 0
+    weights[fix] = HaveNN[fix]
+    weights_sum[fix] = HaveNN[fix].sum(axis=1, keepdims=True)
+
+    fused = np.einsum('nck,nk->nc', candidate[HaveNN_sum], weights / weights_sum)
+
+    return HaveNN_sum, fused
+
+
+def unfilled_mask(args, corr):
+    """imgH x imgW x nFrame mask of the hole pixels of corr left unfilled.
+    """
+    sub = corr.holes.sub
+    mask_tofill = create_array(corr.shape, bool, args.scratch_dir)
+    unfilledPos = sub[np.invert(corr.filled)]
+    mask_tofill[unfilledPos[:, 0], unfilledPos[:, 1], unfilledPos[:, 2]] = True
+    return mask_tofill
@@ -0,0 +1,291 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import numpy as np
+import torch
+import torch.nn.functional as F
+from utils.common_utils import create_array, HoleIndex
+from get_flowNN import NN_UNREACHABLE, NN_REACHABLE, NN_NOT_HOLE, NN_INVALID
+
+
+def get_flowNN_torch(args,
+                     video,
+                     mask,
+                     videoFlowF,
+                     videoFlowB,
+                     videoNonLocalFlowF,
+                     videoNonLocalFlowB):
+    """Same as get_flowNN, on torch tensors (args.propagation_device).
+    """
+    (video, ), mask_tofill, HaveFlowNN = propagate(
+        args, [video], mask, videoFlowF, videoFlowB,
+        videoNonLocalFlowF, videoNonLocalFlowB, border=0)
+
+    return video, mask_tofill, HaveFlowNN
+
+
+def get_flowNN_gradient_torch(args,
+                              gradient_x,
+                              gradient_y,
+                              mask_RGB,
+                              mask,
+                              videoFlowF,
+                              videoFlowB,
+                              videoNonLocalFlowF,
+                              videoNonLocalFlowB):
+    """Same as get_flowNN_gradient, on torch tensors (args.propagation_device).
+    """
+    # The last row and column do not have a valid gradient.
+    (gradient_x, gradient_y), mask_tofill, _ = propagate(
+        args, [gradient_x, gradient_y], mask, videoFlowF, videoFlowB,
+        videoNonLocalFlowF, videoNonLocalFlowB, border=1)
+
+    return gradient_x, gradient_y, mask_tofill
+
+
+def propagation_device(args):
+    device = getattr(args, 'propagation_device', None)
+    if device is None:
+        device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+
+def sample(img, x, y):
+    """Bilinear lookup of img (nCh x imgH x imgW) at the points (x, y), with
+    zeros outside of the image like interp. Returns numPix x nCh.
+    """
+    _, imgH, imgW = img.shape
+    grid = torch.stack((2 * x / max(imgW - 1, 1) - 1,
+                        2 * y / max(imgH - 1, 1) - 1), dim=1)
+    out = F.grid_sample(img[None], grid[None, None], mode='bilinear',
+                        padding_mode='zeros', align_corners=True)
+    return out[0, :, 0, :].t()
+
+
+def consist_check(flowF, flowB):
+    """consistCheck on 2 x imgH x imgW flows. Returns 2 x imgH x imgW [u, v].
+    """
+    _, imgH, imgW = flowF.shape
+    fy, fx = torch.meshgrid(torch.arange(imgH, dtype=flowF.dtype, device=flowF.device),
+                            torch.arange(imgW, dtype=flowF.dtype, device=flowF.device),
+                            indexing='ij')
+    fxx = (fx + flowB[0]).reshape(-1)
+    fyy = (fy + flowB[1]).reshape(-1)
+    back = sample(flowF, fxx, fyy).t().reshape(2, imgH, imgW)
+    return torch.stack((fxx.reshape(imgH, imgW) + back[0] - fx,
+                        fyy.reshape(imgH, imgW) + back[1] - fy))
+
+
+def propagate(args, images, mask, videoFlowF, videoFlowB,
+              videoNonLocalFlowF, videoNonLocalFlowB, border):
+    """propagate_on args.propagation_device, with args.num_workers torch
+    threads on the CPU (the thread count of the caller is restored).
+    """
+    device = propagation_device(args)
+    numThreads = torch.get_num_threads()
+    if device.type == 'cpu':
+        torch.set_num_threads(max(getattr(args, 'num_workers', 1), 1))
+    try:
+        return propagate_on(device, args, images, mask, videoFlowF, videoFlowB,
+                            videoNonLocalFlowF, videoNonLocalFlowB, border)
+    finally:
+        torch.set_num_threads(numThreads)
+
+
+def propagate_on(device, args, images, mask, videoFlowF, videoFlowB,
+                 videoNonLocalFlowF, videoNonLocalFlowB, border):
+    """Flow-guided propagation and fusion of images (a list of imgH x imgW x
+    nCh x nFrame arrays sharing the flow neighbors), in place.
+
+    The images and the flows are held on the device as nFrame x nCh x imgH x
+    imgW tensors. The tracing of a frame is vectorised over its hole pixels,
+    in the order of HoleIndex, and the candidates are fused on the hole pixels
+    only. border is the number of last rows and columns a flow neighbor may not
+    fall on.
+    """
+    num_candidate = 5 if args.Nonlocal else 2
+    imgH, imgW, nFrame = mask.shape
+
+    def tensor(a, dims):
+        return torch.from_numpy(np.ascontiguousarray(np.asarray(a, dtype=np.float32).transpose(dims))).to(device)
+
+    # Flows: (nFrame - 1) x [u, v] x imgH x imgW
+    flowF = tensor(videoFlowF, (3, 2, 0, 1))
+    flowB = tensor(videoFlowB, (3, 2, 0, 1))
+    imgs = [tensor(img, (3, 2, 0, 1)) for img in images]
+    holeMask = torch.from_numpy(np.ascontiguousarray(np.asarray(mask, dtype=bool).transpose(2, 0, 1))).to(device)
+
+    holes = HoleIndex(mask, args.scratch_dir)
+    numPix = holes.numPix
+    sub = torch.from_numpy(holes.sub.astype(np.int64)).to(device)
+    offsets = holes.offsets
+    index = torch.from_numpy(np.asarray(holes.index)).to(device)
+
+    def lookup(y, x, t):
+        if holes.static:
+            idx = index[y, x].long()
+            return torch.where(idx >= 0, idx + int(offsets[t]), idx)
+        return index[y, x, t].long()
+
+    def inside(y, x):
+        return (y >= 0) & (y < imgH - border) & (x >= 0) & (x < imgW - border)
+
+    # flowNN: numPix x [y, x, t] x [BN, FN], haveNN: numPix x [BN, FN]
+    flowNN = torch.full((numPix, 3, 2), NN_INVALID, dtype=torch.float32, device=device)
+    haveNN = torch.zeros((numPix, 2), dtype=torch.bool, device=device)
+    consistency_uv = torch.zeros((numPix, 2, 2), dtype=torch.float32, device=device)
+
+    # 1. Forward Pass (backward flow propagation), 2. Backward Pass (forward
+    # flow propagation).
+    for NN_idx, frames, step in ((0, range(1, nFrame), -1), (1, range(nFrame - 2, -1, -1), 1)):
+        print('Forward Pass......' if NN_idx == 0 else 'Backward Pass......')
+        for indFrame in frames:
+            src = indFrame + step
+            flowInd = min(indFrame, src)
+            # Flow to the neighbor frame and back.
+            flowTo, flowBack = (flowB, flowF) if step < 0 else (flowF, flowB)
+            flowTo, flowBack = flowTo[flowInd], flowBack[flowInd]
+
+            rows = torch.arange(int(offsets[indFrame]), int(offsets[indFrame + 1]), device=device)
+            y, x = sub[rows, 0], sub[rows, 1]
+            yf, xf = y.float(), x.float()
+
+            neighbor_y = yf + flowTo[1, y, x]
+            neighbor_x = xf + flowTo[0, y, x]
+            neighbor_yi = torch.round(neighbor_y).long()
+            neighbor_xi = torch.round(neighbor_x).long()
+
+            # Flow consistency
+            back_y = neighbor_y + sample(flowBack[1:2], neighbor_x, neighbor_y)[:, 0]
+            back_x = neighbor_x + sample(flowBack[0:1], neighbor_x, neighbor_y)[:, 0]
+            IsConsist = ((back_y - yf) ** 2 + (back_x - xf) ** 2) ** 0.5 < args.consistencyThres
+            uv = consist_check(flowBack, flowTo).abs()
+
+            # Only work with pixels that are not out-of-boundary
+            keep = inside(neighbor_yi, neighbor_xi)
+            rows, y, x = rows[keep], y[keep], x[keep]
+            neighbor_y, neighbor_x = neighbor_y[keep], neighbor_x[keep]
+            neighbor_yi, neighbor_xi = neighbor_yi[keep], neighbor_xi[keep]
+            IsConsist = IsConsist[keep]
+            uv_hole = uv[:, y, x].t()
+
+            # Case 1: the flow neighbor is known.
+            KnownInd = ~holeMask[src, neighbor_yi, neighbor_xi]
+            Valid = KnownInd & IsConsist
+            flowNN[rows[Valid], 0, NN_idx] = neighbor_y[Valid]
+            flowNN[rows[Valid], 1, NN_idx] = neighbor_x[Valid]
+            flowNN[rows[Valid], 2, NN_idx] = src
+            haveNN[rows[Valid], NN_idx] = True
+            consistency_uv[rows[Valid], NN_idx] = uv_hole[Valid]
+
+            # Case 2: the flow neighbor is a hole pixel that has a flow
+            # neighbor, refined by the sub-pixel offset.
+            neighborRows = lookup(neighbor_yi, neighbor_xi, src)
+            neighborRows_ = neighborRows.clamp(min=0)
+            Valid_ = ~KnownInd & IsConsist & (neighborRows >= 0) & haveNN[neighborRows_, NN_idx]
+            flowNN_tmp = flowNN[neighborRows_, :, NN_idx].clone()
+            flowNN_tmp[:, 0] += neighbor_y - neighbor_yi
+            flowNN_tmp[:, 1] += neighbor_x - neighbor_xi
+            Valid = Valid_ & inside(torch.round(flowNN_tmp[:, 0]), torch.round(flowNN_tmp[:, 1]))
+
+            flowNN[rows[Valid], :, NN_idx] = flowNN_tmp[Valid]
+            haveNN[rows[Valid], NN_idx] = True
+            consistency_uv[rows[Valid], NN_idx] = torch.maximum(
+                uv_hole[Valid], consistency_uv[neighborRows_[Valid], NN_idx])
+
+            print("Frame {0:3d}: {1:8d} + {2:8d} = {3:8d}"
+            .format(indFrame,
+                    int(haveNN[int(offsets[indFrame]):int(offsets[indFrame + 1]), NN_idx].sum()),
+                    int((~haveNN[int(offsets[indFrame]):int(offsets[indFrame + 1]), NN_idx]).sum()),
+                    int(offsets[indFrame + 1] - offsets[indFrame])))
+
+    # Interpolation, frame-sequential like get_flowNN: the source frames
+    # are complete when they are read.
+    candidates = []
+    for NN_idx, frames in ((0, range(nFrame)), (1, range(nFrame - 1, -1, -1))):
+        buffers = [img.clone() for img in imgs]
+        for indFrame in frames:
+            rows = torch.arange(int(offsets[indFrame]), int(offsets[indFrame + 1]), device=device)
+            rows = rows[haveNN[rows, NN_idx]]
+            sourceFrames = flowNN[rows, 2, NN_idx].long()
+            for SourceFrame in torch.unique(sourceFrames).tolist():
+                TargetInd = rows[sourceFrames == SourceFrame]
+                print("{0:8d} pixels of Frame {1:3d} are from source Frame {2:3d}"
+                                .format(len(TargetInd), indFrame, SourceFrame))
+                y, x = sub[TargetInd, 0], sub[TargetInd, 1]
+                for buf in buffers:
+                    buf[indFrame][:, y, x] = sample(buf[SourceFrame],
+                                                    flowNN[TargetInd, 1, NN_idx],
+                                                    flowNN[TargetInd, 0, NN_idx]).t()
+        candidates.append(buffers)
+
+    # Fusion of the candidates at the hole pixels, frame by frame.
+    mask_tofill = create_array((imgH, imgW, nFrame), bool, args.scratch_dir)
+    KeySourceFrame = [0, nFrame // 2, nFrame - 1]
+
+    for indFrame in range(nFrame):
+        rows = torch.arange(int(offsets[indFrame]), int(offsets[indFrame + 1]), device=device)
+        y, x = sub[rows, 0], sub[rows, 1]
+        yf, xf = y.float(), x.float()
+
+        consistencyMap = torch.zeros((len(rows), num_candidate), dtype=torch.float32, device=device)
+        consistencyMap[:, :2] = (consistency_uv[rows] ** 2).sum(dim=2) ** 0.5
+        HaveNN = torch.zeros((len(rows), num_candidate), dtype=torch.bool, device=device)
+        HaveNN[:, :2] = haveNN[rows]
+
+        # numPix(frame) x nCh x num_candidate, per image
+        Candidate = [torch.zeros((len(rows), img.shape[1], num_candidate), device=device) for img in imgs]
+        for img, cand, BN, FN in zip(imgs, Candidate, candidates[0], candidates[1]):
+            cand[:, :, 0] = BN[indFrame][:, y, x].t()
+            cand[:, :, 1] = FN[indFrame][:, y, x].t()
+
+        if args.Nonlocal:
+            for k in range(3):
+                flowNLF = tensor(videoNonLocalFlowF[:, :, :, k, indFrame], (2, 0, 1))
+                flowNLB = tensor(videoNonLocalFlowB[:, :, :, k, indFrame], (2, 0, 1))
+                uv = consist_check(flowNLB, flowNLF)
+                consistencyMap[:, 2 + k] = ((uv[:, y, x] ** 2).sum(dim=0)) ** 0.5
+
+                # Flow neighbor in the key source frame
+                neighbor_y = yf + flowNLF[1, y, x]
+                neighbor_x = xf + flowNLF[0, y, x]
+                neighbor_yi = torch.round(neighbor_y).long()
+                neighbor_xi = torch.round(neighbor_x).long()
+                back_y = neighbor_y + sample(flowNLB[1:2], neighbor_x, neighbor_y)[:, 0]
+                back_x = neighbor_x + sample(flowNLB[0:1], neighbor_x, neighbor_y)[:, 0]
+                IsConsist = ((back_y - yf) ** 2 + (back_x - xf) ** 2) ** 0.5 < args.consistencyThres
+
+                keep = inside(neighbor_yi, neighbor_xi) & IsConsist
+                keep[keep.clone()] = ~holeMask[KeySourceFrame[k], neighbor_yi[keep], neighbor_xi[keep]]
+                HaveNN[:, 2 + k] = keep
+                for img, cand in zip(imgs, Candidate):
+                    cand[:, :, 2 + k] = img[indFrame][:, y, x].t()
+                    cand[keep, :, 2 + k] = sample(img[KeySourceFrame[k]], neighbor_x[keep], neighbor_y[keep])
+
+        HaveNN_sum = HaveNN.any(dim=1)
+
+        # Exponential weighting of the candidates, zero without flow neighbor
+        consistencyMap = torch.exp( - consistencyMap / args.alpha) * HaveNN
+        weights = consistencyMap[HaveNN_sum] / consistencyMap[HaveNN_sum].sum(dim=1, keepdim=True)
+
+        # Fix the numerical issue. 0 / 0
+        fix = consistencyMap[HaveNN_sum].sum(dim=1) == 0
+        weights[fix] = HaveNN[HaveNN_sum][fix] / HaveNN[HaveNN_sum][fix].sum(dim=1, keepdim=True)
+
+        fill_y, fill_x = y[HaveNN_sum], x[HaveNN_sum]
+        for img, cand, out in zip(imgs, Candidate, images):
+            fused = (cand[HaveNN_sum] * weights[:, None, :]).sum(dim=2)
+            img[indFrame][:, fill_y, fill_x] = fused.t()
+            out[fill_y.cpu().numpy(), fill_x.cpu().numpy(), :, indFrame] = fused.cpu().numpy()
+
+        unfilled = ~HaveNN_sum
+        mask_tofill[y[unfilled].cpu().numpy(), x[unfilled].cpu().numpy(), indFrame] = True
+
+    # HaveFlowNN state codes, as returned by get_flowNN
+    HaveFlowNN = create_array((imgH, imgW, nFrame, 2), np.int8, args.scratch_dir, fill=NN_NOT_HOLE)
+    HaveFlowNN[mask, :] = NN_UNREACHABLE
+    sub_np = holes.sub
+    haveNN = haveNN.cpu().numpy()
+    for NN_idx in range(2):
+        reached = sub_np[haveNN[:, NN_idx]]
+        HaveFlowNN[reached[:, 0], reached[:, 1], reached[:, 2], NN_idx] = NN_REACHABLE
+
+    return images, mask_tofill, HaveFlowNN
@@ -5,12 +5,57 @@ import numpy as np
 import torch
 
 
-def spatial_inpaint(deepfill, mask, video_comp):
+def spatial_inpaint(deepfill, mask, video_comp, corr=None, max_keyframes=1, selection='area'):
 
-    keyFrameInd = np.argmax(np.sum(np.sum(mask, axis=0), axis=0))
+    keyFrameInds = select_keyframes(mask, corr, max_keyframes, selection)
     with torch.no_grad():
-        img_res = deepfill.forward(video_comp[:, :, :, keyFrameInd] * 255., mask[:, :, keyFrameInd]) / 255.
-    video_comp[mask[:, :, keyFrameInd], :, keyFrameInd] = img_res[mask[:, :, keyFrameInd], :]
-    mask[:, :, keyFrameInd] = False
+        img_res = deepfill.forward_batch([video_comp[:, :, :, keyFrameInd] * 255. for keyFrameInd in keyFrameInds],
+                                         [mask[:, :, keyFrameInd] for keyFrameInd in keyFrameInds])
+    for keyFrameInd, img in zip(keyFrameInds, img_res):
+        img = img / 255.
+        video_comp[mask[:, :, keyFrameInd], :, keyFrameInd] = img[mask[:, :, keyFrameInd], :]
+        mask[:, :, keyFrameInd] = False
 
     return mask, video_comp
+
+
+def select_keyframes(mask, corr=None, max_keyframes=1, selection='area'):
+    """Frames to inpaint, by decreasing hole area ('area') or by decreasing
+    reach ('coverage'), i.e. the number of unfilled pixels of the whole video
+    they would give a flow neighbor, given the FlowCorrespondence of the last
+    propagation. Up to max_keyframes frames whose propagated coverage does
+    not overlap, so that no region is completed from two inpainted frames.
+    """
+    imgH, imgW, nFrame = mask.shape
+    holeArea = np.sum(np.sum(mask, axis=0), axis=0)
+    keyFrameInd = np.argmax(holeArea)
+    if corr is None or (max_keyframes <= 1 and selection == 'area'):
+        return [keyFrameInd]
+
+    # The unfilled pixels that each frame would give a flow neighbor are the
+    # ones whose chains of hole flow neighbors reach it.
+    first, last = corr.chainExtent()
+    unfilled = np.invert(corr.filled)
+    first, last = first[unfilled], last[unfilled]
+
+    if selection == 'coverage':
+        reach = np.cumsum(np.bincount(first, minlength=nFrame + 1) -
+                          np.bincount(last + 1, minlength=nFrame + 1))[:nFrame]
+        order = np.lexsort((-holeArea, -reach))
+    else:
+        order = np.argsort(-holeArea, kind='stable')
+
+    keyFrameInds = []
+    covered = np.zeros(len(first), dtype=bool)
+    for indFrame in order:
+        if len(keyFrameInds) == max_keyframes:
+            break
+        if holeArea[indFrame] == 0:
+            continue
+        coverage = np.logical_and(first <= indFrame, indFrame <= last)
+        if not coverage.any() or np.logical_and(coverage, covered).any():
+            continue
+        keyFrameInds.append(indFrame)
+        covered |= coverage
+
+    return keyFrameInds if len(keyFrameInds) > 0 else [keyFrameInd]
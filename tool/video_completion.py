@@ -7,6 +7,9 @@ import os
 import cv2
 import glob
 import copy
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import numpy as np
 import torch
 import imutils
@@ -20,14 +23,16 @@ from RAFT import utils
 from RAFT import RAFT
 
 import utils.region_fill as rf
-from utils.Poisson_blend import Poisson_blend
+from utils.region_fill_torch import regionfill_batch
+from utils.Poisson_blend import Poisson_blend, holeIndices
 from utils.Poisson_blend_img import Poisson_blend_img
-from get_flowNN import get_flowNN
+from get_flowNN import get_flowNN, FlowCorrespondence
 from get_flowNN_gradient import get_flowNN_gradient
-from utils.common_utils import flow_edge
+from get_flowNN_torch import get_flowNN_torch, get_flowNN_gradient_torch
+from utils.common_utils import flow_edge, fast_canny, edge_mismatch, create_array, static_mask, is_static_mask, MemoryStages
 from spatial_inpaint import spatial_inpaint
 from frame_inpaint import DeepFillv1
-from edgeconnect.networks import EdgeGenerator_
+from edgeconnect.networks import EdgeGenerator_, InpaintGenerator
 
 
 def detectAndDescribe(image):
@@ -130,11 +135,12 @@ def to_tensor(img):
 
 
 def infer(args, EdgeGenerator, device, flow_img_gray, edge, mask):
-
-    # Add a pytorch dataloader
-    flow_img_gray_tensor = to_tensor(flow_img_gray)[None, :, :].float().to(device)
-    edge_tensor = to_tensor(edge)[None, :, :].float().to(device)
-    mask_tensor = torch.from_numpy(mask.astype(np.float64))[None, None, :, :].float().to(device)
+    """Completes the flow edges of a batch of frames.
+    flow_img_gray, edge, mask: N x imgH x imgW
+    """
+    flow_img_gray_tensor = torch.from_numpy(np.asarray(flow_img_gray, dtype=np.float32))[:, None].to(device)
+    edge_tensor = torch.from_numpy(np.asarray(edge, dtype=np.float32))[:, None].to(device)
+    mask_tensor = torch.from_numpy(np.asarray(mask, dtype=np.float32))[:, None].to(device)
 
     # Complete the edges
     edges_masked = (edge_tensor * (1 - mask_tensor))
@@ -143,7 +149,7 @@ def infer(args, EdgeGenerator, device, flow_img_gray, edge, mask):
     with torch.no_grad():
         edges_completed = EdgeGenerator(inputs) # in: [grayscale(1) + edge(1) + mask(1)]
     edges_completed = edges_completed * mask_tensor + edge_tensor * (1 - mask_tensor)
-    edge_completed = edges_completed[0, 0].data.cpu().numpy()
+    edge_completed = edges_completed[:, 0].data.cpu().numpy()
     edge_completed[edge_completed < 0.5] = 0
     edge_completed[edge_completed >= 0.5] = 1
 
@@ -166,6 +172,32 @@ def create_dir(dir):
         os.makedirs(dir)
 
 
+def load_mask(filename):
+    """Loads a mask image.
+    """
+    return np.array(Image.open(filename).convert('L'))
+
+
+def is_static(filename_list):
+    """Checks whether all the mask images are the same.
+    """
+    mask_img = load_mask(filename_list[0])
+    for filename in filename_list[1:]:
+        if not np.array_equal(load_mask(filename), mask_img):
+            return False
+    return True
+
+
+def get_flow_mask(mask_img):
+    """Computes the flow mask from the mask of a frame.
+    """
+    # Dilate 15 pixel so that all known pixel is trustworthy
+    flow_mask_img = scipy.ndimage.binary_dilation(mask_img, iterations=15)
+    # Close the small holes inside the foreground objects
+    flow_mask_img = cv2.morphologyEx(flow_mask_img.astype(np.uint8), cv2.MORPH_CLOSE, np.ones((21, 21),np.uint8)).astype(bool)
+    return scipy.ndimage.binary_fill_holes(flow_mask_img).astype(bool)
+
+
 def initialize_RAFT(args):
     """Initializes the RAFT model.
     """
@@ -213,16 +245,10 @@ def calculate_flow(args, model, video):
     """Calculates optical flow.
     """
     nFrame, _, imgH, imgW = video.shape
-    FlowF = np.empty(((imgH, imgW, 2, 0)), dtype=np.float32)
-    FlowB = np.empty(((imgH, imgW, 2, 0)), dtype=np.float32)
-    FlowNLF = np.empty(((imgH, imgW, 2, 3, 0)), dtype=np.float32)
-    FlowNLB = np.empty(((imgH, imgW, 2, 3, 0)), dtype=np.float32)
-    # FlowNLF0 = np.empty(((imgH, imgW, 2, 0)), dtype=np.float32)
-    # FlowNLF1 = np.empty(((imgH, imgW, 2, 0)), dtype=np.float32)
-    # FlowNLF2 = np.empty(((imgH, imgW, 2, 0)), dtype=np.float32)
-    # FlowNLB0 = np.empty(((imgH, imgW, 2, 0)), dtype=np.float32)
-    # FlowNLB1 = np.empty(((imgH, imgW, 2, 0)), dtype=np.float32)
-    # FlowNLB2 = np.empty(((imgH, imgW, 2, 0)), dtype=np.float32)
+    FlowF = create_array((imgH, imgW, 2, nFrame - 1), np.float32, args.scratch_dir)
+    FlowB = create_array((imgH, imgW, 2, nFrame - 1), np.float32, args.scratch_dir)
+    FlowNLF = create_array((imgH, imgW, 2, 3, nFrame if args.Nonlocal else 0), np.float32, args.scratch_dir)
+    FlowNLB = create_array((imgH, imgW, 2, 3, nFrame if args.Nonlocal else 0), np.float32, args.scratch_dir)
 
     if args.Nonlocal:
         mode_list = ['forward', 'backward', 'nonlocal_forward', 'nonlocal_backward']
@@ -242,8 +268,7 @@ def calculate_flow(args, model, video):
                     print("Calculating {0} flow {1:2d} <---> {2:2d}".format(mode, i, i + 1), '\r', end='')
                     image1 = video[i, None]
                     image2 = video[i + 1, None]
-                    flow = infer_flow(args, mode, '%05d'%i, image1, image2, imgH, imgW, model, homography=False)
-                    FlowF = np.concatenate((FlowF, flow[..., None]), axis=-1)
+                    FlowF[..., i] = infer_flow(args, mode, '%05d'%i, image1, image2, imgH, imgW, model, homography=False)
                 elif mode == 'backward':
                     if i == nFrame - 1:
                         continue
@@ -251,53 +276,60 @@ def calculate_flow(args, model, video):
                     print("Calculating {0} flow {1:2d} <---> {2:2d}".format(mode, i, i + 1), '\r', end='')
                     image1 = video[i + 1, None]
                     image2 = video[i, None]
-                    flow = infer_flow(args, mode, '%05d'%i, image1, image2, imgH, imgW, model, homography=False)
-                    FlowB = np.concatenate((FlowB, flow[..., None]), axis=-1)
+                    FlowB[..., i] = infer_flow(args, mode, '%05d'%i, image1, image2, imgH, imgW, model, homography=False)
                 elif mode == 'nonlocal_forward':
                     # Flow i -> 0
                     print("Calculating {0} flow {1:2d} <---> {2:2d}".format(mode, i, 0), '\r', end='')
                     image1 = video[i, None]
                     image2 = video[0, None]
-                    FlowNLF0 = infer_flow(args, mode, '%05d_00000'%i, image1, image2, imgH, imgW, model, homography=False)
+                    FlowNLF[..., 0, i] = infer_flow(args, mode, '%05d_00000'%i, image1, image2, imgH, imgW, model, homography=False)
 
                     # Flow i -> nFrame // 2
                     print("Calculating {0} flow {1:2d} <---> {2:2d}".format(mode, i, nFrame // 2), '\r', end='')
                     image1 = video[i, None]
                     image2 = video[nFrame // 2, None]
-                    FlowNLF1 = infer_flow(args, mode, '%05d_00001'%i, image1, image2, imgH, imgW, model, homography=False)
+                    FlowNLF[..., 1, i] = infer_flow(args, mode, '%05d_00001'%i, image1, image2, imgH, imgW, model, homography=False)
 
                     # # Flow i -> nFrame - 1
                     print("Calculating {0} flow {1:2d} <---> {2:2d}".format(mode, i, nFrame - 1), '\r', end='')
                     image1 = video[i, None]
                     image2 = video[nFrame - 1, None]
-                    FlowNLF2 = infer_flow(args, mode, '%05d_00002'%i, image1, image2, imgH, imgW, model, homography=False)
-
-                    FlowNLF = np.concatenate((FlowNLF, np.stack((FlowNLF0, FlowNLF1, FlowNLF2), -1)[..., None]), axis=-1)
+                    FlowNLF[..., 2, i] = infer_flow(args, mode, '%05d_00002'%i, image1, image2, imgH, imgW, model, homography=False)
 
                 elif mode == 'nonlocal_backward':
                     # Flow 0 -> i
                     print("Calculating {0} flow {1:2d} <---> {2:2d}".format(mode, 0, i), '\r', end='')
                     image1 = video[0, None]
                     image2 = video[i, None]
-                    FlowNLB0 = infer_flow(args, mode, '%05d_00000'%i, image1, image2, imgH, imgW, model, homography=False)
+                    FlowNLB[..., 0, i] = infer_flow(args, mode, '%05d_00000'%i, image1, image2, imgH, imgW, model, homography=False)
 
                     # Flow nFrame // 2 -> i
                     print("Calculating {0} flow {1:2d} <---> {2:2d}".format(mode, nFrame // 2, i), '\r', end='')
                     image1 = video[nFrame // 2, None]
                     image2 = video[i, None]
-                    FlowNLB1 = infer_flow(args, mode, '%05d_00001'%i, image1, image2, imgH, imgW, model, homography=False)
+                    FlowNLB[..., 1, i] = infer_flow(args, mode, '%05d_00001'%i, image1, image2, imgH, imgW, model, homography=False)
 
                     # # Flow nFrame - 1 -> i
                     print("Calculating {0} flow {1:2d} <---> {2:2d}".format(mode, nFrame - 1, i), '\r', end='')
                     image1 = video[nFrame - 1, None]
                     image2 = video[i, None]
-                    FlowNLB2 = infer_flow(args, mode, '%05d_00002'%i, image1, image2, imgH, imgW, model, homography=False)
-
-                    FlowNLB = np.concatenate((FlowNLB, np.stack((FlowNLB0, FlowNLB1, FlowNLB2), -1)[..., None]), axis=-1)
+                    FlowNLB[..., 2, i] = infer_flow(args, mode, '%05d_00002'%i, image1, image2, imgH, imgW, model, homography=False)
 
     return FlowF, FlowB, FlowNLF, FlowNLB
 
 
+def video_to_numpy(args, video):
+    """Converts the nFrame x 3 x imgH x imgW RGB tensor into an
+    imgH x imgW x 3 x nFrame BGR (opencv) array in [0, 1], frame by frame.
+    """
+    nFrame, _, imgH, imgW = video.shape
+    video_np = create_array((imgH, imgW, 3, nFrame), np.float32, args.scratch_dir)
+    for i in range(nFrame):
+        video_np[:, :, :, i] = video[i].permute(1, 2, 0).cpu().numpy()[:, :, ::-1] / 255.
+
+    return video_np
+
+
 def extrapolation(args, video_ori, corrFlowF_ori, corrFlowB_ori, corrFlowNLF_ori, corrFlowNLB_ori):
     """Prepares the data for video extrapolation.
     """
@@ -316,26 +348,28 @@ def extrapolation(args, video_ori, corrFlowF_ori, corrFlowB_ori, corrFlowNLF_ori
     mask_dilated = gradient_mask(flow_mask)
 
     # Extrapolates the FOV for video.
-    video = np.zeros(((imgH_extr, imgW_extr, 3, nFrame)), dtype=np.float32)
-    video[H_start : H_start + imgH, W_start : W_start + imgW, :, :] = video_ori
+    video = create_array((imgH_extr, imgW_extr, 3, nFrame), np.float32, args.scratch_dir)
 
     for i in range(nFrame):
         print("Preparing frame {0}".format(i), '\r', end='')
+        video[H_start : H_start + imgH, W_start : W_start + imgW, :, i] = video_ori[:, :, :, i]
         video[:, :, :, i] = cv2.inpaint((video[:, :, :, i] * 255).astype(np.uint8), flow_mask.astype(np.uint8), 3, cv2.INPAINT_TELEA).astype(np.float32)  / 255.
 
     # Extrapolates the FOV for flow.
-    corrFlowF = np.zeros(((imgH_extr, imgW_extr, 2, nFrame - 1)), dtype=np.float32)
-    corrFlowB = np.zeros(((imgH_extr, imgW_extr, 2, nFrame - 1)), dtype=np.float32)
+    corrFlowF = create_array((imgH_extr, imgW_extr, 2, nFrame - 1), np.float32, args.scratch_dir)
+    corrFlowB = create_array((imgH_extr, imgW_extr, 2, nFrame - 1), np.float32, args.scratch_dir)
 
-    corrFlowF[H_start : H_start + imgH, W_start : W_start + imgW] = corrFlowF_ori
-    corrFlowB[H_start : H_start + imgH, W_start : W_start + imgW] = corrFlowB_ori
+    for i in range(nFrame - 1):
+        corrFlowF[H_start : H_start + imgH, W_start : W_start + imgW, :, i] = corrFlowF_ori[..., i]
+        corrFlowB[H_start : H_start + imgH, W_start : W_start + imgW, :, i] = corrFlowB_ori[..., i]
 
     if args.Nonlocal:
-        corrFlowNLF = np.zeros(((imgH_extr, imgW_extr, 2, 3, nFrame)), dtype=np.float32)
-        corrFlowNLB = np.zeros(((imgH_extr, imgW_extr, 2, 3, nFrame)), dtype=np.float32)
+        corrFlowNLF = create_array((imgH_extr, imgW_extr, 2, 3, nFrame), np.float32, args.scratch_dir)
+        corrFlowNLB = create_array((imgH_extr, imgW_extr, 2, 3, nFrame), np.float32, args.scratch_dir)
 
-        corrFlowNLF[H_start : H_start + imgH, W_start : W_start + imgW] = corrFlowNLF_ori
-        corrFlowNLB[H_start : H_start + imgH, W_start : W_start + imgW] = corrFlowNLB_ori
+        for i in range(nFrame):
+            corrFlowNLF[H_start : H_start + imgH, W_start : W_start + imgW, :, :, i] = corrFlowNLF_ori[..., i]
+            corrFlowNLB[H_start : H_start + imgH, W_start : W_start + imgW, :, :, i] = corrFlowNLB_ori[..., i]
     else:
         corrFlowNLF = None
         corrFlowNLB = None
@@ -343,7 +377,98 @@ def extrapolation(args, video_ori, corrFlowF_ori, corrFlowB_ori, corrFlowNLF_ori
     return video, corrFlowF, corrFlowB, corrFlowNLF, corrFlowNLB, flow_mask, mask_dilated, (W_start, H_start), (W_start + imgW, H_start + imgH)
 
 
-def complete_flow(args, corrFlow, flow_mask, mode, edge=None):
+def compute_roi(args, flow_mask, corrFlowF, corrFlowB, corrFlowNLF=None, corrFlowNLB=None):
+    """Computes the spatio-temporal region of interest (y0, y1, x0, x1, t0, t1).
+
+    The region is the union bounding box of the dilated masks, enlarged by the
+    maximum flow magnitude around the holes (the non-local flows included with
+    --Nonlocal, plus args.roi_margin) so that the flow neighbors of the hole
+    pixels stay inside the crop. Its size is rounded
+    up to a multiple of 8 for the networks. Temporally, only the frames with
+    holes and their two direct neighbors are kept (the key frames of the
+    non-local flow are fixed, so all frames are kept with --Nonlocal).
+    """
+    imgH, imgW, nFrame = flow_mask.shape
+
+    HoleRow = np.zeros(imgH, dtype=bool)
+    HoleCol = np.zeros(imgW, dtype=bool)
+    HoleFrame = np.zeros(nFrame, dtype=bool)
+    for indFrame in range(nFrame):
+        HoleRow |= flow_mask[:, :, indFrame].any(axis=1)
+        HoleCol |= flow_mask[:, :, indFrame].any(axis=0)
+        HoleFrame[indFrame] = flow_mask[:, :, indFrame].any()
+
+    if not HoleFrame.any():
+        return 0, imgH, 0, imgW, 0, nFrame
+
+    y0, y1 = np.where(HoleRow)[0][0], np.where(HoleRow)[0][-1] + 1
+    x0, x1 = np.where(HoleCol)[0][0], np.where(HoleCol)[0][-1] + 1
+
+    if args.Nonlocal:
+        t0, t1 = 0, nFrame
+    else:
+        t0 = max(np.where(HoleFrame)[0][0] - 1, 0)
+        t1 = min(np.where(HoleFrame)[0][-1] + 2, nFrame)
+
+    # Maximum flow magnitude around the holes.
+    maxFlow = 0
+    for indFrame in range(t0, t1 - 1):
+        for flow in (corrFlowF[y0:y1, x0:x1, :, indFrame], corrFlowB[y0:y1, x0:x1, :, indFrame]):
+            maxFlow = max(maxFlow, np.sqrt((flow ** 2).sum(axis=2)).max())
+    if args.Nonlocal:
+        # Flows to the key frames: imgH x imgW x 2 x 3.
+        for indFrame in range(t0, t1):
+            for flow in (corrFlowNLF[y0:y1, x0:x1, :, :, indFrame], corrFlowNLB[y0:y1, x0:x1, :, :, indFrame]):
+                maxFlow = max(maxFlow, np.sqrt((flow ** 2).sum(axis=2)).max())
+    margin = int(np.ceil(maxFlow)) + args.roi_margin
+
+    def expand(start, end, size):
+        start, end = max(start - margin, 0), min(end + margin, size)
+        length = min(int(np.ceil((end - start) / 8.0)) * 8, size)
+        end = min(start + length, size)
+        return end - length, end
+
+    y0, y1 = expand(y0, y1, imgH)
+    x0, x1 = expand(x0, x1, imgW)
+
+    print('Region of interest: [{0:d}:{1:d}, {2:d}:{3:d}], frame {4:d} - {5:d}'
+          .format(y0, y1, x0, x1, t0, t1 - 1))
+
+    return y0, y1, x0, x1, t0, t1
+
+
+def crop_roi(args, arr, roi, flow=False):
+    """Crops a video sized array (frames along the last axis) to the region of
+    interest. Flows have one frame less than the video.
+    """
+    y0, y1, x0, x1, t0, t1 = roi
+    if is_static_mask(arr):
+        return static_mask(arr[y0:y1, x0:x1, 0], t1 - t0)
+    if flow:
+        t1 -= 1
+    roi_arr = create_array((y1 - y0, x1 - x0) + arr.shape[2:-1] + (t1 - t0, ), arr.dtype, args.scratch_dir)
+    for indFrame in range(t0, t1):
+        roi_arr[..., indFrame - t0] = arr[y0:y1, x0:x1, ..., indFrame]
+
+    return roi_arr
+
+
+def paste_roi(video, video_comp, roi, indFrame):
+    """Returns frame indFrame of the video with the completed region of interest
+    pasted in.
+    """
+    if roi is None:
+        return video_comp[:, :, :, indFrame]
+
+    y0, y1, x0, x1, t0, t1 = roi
+    img = np.array(video[:, :, :, indFrame])
+    if t0 <= indFrame < t1:
+        img[y0:y1, x0:x1] = video_comp[:, :, :, indFrame - t0]
+
+    return img
+
+
+def complete_flow(args, corrFlow, flow_mask, mode, edge=None, FlowGenerator=None):
     """Completes flow.
     """
     if mode not in ['forward', 'backward', 'nonlocal_forward', 'nonlocal_backward']:
@@ -357,17 +482,30 @@ def complete_flow(args, corrFlow, flow_mask, mode, edge=None):
     create_dir(os.path.join(args.outroot, 'flow_comp', mode + '_flo'))
     create_dir(os.path.join(args.outroot, 'flow_comp', mode + '_png'))
 
-    compFlow = np.zeros(((sh)), dtype=np.float32)
+    compFlow = create_array(sh, np.float32, args.scratch_dir)
+
+    if edge is None and args.flow_completion == 'torch':
+        complete_flow_batch(args, corrFlow, flow_mask, mode, compFlow)
+        return compFlow
+
+    if FlowGenerator is not None and (mode == 'forward' or mode == 'backward'):
+        complete_flow_learned(args, FlowGenerator, corrFlow, flow_mask, mode, edge, compFlow)
+        return compFlow
+
+    # Everything derived from a static mask is computed once for all frames.
+    static = is_static_mask(flow_mask)
 
     for i in range(nFrame):
         print("Completing {0} flow {1:2d} <---> {2:2d}".format(mode, i, i + 1), '\r', end='')
         flow = corrFlow[..., i]
-        if mode == 'forward':
-            flow_mask_img = flow_mask[:, :, i]
-            flow_mask_gradient_img = gradient_mask(flow_mask_img)
-        elif mode == 'backward':
-            flow_mask_img = flow_mask[:, :, i + 1]
-            flow_mask_gradient_img = gradient_mask(flow_mask_img)
+        if mode == 'forward' or mode == 'backward':
+            flow_mask_img = flow_mask[:, :, i] if mode == 'forward' else flow_mask[:, :, i + 1]
+            if i == 0 or not static:
+                flow_mask_gradient_img = gradient_mask(flow_mask_img)
+                if edge is not None:
+                    holeIdx = holeIndices(flow_mask_img)
+                else:
+                    filler = rf.RegionFill(flow_mask_img, solver=args.flow_solver, tol=args.flow_solver_tol)
         else: # nonlocal_backward
             assert edge == None
 
@@ -389,27 +527,26 @@ def complete_flow(args, corrFlow, flow_mask, mode, edge=None):
             imgSrc_gy = imgSrc_gy[0 : imgH - 1, :, :]
             imgSrc_gx = gradient[:, :, 0 : 2]
             imgSrc_gx = imgSrc_gx[:, 0 : imgW - 1, :]
-            compFlow[:, :, :, i] = Poisson_blend(flow, imgSrc_gx, imgSrc_gy, flow_mask_img, edge[:, :, i])
+            compFlow[:, :, :, i] = Poisson_blend(flow, imgSrc_gx, imgSrc_gy, flow_mask_img, edge[:, :, i], holeIdx)
 
         else:
+            # All the channels sharing a mask are filled in one solve. The
+            # previous completed flow is the initial guess of the iterative solver.
+            x0 = compFlow[..., i - 1] if i > 0 else None
             if mode == 'forward' or mode == 'backward':
-                flow[:, :, 0] = rf.regionfill(flow[:, :, 0], flow_mask_img)
-                flow[:, :, 1] = rf.regionfill(flow[:, :, 1], flow_mask_img)
-                compFlow[:, :, :, i] = flow
+                compFlow[:, :, :, i] = filler.fill(flow, x0)
             elif mode == 'nonlocal_forward':
-                flow[:, :, 0, 0] = rf.regionfill(flow[:, :, 0, 0], flow_mask[:, :, i])
-                flow[:, :, 1, 0] = rf.regionfill(flow[:, :, 1, 0], flow_mask[:, :, i])
-                flow[:, :, 0, 1] = rf.regionfill(flow[:, :, 0, 1], flow_mask[:, :, i])
-                flow[:, :, 1, 1] = rf.regionfill(flow[:, :, 1, 1], flow_mask[:, :, i])
-                flow[:, :, 0, 2] = rf.regionfill(flow[:, :, 0, 2], flow_mask[:, :, i])
-                flow[:, :, 1, 2] = rf.regionfill(flow[:, :, 1, 2], flow_mask[:, :, i])
+                if i == 0 or not static:
+                    filler = rf.RegionFill(flow_mask[:, :, i], solver=args.flow_solver, tol=args.flow_solver_tol)
+                compFlow[:, :, :, :, i] = filler.fill(flow.reshape(imgH, imgW, 6),
+                                                      None if x0 is None else x0.reshape(imgH, imgW, 6)).reshape(imgH, imgW, 2, 3)
             else:
-                flow[:, :, 0, 0] = rf.regionfill(flow[:, :, 0, 0], flow_mask[:, :, 0])
-                flow[:, :, 1, 0] = rf.regionfill(flow[:, :, 1, 0], flow_mask[:, :, 0])
-                flow[:, :, 0, 1] = rf.regionfill(flow[:, :, 0, 1], flow_mask[:, :, nFrame // 2])
-                flow[:, :, 1, 1] = rf.regionfill(flow[:, :, 1, 1], flow_mask[:, :, nFrame // 2])
-                flow[:, :, 0, 2] = rf.regionfill(flow[:, :, 0, 2], flow_mask[:, :, nFrame - 1])
-                flow[:, :, 1, 2] = rf.regionfill(flow[:, :, 1, 2], flow_mask[:, :, nFrame - 1])
+                # The key frames (and their masks) are the same for every frame.
+                if i == 0:
+                    fillers = [rf.RegionFill(flow_mask[:, :, indFrame], solver=args.flow_solver, tol=args.flow_solver_tol)
+                               for indFrame in (0, nFrame // 2, nFrame - 1)]
+                for k in range(3):
+                    compFlow[:, :, :, k, i] = fillers[k].fill(flow[:, :, :, k], None if x0 is None else x0[:, :, :, k])
         # # Flow visualization.
         # flow_img = utils.flow_viz.flow_to_image(compFlow[:, :, :, i])
         # flow_img = Image.fromarray(flow_img)
@@ -421,32 +558,243 @@ def complete_flow(args, corrFlow, flow_mask, mode, edge=None):
     return compFlow
 
 
-def edge_completion(args, EdgeGenerator, corrFlow, flow_mask, mode):
-    """Calculate flow edge and complete it.
+def complete_flow_batch(args, corrFlow, flow_mask, mode, compFlow):
+    """Completes the flows of args.flow_batch_size frames at once (all
+    channels) with the batched torch Laplace solver.
     """
+    imgH, imgW = corrFlow.shape[:2]
+    nFrame = corrFlow.shape[-1]
+    # Masks of the key frames of the non-local backward flows.
+    indKeys = (0, nFrame // 2, nFrame - 1)
+
+    for start in range(0, nFrame, args.flow_batch_size):
+        indFrames = range(start, min(start + args.flow_batch_size, nFrame))
+        print("Completing {0} flow {1:2d} - {2:2d}".format(mode, indFrames[0], indFrames[-1]), '\r', end='')
+
+        if mode == 'forward' or mode == 'backward':
+            offset = 0 if mode == 'forward' else 1
+            flows = np.stack([corrFlow[..., i] for i in indFrames])
+            masks = np.stack([flow_mask[:, :, i + offset] for i in indFrames])
+        elif mode == 'nonlocal_forward':
+            flows = np.stack([corrFlow[..., i].reshape(imgH, imgW, 6) for i in indFrames])
+            masks = np.stack([flow_mask[:, :, i] for i in indFrames])
+        else:
+            flows = np.stack([corrFlow[:, :, :, k, i] for i in indFrames for k in range(3)])
+            masks = np.stack([flow_mask[:, :, indKey] for i in indFrames for indKey in indKeys])
 
-    if mode not in ['forward', 'backward']:
-        raise NotImplementedError
+        flows = regionfill_batch(flows, masks, tol=args.flow_solver_tol)
 
+        for b, i in enumerate(indFrames):
+            if mode == 'forward' or mode == 'backward':
+                compFlow[..., i] = flows[b]
+            elif mode == 'nonlocal_forward':
+                compFlow[..., i] = flows[b].reshape(imgH, imgW, 2, 3)
+            else:
+                for k in range(3):
+                    compFlow[:, :, :, k, i] = flows[3 * b + k]
+
+
+def load_flow_generator(args):
+    """Loads the EdgeConnect flow inpainting generator.
+    With --flow_completion_fill, it refines regionfill-prefilled flows.
+    """
+    config = argparse.Namespace(FLO=1, NORM=1, PASSMASK=1,
+                                FILL=int(args.flow_completion_fill),
+                                RESIDUAL=int(args.flow_completion_fill))
+    FlowGenerator = InpaintGenerator(config)
+    FlowComp_ckpt = torch.load(args.flow_completion_model)
+    FlowGenerator.load_state_dict(FlowComp_ckpt['generator'])
+    FlowGenerator.to(torch.device('cuda:0'))
+    FlowGenerator.eval()
+
+    return FlowGenerator
+
+
+def complete_flow_learned(args, FlowGenerator, corrFlow, flow_mask, mode, edge, compFlow):
+    """Completes the forward or backward flows with the flow inpainting
+    generator, args.flow_batch_size frames per forward pass. Each flow is
+    normalised by its largest known magnitude. Frames whose hole covers more
+    than args.flow_max_hole of the frame are completed by regionfill.
+    """
     imgH, imgW, _, nFrame = corrFlow.shape
-    Edge = np.empty(((imgH, imgW, 0)), dtype=np.float32)
+    offset = 0 if mode == 'forward' else 1
+    device = next(FlowGenerator.parameters()).device
 
+    indFrames = []
     for i in range(nFrame):
-        print("Completing {0} flow edge {1:2d} <---> {2:2d}".format(mode, i, i + 1), '\r', end='')
-        flow_mask_img = flow_mask[:, :, i] if mode == 'forward' else flow_mask[:, :, i + 1]
+        flow_mask_img = flow_mask[:, :, i + offset]
+        if flow_mask_img.mean() > args.flow_max_hole:
+            filler = rf.RegionFill(flow_mask_img, solver=args.flow_solver, tol=args.flow_solver_tol)
+            compFlow[:, :, :, i] = filler.fill(corrFlow[..., i])
+        else:
+            indFrames.append(i)
 
-        flow_img_gray = (corrFlow[:, :, 0, i] ** 2 + corrFlow[:, :, 1, i] ** 2) ** 0.5
-        flow_img_gray = flow_img_gray / flow_img_gray.max()
+    # The generator downsamples by 4.
+    padH, padW = (-imgH) % 4, (-imgW) % 4
 
-        edge_corr = canny(flow_img_gray, sigma=2, mask=(1 - flow_mask_img).astype(bool))
-        edge_completed = infer(args, EdgeGenerator, torch.device('cuda:0'), flow_img_gray, edge_corr, flow_mask_img)
-        Edge = np.concatenate((Edge, edge_completed[..., None]), axis=-1)
+    for start in range(0, len(indFrames), args.flow_batch_size):
+        batch = indFrames[start : start + args.flow_batch_size]
+        print("Completing {0} flow {1:2d} - {2:2d}".format(mode, batch[0], batch[-1]), '\r', end='')
 
-    return Edge
+        flows = np.stack([corrFlow[..., i] for i in batch]).astype(np.float32)
+        masks = np.stack([flow_mask[:, :, i + offset] for i in batch]).astype(np.float32)
+
+        # Per-frame normalisation, as in edgeconnect.dataset (NORM).
+        magnitude = np.sqrt((flows ** 2).sum(axis=3)) * (1 - masks)
+        factor = np.maximum(magnitude.reshape(len(batch), -1).max(axis=1), 1e-6).reshape(-1, 1, 1, 1)
+        flows = flows / factor
+
+        # The generator takes full-frame edge maps: the Canny edges of the
+        # known region and, with edge_completion, the completed edges in the
+        # hole (edge_completion only computes the edges around the hole).
+        edges = np.stack([flow_canny(corrFlow[..., i], flow_mask[:, :, i + offset])[1] for i in batch]).astype(np.float32)
+        if edge is not None:
+            edges = np.where(masks > 0, np.stack([edge[:, :, i] for i in batch]), edges)
+
+        if args.flow_completion_fill:
+            flows_masked = regionfill_batch(flows, masks, tol=args.flow_solver_tol)
+        else:
+            flows_masked = flows * (1 - masks[..., None])
+
+        # The completed edges, in the hole too, are the guidance of the generator.
+        inputs = np.concatenate((flows_masked, edges[..., None], masks[..., None]), axis=3)
+        inputs = torch.from_numpy(inputs.transpose(0, 3, 1, 2).astype(np.float32)).to(device)
+        inputs = torch.nn.functional.pad(inputs, (0, padW, 0, padH), mode='reflect')
+        with torch.no_grad():
+            outputs = FlowGenerator(inputs)[:, :, :imgH, :imgW]
+        outputs = outputs.permute(0, 2, 3, 1).cpu().numpy() * factor
+
+        for b, i in enumerate(batch):
+            mask_b = masks[b][..., None]
+            compFlow[:, :, :, i] = outputs[b] * mask_b + corrFlow[..., i] * (1 - mask_b)
+
+
+def flow_canny(flow, flow_mask_img, fast=False, roi=None):
+    """Computes the normalised magnitude of a flow and its Canny edges.
+    The magnitude is normalised over the whole frame, then cropped to roi.
+    """
+    flow_img_gray = (flow[:, :, 0] ** 2 + flow[:, :, 1] ** 2) ** 0.5
+    flow_img_gray = flow_img_gray / flow_img_gray.max()
+
+    if roi is not None:
+        y0, y1, x0, x1 = roi
+        flow_img_gray = flow_img_gray[y0:y1, x0:x1]
+        flow_mask_img = flow_mask_img[y0:y1, x0:x1]
+
+    if fast:
+        edge = fast_canny(flow_img_gray, sigma=2, mask=(1 - flow_mask_img).astype(bool))
+    else:
+        edge = canny(flow_img_gray, sigma=2, mask=(1 - flow_mask_img).astype(bool))
+
+    return flow_img_gray, edge
+
+
+def hole_bbox(flow_mask_img, margin):
+    """Bounding box (y0, y1, x0, x1) of the hole enlarged by margin.
+    Returns None if the mask has no hole.
+    """
+    imgH, imgW = flow_mask_img.shape
+    HoleRow = np.where(flow_mask_img.any(axis=1))[0]
+    if len(HoleRow) == 0:
+        return None
+    HoleCol = np.where(flow_mask_img.any(axis=0))[0]
+
+    return (max(HoleRow[0] - margin, 0), min(HoleRow[-1] + 1 + margin, imgH),
+            max(HoleCol[0] - margin, 0), min(HoleCol[-1] + 1 + margin, imgW))
+
+
+def fit_bbox(bbox, cropH, cropW, imgH, imgW):
+    """Resizes a bounding box to cropH x cropW, keeping it inside the frame.
+    """
+    y0, _, x0, _ = bbox
+    y0 = min(y0, imgH - cropH)
+    x0 = min(x0, imgW - cropW)
+
+    return y0, y0 + cropH, x0, x0 + cropW
+
+
+def edge_completion(args, EdgeGenerator, corrFlowF, corrFlowB, flow_mask):
+    """Calculates the forward and backward flow edges and completes them.
+
+    Only the flows with a hole are processed, cropped to the hole bounding box
+    enlarged by args.edge_margin. Poisson_blend only uses the edges at the hole
+    pixels and their neighbors, so the rest of the edge volume is left
+    untouched (zero pages that are never written); complete_flow_learned
+    takes the edges of the known region from the full-frame Canny instead. Both directions are completed in the
+    same batches; the crops of a batch share the same size, a multiple of 4
+    (the stride of the EdgeGenerator).
+    """
+    imgH, imgW, _, nFrame = corrFlowF.shape
+    FlowF_edge = create_array((imgH, imgW, nFrame), np.float32, args.scratch_dir)
+    FlowB_edge = create_array((imgH, imgW, nFrame), np.float32, args.scratch_dir)
+
+    # The edges are needed one pixel around the hole.
+    margin = max(args.edge_margin, 1)
+    static = is_static_mask(flow_mask)
+
+    # (completed edge, flow, flow index, mask index, hole bounding box) of every flow with a hole.
+    flows = []
+    bboxes = {}
+    for i in range(nFrame):
+        for Edge, corrFlow, indMask in ((FlowF_edge, corrFlowF, i), (FlowB_edge, corrFlowB, i + 1)):
+            if indMask not in bboxes and not (static and bboxes):
+                bboxes[indMask] = hole_bbox(flow_mask[:, :, indMask], margin)
+            bbox = bboxes[0] if static else bboxes[indMask]
+            if bbox is not None:
+                flows.append((Edge, corrFlow, i, indMask, bbox))
+
+    if len(flows) == 0:
+        return FlowF_edge, FlowB_edge
+
+    fast = args.fast_canny
+    if fast:
+        # The fast Canny has to stay close to skimage, checked on the first flow.
+        _, corrFlow, i, indMask, bbox = flows[0]
+        flow_img_gray, edge = flow_canny(corrFlow[..., i], flow_mask[:, :, indMask], fast=True, roi=bbox)
+        y0, y1, x0, x1 = bbox
+        mismatch = edge_mismatch(edge, canny(flow_img_gray, sigma=2, mask=(1 - flow_mask[y0:y1, x0:x1, indMask]).astype(bool)))
+        if mismatch > args.canny_tolerance:
+            print('Fast Canny differs from skimage ({0:.1f}% of the edges), using skimage.'.format(100 * mismatch))
+            fast = False
+
+    # The flow magnitudes and edges of a batch are computed in parallel.
+    pool = ThreadPoolExecutor(max_workers=args.num_workers)
+
+    for start in range(0, len(flows), args.edge_batch_size):
+        batch = flows[start : start + args.edge_batch_size]
+        print("Completing flow edge {0:3d} / {1:3d}".format(start + len(batch), len(flows)), '\r', end='')
+
+        # Common crop size of the batch.
+        cropH = min(int(np.ceil(max(bbox[1] - bbox[0] for *_, bbox in batch) / 4.0)) * 4, imgH)
+        cropW = min(int(np.ceil(max(bbox[3] - bbox[2] for *_, bbox in batch) / 4.0)) * 4, imgW)
+        rois = [fit_bbox(bbox, cropH, cropW, imgH, imgW) for *_, bbox in batch]
+
+        flow_img_gray = np.zeros((len(batch), cropH, cropW), dtype=np.float32)
+        edge_corr = np.zeros((len(batch), cropH, cropW), dtype=np.float32)
+        mask = np.zeros((len(batch), cropH, cropW), dtype=np.float32)
+
+        results = pool.map(lambda item: flow_canny(item[0][1][..., item[0][2]], flow_mask[:, :, item[0][3]], fast, item[1]),
+                           zip(batch, rois))
+        for k, ((_, _, _, indMask, _), (y0, y1, x0, x1), (flow_img_gray_k, edge_k)) in enumerate(zip(batch, rois, results)):
+            flow_img_gray[k] = flow_img_gray_k
+            edge_corr[k] = edge_k
+            mask[k] = flow_mask[y0:y1, x0:x1, indMask]
+
+        edge_completed = infer(args, EdgeGenerator, torch.device('cuda:0'), flow_img_gray, edge_corr, mask)
+
+        for k, ((Edge, _, i, _, _), (y0, y1, x0, x1)) in enumerate(zip(batch, rois)):
+            Edge[y0:y1, x0:x1, i] = edge_completed[k]
+
+    pool.shutdown()
+
+    return FlowF_edge, FlowB_edge
 
 
 def video_completion(args):
 
+    # Memory reclaimed at the end of each stage.
+    memory = MemoryStages()
+
     # Flow model.
     RAFT_model = initialize_RAFT(args)
 
@@ -471,7 +819,13 @@ def video_completion(args):
     print('\nFinish flow prediction.')
 
     # Makes sure video is in BGR (opencv) format.
-    video = video.permute(2, 3, 1, 0).cpu().numpy()[:, :, ::-1, :] / 255.
+    frames = video
+    video = video_to_numpy(args, frames)
+
+    # The flow model and the frames on the GPU are not needed anymore.
+    memory.end('flow prediction')
+    del RAFT_model, frames
+    memory.release()
 
     if args.mode == 'video_extrapolation':
 
@@ -479,31 +833,44 @@ def video_completion(args):
         video, corrFlowF, corrFlowB, corrFlowNLF, corrFlowNLB, flow_mask, mask_dilated, start_point, end_point = extrapolation(args, video, corrFlowF, corrFlowB, corrFlowNLF, corrFlowNLB)
         imgH, imgW = video.shape[:2]
 
-        # mask indicating the missing region in the video.
-        mask = np.tile(flow_mask[..., None], (1, 1, nFrame))
-        flow_mask = np.tile(flow_mask[..., None], (1, 1, nFrame))
+        # mask indicating the missing region in the video (the same in every frame).
+        mask = static_mask(flow_mask, nFrame)
+        flow_mask = static_mask(flow_mask, nFrame)
 
     else:
         # Loads masks.
-        filename_list = glob.glob(os.path.join(args.path_mask, '*.png')) + \
-                        glob.glob(os.path.join(args.path_mask, '*.jpg'))
-
-        mask = []
-        flow_mask = []
-        for filename in sorted(filename_list):
-            mask_img = np.array(Image.open(filename).convert('L'))
-            mask.append(mask_img)
-
-            # Dilate 15 pixel so that all known pixel is trustworthy
-            flow_mask_img = scipy.ndimage.binary_dilation(mask_img, iterations=15)
-            # Close the small holes inside the foreground objects
-            flow_mask_img = cv2.morphologyEx(flow_mask_img.astype(np.uint8), cv2.MORPH_CLOSE, np.ones((21, 21),np.uint8)).astype(bool)
-            flow_mask_img = scipy.ndimage.binary_fill_holes(flow_mask_img).astype(bool)
-            flow_mask.append(flow_mask_img)
-
-        # mask indicating the missing region in the video.
-        mask = np.stack(mask, -1).astype(bool)
-        flow_mask = np.stack(flow_mask, -1).astype(bool)
+        filename_list = sorted(glob.glob(os.path.join(args.path_mask, '*.png')) + \
+                               glob.glob(os.path.join(args.path_mask, '*.jpg')))
+
+        if is_static(filename_list):
+            # The mask is the same in every frame (e.g. logo removal), it is
+            # prepared and stored only once.
+            mask_img = load_mask(filename_list[0])
+            mask = static_mask(mask_img, nFrame)
+            flow_mask = static_mask(get_flow_mask(mask_img), nFrame)
+        else:
+            # mask indicating the missing region in the video.
+            mask = create_array((imgH, imgW, nFrame), bool, args.scratch_dir)
+            flow_mask = create_array((imgH, imgW, nFrame), bool, args.scratch_dir)
+            for i, filename in enumerate(filename_list):
+                mask_img = load_mask(filename)
+                mask[:, :, i] = mask_img
+                flow_mask[:, :, i] = get_flow_mask(mask_img)
+
+    # Keeps the full video to paste the completed region of interest back.
+    video_ori, roi = video, None
+    if args.roi and args.mode == 'object_removal':
+        # Every completion stage runs on the spatio-temporal region of interest.
+        roi = compute_roi(args, flow_mask, corrFlowF, corrFlowB, corrFlowNLF, corrFlowNLB)
+        video = crop_roi(args, video, roi)
+        mask = crop_roi(args, mask, roi)
+        flow_mask = crop_roi(args, flow_mask, roi)
+        corrFlowF = crop_roi(args, corrFlowF, roi, flow=True)
+        corrFlowB = crop_roi(args, corrFlowB, roi, flow=True)
+        if args.Nonlocal:
+            corrFlowNLF = crop_roi(args, corrFlowNLF, roi)
+            corrFlowNLB = crop_roi(args, corrFlowNLB, roi)
+        imgH, imgW, nFrame = mask.shape
 
     if args.edge_guide:
         # Edge completion model.
@@ -514,15 +881,19 @@ def video_completion(args):
         EdgeGenerator.eval()
 
         # Edge completion.
-        FlowF_edge = edge_completion(args, EdgeGenerator, corrFlowF, flow_mask, 'forward')
-        FlowB_edge = edge_completion(args, EdgeGenerator, corrFlowB, flow_mask, 'backward')
+        FlowF_edge, FlowB_edge = edge_completion(args, EdgeGenerator, corrFlowF, corrFlowB, flow_mask)
         print('\nFinish edge completion.')
+
+        memory.end('edge completion')
+        del EdgeGenerator, EdgeComp_ckpt
+        memory.release()
     else:
         FlowF_edge, FlowB_edge = None, None
 
     # Completes the flow.
-    videoFlowF = complete_flow(args, corrFlowF, flow_mask, 'forward', FlowF_edge)
-    videoFlowB = complete_flow(args, corrFlowB, flow_mask, 'backward', FlowB_edge)
+    FlowGenerator = load_flow_generator(args) if args.flow_completion == 'learned' else None
+    videoFlowF = complete_flow(args, corrFlowF, flow_mask, 'forward', FlowF_edge, FlowGenerator)
+    videoFlowB = complete_flow(args, corrFlowB, flow_mask, 'backward', FlowB_edge, FlowGenerator)
 
     if args.Nonlocal:
         videoNonLocalFlowF = complete_flow(args, corrFlowNLF, flow_mask, 'nonlocal_forward', None)
@@ -532,6 +903,11 @@ def video_completion(args):
         videoNonLocalFlowB = None
     print('\nFinish flow completion.')
 
+    # The corrupted flows and the edge maps have been consumed.
+    memory.end('flow completion')
+    del corrFlowF, corrFlowB, corrFlowNLF, corrFlowNLB, FlowF_edge, FlowB_edge, FlowGenerator
+    memory.release()
+
     iter = 0
     mask_tofill = mask
     video_comp = video
@@ -539,18 +915,23 @@ def video_completion(args):
     # Image inpainting model.
     deepfill = DeepFillv1(pretrained_model=args.deepfill_model, image_shape=[imgH, imgW])
 
+    # The flow neighbors are traced once, each iteration only re-traces the
+    # ones invalidated by the pixels filled (or dilated) since the last one.
+    flowCorr = FlowCorrespondence(args, videoFlowF, videoFlowB)
+
     # We iteratively complete the video.
     while(np.sum(mask_tofill) > 0):
         create_dir(os.path.join(args.outroot, 'frame_comp_' + str(iter)))
 
         # Color propagation.
-        video_comp, mask_tofill, _ = get_flowNN(args,
-                                      video_comp,
-                                      mask_tofill,
-                                      videoFlowF,
-                                      videoFlowB,
-                                      videoNonLocalFlowF,
-                                      videoNonLocalFlowB)
+        propagate = get_flowNN_torch if args.propagation_backend == 'torch' else partial(get_flowNN, corr=flowCorr, incremental=args.incremental_propagation)
+        video_comp, mask_tofill, _ = propagate(args,
+                                               video_comp,
+                                               mask_tofill,
+                                               videoFlowF,
+                                               videoFlowB,
+                                               videoNonLocalFlowF,
+                                               videoNonLocalFlowB)
 
         for i in range(nFrame):
             mask_tofill[:, :, i] = scipy.ndimage.binary_dilation(mask_tofill[:, :, i], iterations=2)
@@ -562,20 +943,33 @@ def video_completion(args):
         # video_comp_ = (video_comp * 255).astype(np.uint8).transpose(3, 0, 1, 2)[:, :, :, ::-1]
         # imageio.mimwrite(os.path.join(args.outroot, 'frame_comp_' + str(iter), 'intermediate_{0}.mp4'.format(str(iter))), video_comp_, fps=12, quality=8, macro_block_size=1)
         # imageio.mimsave(os.path.join(args.outroot, 'frame_comp_' + str(iter), 'intermediate_{0}.gif'.format(str(iter))), video_comp_, format='gif', fps=12)
-        mask_tofill, video_comp = spatial_inpaint(deepfill, mask_tofill, video_comp)
+        mask_tofill, video_comp = spatial_inpaint(deepfill, mask_tofill, video_comp,
+                                                  flowCorr if args.propagation_backend == 'numpy' else None,
+                                                  args.max_keyframes,
+                                                  args.keyframe_selection)
         iter += 1
 
+    memory.end('completion')
+    del deepfill, flowCorr, videoFlowF, videoFlowB, videoNonLocalFlowF, videoNonLocalFlowB
+    memory.release()
+
     create_dir(os.path.join(args.outroot, 'frame_comp_' + 'final'))
-    video_comp_ = (video_comp * 255).astype(np.uint8).transpose(3, 0, 1, 2)[:, :, :, ::-1]
-    for i in range(nFrame):
-        img = video_comp[:, :, :, i] * 255
+    # Streams the frames into the video so that the whole clip is never copied.
+    writer = imageio.get_writer(os.path.join(args.outroot, 'frame_comp_' + 'final', 'final.mp4'), fps=12, quality=8, macro_block_size=1)
+    for i in range(video_ori.shape[3]):
+        img = paste_roi(video_ori, video_comp, roi, i) * 255
         cv2.imwrite(os.path.join(args.outroot, 'frame_comp_' + 'final', '%05d.png'%i), img)
-        imageio.mimwrite(os.path.join(args.outroot, 'frame_comp_' + 'final', 'final.mp4'), video_comp_, fps=12, quality=8, macro_block_size=1)
-        # imageio.mimsave(os.path.join(args.outroot, 'frame_comp_' + 'final', 'final.gif'), video_comp_, format='gif', fps=12)
+        writer.append_data(img.astype(np.uint8)[:, :, ::-1])
+    writer.close()
+
+    memory.summary()
 
 
 def video_completion_seamless(args):
 
+    # Memory reclaimed at the end of each stage.
+    memory = MemoryStages()
+
     # Flow model.
     RAFT_model = initialize_RAFT(args)
 
@@ -600,7 +994,13 @@ def video_completion_seamless(args):
     print('\nFinish flow prediction.')
 
     # Makes sure video is in BGR (opencv) format.
-    video = video.permute(2, 3, 1, 0).cpu().numpy()[:, :, ::-1, :] / 255.
+    frames = video
+    video = video_to_numpy(args, frames)
+
+    # The flow model and the frames on the GPU are not needed anymore.
+    memory.end('flow prediction')
+    del RAFT_model, frames
+    memory.release()
 
     if args.mode == 'video_extrapolation':
 
@@ -608,38 +1008,61 @@ def video_completion_seamless(args):
         video, corrFlowF, corrFlowB, corrFlowNLF, corrFlowNLB, flow_mask, mask_dilated, start_point, end_point = extrapolation(args, video, corrFlowF, corrFlowB, corrFlowNLF, corrFlowNLB)
         imgH, imgW = video.shape[:2]
 
-        # mask indicating the missing region in the video.
-        mask = np.tile(flow_mask[..., None], (1, 1, nFrame))
-        flow_mask = np.tile(flow_mask[..., None], (1, 1, nFrame))
-        mask_dilated = np.tile(mask_dilated[..., None], (1, 1, nFrame))
+        # mask indicating the missing region in the video. The mask and the
+        # gradient mask are updated during the completion, the flow mask is
+        # the same in every frame.
+        mask = create_array((imgH, imgW, nFrame), bool, args.scratch_dir)
+        mask[...] = flow_mask[..., None]
+        mask_dilated_img = mask_dilated
+        mask_dilated = create_array((imgH, imgW, nFrame), bool, args.scratch_dir)
+        mask_dilated[...] = mask_dilated_img[..., None]
+        flow_mask = static_mask(flow_mask, nFrame)
 
     else:
         # Loads masks.
-        filename_list = glob.glob(os.path.join(args.path_mask, '*.png')) + \
-                        glob.glob(os.path.join(args.path_mask, '*.jpg'))
-
-        mask = []
-        mask_dilated = []
-        flow_mask = []
-        for filename in sorted(filename_list):
-            mask_img = np.array(Image.open(filename).convert('L'))
-
-            # Dilate 15 pixel so that all known pixel is trustworthy
-            flow_mask_img = scipy.ndimage.binary_dilation(mask_img, iterations=15)
-            # Close the small holes inside the foreground objects
-            flow_mask_img = cv2.morphologyEx(flow_mask_img.astype(np.uint8), cv2.MORPH_CLOSE, np.ones((21, 21),np.uint8)).astype(bool)
-            flow_mask_img = scipy.ndimage.binary_fill_holes(flow_mask_img).astype(bool)
-            flow_mask.append(flow_mask_img)
+        filename_list = sorted(glob.glob(os.path.join(args.path_mask, '*.png')) + \
+                               glob.glob(os.path.join(args.path_mask, '*.jpg')))
+        static = is_static(filename_list)
+
+        # mask indicating the missing region in the video.
+        mask = create_array((imgH, imgW, nFrame), bool, args.scratch_dir)
+        mask_dilated = create_array((imgH, imgW, nFrame), bool, args.scratch_dir)
+        if not static:
+            flow_mask = create_array((imgH, imgW, nFrame), bool, args.scratch_dir)
+        for i, filename in enumerate(filename_list):
+            if static and i > 0:
+                # The mask is the same in every frame (e.g. logo removal), it
+                # is prepared only once.
+                mask[:, :, i] = mask_img
+                mask_dilated[:, :, i] = mask_dilated[:, :, 0]
+                continue
+
+            mask_img = load_mask(filename)
+            if static:
+                flow_mask = static_mask(get_flow_mask(mask_img), nFrame)
+            else:
+                flow_mask[:, :, i] = get_flow_mask(mask_img)
 
             mask_img = scipy.ndimage.binary_dilation(mask_img, iterations=5)
             mask_img = scipy.ndimage.binary_fill_holes(mask_img).astype(bool)
-            mask.append(mask_img)
-            mask_dilated.append(gradient_mask(mask_img))
-
-        # mask indicating the missing region in the video.
-        mask = np.stack(mask, -1).astype(bool)
-        mask_dilated = np.stack(mask_dilated, -1).astype(bool)
-        flow_mask = np.stack(flow_mask, -1).astype(bool)
+            mask[:, :, i] = mask_img
+            mask_dilated[:, :, i] = gradient_mask(mask_img)
+
+    # Keeps the full video to paste the completed region of interest back.
+    video_ori, roi = video, None
+    if args.roi and args.mode == 'object_removal':
+        # Every completion stage runs on the spatio-temporal region of interest.
+        roi = compute_roi(args, flow_mask, corrFlowF, corrFlowB, corrFlowNLF, corrFlowNLB)
+        video = crop_roi(args, video, roi)
+        mask = crop_roi(args, mask, roi)
+        flow_mask = crop_roi(args, flow_mask, roi)
+        mask_dilated = crop_roi(args, mask_dilated, roi)
+        corrFlowF = crop_roi(args, corrFlowF, roi, flow=True)
+        corrFlowB = crop_roi(args, corrFlowB, roi, flow=True)
+        if args.Nonlocal:
+            corrFlowNLF = crop_roi(args, corrFlowNLF, roi)
+            corrFlowNLB = crop_roi(args, corrFlowNLB, roi)
+        imgH, imgW, nFrame = mask.shape
 
     if args.edge_guide:
         # Edge completion model.
@@ -650,15 +1073,19 @@ def video_completion_seamless(args):
         EdgeGenerator.eval()
 
         # Edge completion.
-        FlowF_edge = edge_completion(args, EdgeGenerator, corrFlowF, flow_mask, 'forward')
-        FlowB_edge = edge_completion(args, EdgeGenerator, corrFlowB, flow_mask, 'backward')
+        FlowF_edge, FlowB_edge = edge_completion(args, EdgeGenerator, corrFlowF, corrFlowB, flow_mask)
         print('\nFinish edge completion.')
+
+        memory.end('edge completion')
+        del EdgeGenerator, EdgeComp_ckpt
+        memory.release()
     else:
         FlowF_edge, FlowB_edge = None, None
 
     # Completes the flow.
-    videoFlowF = complete_flow(args, corrFlowF, flow_mask, 'forward', FlowF_edge)
-    videoFlowB = complete_flow(args, corrFlowB, flow_mask, 'backward', FlowB_edge)
+    FlowGenerator = load_flow_generator(args) if args.flow_completion == 'learned' else None
+    videoFlowF = complete_flow(args, corrFlowF, flow_mask, 'forward', FlowF_edge, FlowGenerator)
+    videoFlowB = complete_flow(args, corrFlowB, flow_mask, 'backward', FlowB_edge, FlowGenerator)
     if args.Nonlocal:
         videoNonLocalFlowF = complete_flow(args, corrFlowNLF, flow_mask, 'nonlocal_forward', None)
         videoNonLocalFlowB = complete_flow(args, corrFlowNLB, flow_mask, 'nonlocal_backward', None)
@@ -667,19 +1094,22 @@ def video_completion_seamless(args):
         videoNonLocalFlowB = None
     print('\nFinish flow completion.')
 
+    # The corrupted flows and the edge maps have been consumed.
+    memory.end('flow completion')
+    del corrFlowF, corrFlowB, corrFlowNLF, corrFlowNLB, FlowF_edge, FlowB_edge, FlowGenerator
+    memory.release()
+
     # Prepare gradients
-    gradient_x = np.empty(((imgH, imgW, 3, 0)), dtype=np.float32)
-    gradient_y = np.empty(((imgH, imgW, 3, 0)), dtype=np.float32)
+    gradient_x = create_array((imgH, imgW, 3, nFrame), np.float32, args.scratch_dir)
+    gradient_y = create_array((imgH, imgW, 3, nFrame), np.float32, args.scratch_dir)
 
     for indFrame in range(nFrame):
         img = video[:, :, :, indFrame]
         img[mask[:, :, indFrame], :] = 0
         img = cv2.inpaint((img * 255).astype(np.uint8), mask[:, :, indFrame].astype(np.uint8), 3, cv2.INPAINT_TELEA).astype(np.float32)  / 255.
 
-        gradient_x_ = np.concatenate((np.diff(img, axis=1), np.zeros((imgH, 1, 3), dtype=np.float32)), axis=1)
-        gradient_y_ = np.concatenate((np.diff(img, axis=0), np.zeros((1, imgW, 3), dtype=np.float32)), axis=0)
-        gradient_x = np.concatenate((gradient_x, gradient_x_.reshape(imgH, imgW, 3, 1)), axis=-1)
-        gradient_y = np.concatenate((gradient_y, gradient_y_.reshape(imgH, imgW, 3, 1)), axis=-1)
+        gradient_x[:, :-1, :, indFrame] = np.diff(img, axis=1)
+        gradient_y[:-1, :, :, indFrame] = np.diff(img, axis=0)
 
         gradient_x[mask_dilated[:, :, indFrame], :, indFrame] = 0
         gradient_y[mask_dilated[:, :, indFrame], :, indFrame] = 0
@@ -695,21 +1125,25 @@ def video_completion_seamless(args):
     # Image inpainting model.
     deepfill = DeepFillv1(pretrained_model=args.deepfill_model, image_shape=[imgH, imgW])
 
+    # The flow neighbors of the gradients, updated with mask_gradient.
+    flowCorr = FlowCorrespondence(args, videoFlowF, videoFlowB, border=1)
+
     # We iteratively complete the video.
     while(np.sum(mask) > 0):
         create_dir(os.path.join(args.outroot, 'frame_seamless_comp_' + str(iter)))
 
         # Gradient propagation.
+        propagate = get_flowNN_gradient_torch if args.propagation_backend == 'torch' else partial(get_flowNN_gradient, corr=flowCorr)
         gradient_x_filled, gradient_y_filled, mask_gradient = \
-            get_flowNN_gradient(args,
-                                gradient_x_filled,
-                                gradient_y_filled,
-                                mask,
-                                mask_gradient,
-                                videoFlowF,
-                                videoFlowB,
-                                videoNonLocalFlowF,
-                                videoNonLocalFlowB)
+            propagate(args,
+                      gradient_x_filled,
+                      gradient_y_filled,
+                      mask,
+                      mask_gradient,
+                      videoFlowF,
+                      videoFlowB,
+                      videoNonLocalFlowF,
+                      videoNonLocalFlowB)
 
         # if there exist holes in mask, Poisson blending will fail. So I did this trick. I sacrifice some value. Another solution is to modify Poisson blending.
         for indFrame in range(nFrame):
@@ -717,12 +1151,18 @@ def video_completion_seamless(args):
 
         # After one gradient propagation iteration
         # gradient --> RGB
+        PoissonMask = None
         for indFrame in range(nFrame):
             print("Poisson blending frame {0:3d}".format(indFrame))
 
             if mask[:, :, indFrame].sum() > 0:
+                # The unknown pixels only depend on the mask, they are reused
+                # while the mask stays the same (e.g. static masks).
+                if PoissonMask is None or not np.array_equal(PoissonMask, mask[:, :, indFrame]):
+                    PoissonMask = np.array(mask[:, :, indFrame])
+                    holeIdx = holeIndices(PoissonMask)
                 try:
-                    frameBlend, UnfilledMask = Poisson_blend_img(video_comp[:, :, :, indFrame], gradient_x_filled[:, 0 : imgW - 1, :, indFrame], gradient_y_filled[0 : imgH - 1, :, :, indFrame], mask[:, :, indFrame], mask_gradient[:, :, indFrame])
+                    frameBlend, UnfilledMask = Poisson_blend_img(video_comp[:, :, :, indFrame], gradient_x_filled[:, 0 : imgW - 1, :, indFrame], gradient_y_filled[0 : imgH - 1, :, :, indFrame], mask[:, :, indFrame], mask_gradient[:, :, indFrame], indices=holeIdx)
                     # UnfilledMask = scipy.ndimage.binary_fill_holes(UnfilledMask).astype(bool)
                 except:
                     frameBlend, UnfilledMask = video_comp[:, :, :, indFrame], mask[:, :, indFrame]
@@ -746,7 +1186,10 @@ def video_completion_seamless(args):
         # imageio.mimwrite(os.path.join(args.outroot, 'frame_seamless_comp_' + str(iter), 'intermediate_{0}.mp4'.format(str(iter))), video_comp_, fps=12, quality=8, macro_block_size=1)
         # imageio.mimsave(os.path.join(args.outroot, 'frame_seamless_comp_' + str(iter), 'intermediate_{0}.gif'.format(str(iter))), video_comp_, format='gif', fps=12)
 
-        mask, video_comp = spatial_inpaint(deepfill, mask, video_comp)
+        mask, video_comp = spatial_inpaint(deepfill, mask, video_comp,
+                                           flowCorr if args.propagation_backend == 'numpy' else None,
+                                           args.max_keyframes,
+                                           args.keyframe_selection)
         iter += 1
 
         # Re-calculate gradient_x/y_filled and mask_gradient
@@ -759,14 +1202,118 @@ def video_completion_seamless(args):
             gradient_x_filled[mask_gradient[:, :, indFrame], :, indFrame] = 0
             gradient_y_filled[mask_gradient[:, :, indFrame], :, indFrame] = 0
 
+    memory.end('completion')
+    del deepfill, flowCorr, videoFlowF, videoFlowB, videoNonLocalFlowF, videoNonLocalFlowB
+    del gradient_x, gradient_y, gradient_x_filled, gradient_y_filled, mask_gradient
+    memory.release()
+
     create_dir(os.path.join(args.outroot, 'frame_seamless_comp_' + 'final'))
-    video_comp_ = (video_comp * 255).astype(np.uint8).transpose(3, 0, 1, 2)[:, :, :, ::-1]
-    for i in range(nFrame):
-        img = video_comp[:, :, :, i] * 255
+    for i in range(video_ori.shape[3]):
+        img = paste_roi(video_ori, video_comp, roi, i) * 255
         cv2.imwrite(os.path.join(args.outroot, 'frame_seamless_comp_' + 'final', '%05d.png'%i), img)
         # imageio.mimwrite(os.path.join(args.outroot, 'frame_seamless_comp_' + 'final', 'final.mp4'), video_comp_, fps=12, quality=8, macro_block_size=1)
         # imageio.mimsave(os.path.join(args.outroot, 'frame_seamless_comp_' + 'final', 'final.gif'), video_comp_, format='gif', fps=12)
 
+    memory.summary()
+
+
+def video_completion_windowed(args):
+    """Completes the video as a sequence of overlapping temporal windows.
+
+    Each window of args.window_size frames is completed independently, so the
+    memory footprint (and the non-local key frames) only depend on the window
+    length (the last window may be one frame longer, so that it has a flow
+    pair). The last args.window_context frames before a window, which are
+    already completed, are passed in as known frames. Frames shared by two
+    consecutive windows are linearly cross-faded.
+    """
+    # Loads frames and masks.
+    filename_list = sorted(glob.glob(os.path.join(args.path, '*.png')) + \
+                           glob.glob(os.path.join(args.path, '*.jpg')))
+    mask_list = sorted(glob.glob(os.path.join(args.path_mask, '*.png')) + \
+                       glob.glob(os.path.join(args.path_mask, '*.jpg')))
+    nFrame = len(filename_list)
+
+    window = args.window_size
+    overlap = args.window_overlap
+    assert 0 <= overlap < window, (
+        "window_overlap must be smaller than window_size")
+
+    # The extrapolated region is larger than the input frames, so the completed
+    # frames can not be fed back as context.
+    context = args.window_context if args.mode == 'object_removal' else 0
+
+    starts = [0]
+    while starts[-1] + window < nFrame:
+        starts.append(starts[-1] + window - overlap)
+    # A last window of a single frame has no flow to propagate along (with an
+    # overlap, it has at least overlap + 1 frames), it is merged into the
+    # previous window, which then runs to the last frame.
+    if len(starts) > 1 and nFrame - starts[-1] < 2:
+        starts.pop()
+
+    final_name = 'frame_seamless_comp_final' if args.seamless else 'frame_comp_final'
+    final_dir = os.path.join(args.outroot, final_name)
+    create_dir(final_dir)
+    writer = imageio.get_writer(os.path.join(final_dir, 'final.mp4'), fps=12, quality=8, macro_block_size=1)
+
+    prev_dir, prev_start, prev_context = None, None, 0
+    for indWindow, start in enumerate(starts):
+        end = min(start + window, nFrame) if indWindow + 1 < len(starts) else nFrame
+        next_start = starts[indWindow + 1] if indWindow + 1 < len(starts) else nFrame
+        nContext = min(context, start)
+        print('\nWindow {0:3d}: frame {1:5d} - {2:5d} ({3:d} context frames)'
+              .format(indWindow, start, end - 1, nContext))
+
+        # Writes the input of the window. Context frames are taken from the
+        # completed result and have an empty mask.
+        window_root = os.path.join(args.outroot, 'window_%03d'%indWindow)
+        window_path = os.path.join(window_root, 'input_frames')
+        window_path_mask = os.path.join(window_root, 'input_masks')
+        create_dir(window_path)
+        create_dir(window_path_mask)
+        for i, indFrame in enumerate(range(start - nContext, end)):
+            if indFrame < start:
+                shutil.copy(os.path.join(final_dir, '%05d.png'%indFrame),
+                            os.path.join(window_path, '%05d.png'%i))
+                if args.mode == 'object_removal':
+                    mask_img = np.array(Image.open(mask_list[indFrame]).convert('L'))
+                    cv2.imwrite(os.path.join(window_path_mask, '%05d.png'%i), np.zeros_like(mask_img))
+            else:
+                shutil.copy(filename_list[indFrame],
+                            os.path.join(window_path, '%05d'%i + os.path.splitext(filename_list[indFrame])[1]))
+                if args.mode == 'object_removal':
+                    shutil.copy(mask_list[indFrame],
+                                os.path.join(window_path_mask, '%05d'%i + os.path.splitext(mask_list[indFrame])[1]))
+
+        window_args = copy.copy(args)
+        window_args.path = window_path
+        window_args.path_mask = window_path_mask
+        window_args.outroot = window_root
+        if args.seamless:
+            video_completion_seamless(window_args)
+        else:
+            video_completion(window_args)
+        torch.cuda.empty_cache()
+
+        # Stitches the window. Frames shared with the next window are written
+        # once the next window is completed.
+        window_dir = os.path.join(window_root, final_name)
+        for indFrame in range(start, min(end, next_start)):
+            img = cv2.imread(os.path.join(window_dir, '%05d.png'%(indFrame - start + nContext))).astype(np.float32)
+            if prev_dir is not None and indFrame < prev_start + window:
+                # Cross-fades from the previous window to the current one.
+                w = (indFrame - start + 1) / (prev_start + window - start + 1)
+                img_prev = cv2.imread(os.path.join(prev_dir, '%05d.png'%(indFrame - prev_start + prev_context))).astype(np.float32)
+                img = (1 - w) * img_prev + w * img
+            img = np.round(img).astype(np.uint8)
+            cv2.imwrite(os.path.join(final_dir, '%05d.png'%indFrame), img)
+            writer.append_data(img[:, :, ::-1])
+
+        prev_dir, prev_start, prev_context = window_dir, start, nContext
+
+    writer.close()
+
 
 def main(args):
 
@@ -774,7 +1321,22 @@ def main(args):
         "Accepted modes: 'object_removal', 'video_extrapolation', but input is %s"
     ) % mode
 
-    if args.seamless:
+    # The torch propagation holds the video, the flows and the propagation
+    # buffers on the device.
+    assert not (args.out_of_core and args.propagation_backend == 'torch'), (
+        "--out_of_core is not supported by --propagation_backend torch"
+    )
+
+    # Video sized arrays are backed by files in scratch_dir in out-of-core mode.
+    if args.out_of_core:
+        if args.scratch_dir is None:
+            args.scratch_dir = os.path.join(args.outroot, 'scratch')
+    else:
+        args.scratch_dir = None
+
+    if args.window_size > 0:
+        video_completion_windowed(args)
+    elif args.seamless:
         video_completion_seamless(args)
     else:
         video_completion(args)
@@ -793,6 +1355,26 @@ if __name__ == '__main__':
     parser.add_argument('--consistencyThres', dest='consistencyThres', default=np.inf, type=float, help='flow consistency error threshold')
     parser.add_argument('--alpha', dest='alpha', default=0.1, type=float)
     parser.add_argument('--Nonlocal', action='store_true', help='Whether use edge as guidance to complete flow')
+    parser.add_argument('--out_of_core', action='store_true', help='Whether back the video, flows, masks and propagation buffers with memory-mapped files (numpy propagation backend only)')
+    parser.add_argument('--scratch_dir', default=None, help="scratch directory for --out_of_core (default: outroot/scratch)")
+    parser.add_argument('--roi', action='store_true', help='Whether complete only the spatio-temporal bounding box of the masks')
+    parser.add_argument('--roi_margin', dest='roi_margin', default=16, type=int, help='margin (in pixels) added to the flow magnitude around the region of interest')
+    parser.add_argument('--flow_completion', dest='flow_completion', default='regionfill', choices=['regionfill', 'torch', 'learned'], help='flow completion: per-frame regionfill, batched torch Laplace solver (without edges) or flow inpainting generator')
+    parser.add_argument('--flow_completion_model', default='../weight/flow_completion.pth', help="restore checkpoint of --flow_completion learned")
+    parser.add_argument('--flow_completion_fill', action='store_true', help='Whether the flow inpainting generator refines regionfill-prefilled flows')
+    parser.add_argument('--flow_max_hole', dest='flow_max_hole', default=0.3, type=float, help='frames with a larger hole fraction are completed by regionfill with --flow_completion learned')
+    parser.add_argument('--flow_batch_size', dest='flow_batch_size', default=16, type=int, help='number of frames completed at once by --flow_completion torch / learned')
+    parser.add_argument('--flow_solver', dest='flow_solver', default='direct', choices=['direct', 'cg', 'auto'], help='linear solver of the flow completion without edges')
+    parser.add_argument('--flow_solver_tol', dest='flow_solver_tol', default=1e-6, type=float, help='relative tolerance of the iterative flow solvers')
+    parser.add_argument('--propagation_backend', dest='propagation_backend', default='numpy', choices=['numpy', 'torch'], help='implementation of the flow-guided color / gradient propagation (torch holds the whole video on the device, not with --out_of_core)')
+    parser.add_argument('--propagation_device', dest='propagation_device', default=None, help='device of --propagation_backend torch (default: cuda:0 if available, else cpu)')
+    parser.add_argument('--max_keyframes', dest='max_keyframes', default=1, type=int, help='maximum number of key frames spatially inpainted (in one batch) per iteration, with non-overlapping propagated coverage (numpy backend)')
+    parser.add_argument('--keyframe_selection', dest='keyframe_selection', default='area', choices=['area', 'coverage'], help='key frames spatially inpainted first: largest hole area, or most unfilled pixels of the video reached through the flow neighbors (numpy backend)')
+    parser.add_argument('--incremental_propagation', action='store_true', help='after the first iteration of the color completion, only re-propagate the hole pixels affected by the spatially inpainted key frame (numpy backend)')
+    parser.add_argument('--num_workers', dest='num_workers', default=4, type=int, help='number of CPU threads for per-frame processing')
+    parser.add_argument('--window_size', dest='window_size', default=0, type=int, help='complete the video in temporal windows of this many frames (0: whole video)')
+    parser.add_argument('--window_overlap', dest='window_overlap', default=10, type=int, help='number of frames shared by consecutive windows, which are cross-faded')
+    parser.add_argument('--window_context', dest='window_context', default=5, type=int, help='number of completed frames passed to the next window as known context')
 
     # RAFT
     parser.add_argument('--model', default='../weight/raft-things.pth', help="restore checkpoint")
@@ -805,6 +1387,10 @@ if __name__ == '__main__':
 
     # Edge completion
     parser.add_argument('--edge_completion_model', default='../weight/edge_completion.pth', help="restore checkpoint")
+    parser.add_argument('--fast_canny', action='store_true', help='Whether use the OpenCV Canny for the flow edges')
+    parser.add_argument('--canny_tolerance', dest='canny_tolerance', default=0.05, type=float, help='maximum fraction of edges the fast Canny may move by more than 1 pixel')
+    parser.add_argument('--edge_margin', dest='edge_margin', default=64, type=int, help='context (in pixels) around the holes for the edge completion')
+    parser.add_argument('--edge_batch_size', dest='edge_batch_size', default=8, type=int, help='number of flows completed in one batch')
 
     # extrapolation
     parser.add_argument('--H_scale', dest='H_scale', default=2, type=float, help='H extrapolation scale')
@@ -1,7 +1,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import scipy.ndimage
-from scipy.sparse.linalg import spsolve
+from scipy.sparse.linalg import spsolve, splu
 from scipy import sparse
 import scipy.io as sio
 import numpy as np
@@ -12,11 +12,17 @@ import os
 import argparse
 
 
+# Tikhonov term of the normal equation. The unknowns that no equation
+# anchors to the known region (e.g. enclosed by edges) get the minimum norm
+# solution, like with lsqr.
+NORMAL_EPS = 1e-8
+
+
 def sub2ind(pi, pj, imgH, imgW):
     return pj + pi * imgW
 
 
-def Poisson_blend(imgTrg, imgSrc_gx, imgSrc_gy, holeMask, edge=None):
+def Poisson_blend(imgTrg, imgSrc_gx, imgSrc_gy, holeMask, edge=None, indices=None):
 
     imgH, imgW, nCh = imgTrg.shape
 
@@ -26,15 +32,18 @@ def Poisson_blend(imgTrg, imgSrc_gx, imgSrc_gy, holeMask, edge=None):
     # Initialize the reconstructed image
     imgRecon = np.zeros((imgH, imgW, nCh), dtype=np.float32)
 
-    # prepare discrete Poisson equation
-    A, b = solvePoisson(holeMask, imgSrc_gx, imgSrc_gy, imgTrg, edge)
+    if indices is None:
+        indices = holeIndices(holeMask)
+    pi, pj = indices[:2]
 
-    # Independently process each channel
-    for ch in range(nCh):
+    # prepare discrete Poisson equation
+    A, b = solvePoisson(holeMask, imgSrc_gx, imgSrc_gy, imgTrg, edge, indices)
 
-        # solve Poisson equation
-        x = scipy.sparse.linalg.lsqr(A, b[:, ch, None])[0]
-        imgRecon[:, :, ch] = x.reshape(imgH, imgW)
+    # Least squares solution of all the channels with a single factorisation
+    # of the normal equation.
+    if A.shape[1] > 0:
+        AtA = (A.T @ A + NORMAL_EPS * sparse.identity(A.shape[1])).tocsc()
+        imgRecon[pi[:, 0], pj[:, 0], :] = splu(AtA).solve(A.T @ b)
 
     # Combined with the known region in the target
     holeMaskC = np.tile(np.expand_dims(holeMask, axis=2), (1, 1, nCh))
@@ -63,14 +72,11 @@ def Poisson_blend(imgTrg, imgSrc_gx, imgSrc_gy, holeMask, edge=None):
 
     return imgBlend
 
-def solvePoisson(holeMask, imgSrc_gx, imgSrc_gy, imgTrg, edge):
-
-    # Prepare the linear system of equations for Poisson blending
+def holeIndices(holeMask):
+    """Precomputes the positions of the unknown pixels and of their 4 neighbors.
+    They can be reused for every image completed with the same hole mask.
+    """
     imgH, imgW = holeMask.shape
-    N = imgH * imgW
-
-    # Number of unknown variables
-    numUnknownPix = holeMask.sum()
 
     # 4-neighbors: dx and dy
     dx = [1, 0, -1,  0]
@@ -83,14 +89,6 @@ def solvePoisson(holeMask, imgSrc_gx, imgSrc_gy, imgTrg, edge):
     #      1
     #
 
-    # Initialize (I, J, S), for sparse matrix A where A(I(k), J(k)) = S(k)
-    I = np.empty((0, 1), dtype=np.float32)
-    J = np.empty((0, 1), dtype=np.float32)
-    S = np.empty((0, 1), dtype=np.float32)
-
-    # Initialize b
-    b = np.empty((0, 2), dtype=np.float32)
-
     # Precompute unkonwn pixel position
     pi = np.expand_dims(np.where(holeMask == 1)[0], axis=1) # y, i
     pj = np.expand_dims(np.where(holeMask == 1)[1], axis=1) # x, j
@@ -114,100 +112,93 @@ def solvePoisson(holeMask, imgSrc_gx, imgSrc_gy, imgTrg, edge):
 
     # Handling cases at image borders
     validN = (qi >= 0) & (qi <= imgH - 1) & (qj >= 0) & (qj <= imgW - 1)
-    qind = np.zeros((validN.shape), dtype=np.float32)
+    qind = np.zeros((validN.shape), dtype=np.int64)
     qind[validN] = sub2ind(qi[validN], qj[validN], imgH, imgW)
 
-    e_start = 0  # equation counter start
-    e_stop  = 0  # equation stop
+    return pi, pj, pind, qi, qj, validN, qind
+
+
+def solvePoisson(holeMask, imgSrc_gx, imgSrc_gy, imgTrg, edge, indices=None):
+
+    # Prepare the linear system of equations for Poisson blending. The
+    # unknowns are the hole pixels, in the order of holeIndices.
+    nCh = imgTrg.shape[2]
+
+    # Unknown pixels and their 4 neighbors only depend on the hole mask
+    if indices is None:
+        indices = holeIndices(holeMask)
+    pi, pj, pind, qi, qj, validN, qind = indices
+
+    # Number of unknown variables
+    numUnknownPix = len(pind)
+
+    # (I, J, S), for sparse matrix A where A(I(k), J(k)) = S(k). There is at
+    # most one equation per unknown and neighbor, with at most 2 non-zeros.
+    I = np.empty(8 * numUnknownPix, dtype=np.int64)
+    J = np.empty(8 * numUnknownPix, dtype=np.int64)
+    S = np.empty(8 * numUnknownPix, dtype=np.float64)
+    b = np.empty((4 * numUnknownPix, nCh), dtype=np.float64)
+
+    nEqn = 0  # equation counter
+    nnz  = 0  # non-zero counter
 
     # 4 neighbors
-    I, J, S, b, e_start, e_stop = constructEquation(0, validN, holeMask, edge, imgSrc_gx, imgSrc_gy, imgTrg, pi, pj, pind, qi, qj, qind, I, J, S, b, e_start, e_stop)
-    I, J, S, b, e_start, e_stop = constructEquation(1, validN, holeMask, edge, imgSrc_gx, imgSrc_gy, imgTrg, pi, pj, pind, qi, qj, qind, I, J, S, b, e_start, e_stop)
-    I, J, S, b, e_start, e_stop = constructEquation(2, validN, holeMask, edge, imgSrc_gx, imgSrc_gy, imgTrg, pi, pj, pind, qi, qj, qind, I, J, S, b, e_start, e_stop)
-    I, J, S, b, e_start, e_stop = constructEquation(3, validN, holeMask, edge, imgSrc_gx, imgSrc_gy, imgTrg, pi, pj, pind, qi, qj, qind, I, J, S, b, e_start, e_stop)
+    for n in range(4):
+        nEqn, nnz = constructEquation(n, validN, holeMask, edge, imgSrc_gx, imgSrc_gy, imgTrg, pi, pj, pind, qi, qj, qind, I, J, S, b, nEqn, nnz)
 
-    nEqn = len(b)
     # Construct the sparse matrix A
-    A = sparse.csr_matrix((S[:, 0], (I[:, 0], J[:, 0])), shape=(nEqn, N))
+    A = sparse.csr_matrix((S[:nnz], (I[:nnz], J[:nnz])), shape=(nEqn, numUnknownPix))
 
-    return A, b
+    return A, b[:nEqn]
 
 
-def constructEquation(n, validN, holeMask, edge, imgSrc_gx, imgSrc_gy, imgTrg, pi, pj, pind, qi, qj, qind, I, J, S, b, e_start, e_stop):
+def constructEquation(n, validN, holeMask, edge, imgSrc_gx, imgSrc_gy, imgTrg, pi, pj, pind, qi, qj, qind, I, J, S, b, nEqn, nnz):
 
     # Pixel that has valid neighbors
     validNeighbor = validN[:, n]
 
-    # Change the out-of-boundary value to 0, in order to run edge[y,x]
-    # in the next line. It won't affect anything as validNeighbor is saved already
-
-    qi_tmp = copy.deepcopy(qi)
-    qj_tmp = copy.deepcopy(qj)
-    qi_tmp[np.invert(validNeighbor), n] = 0
-    qj_tmp[np.invert(validNeighbor), n] = 0
+    # Change the out-of-boundary neighbors to the pixel itself, in order to
+    # run edge[y,x] in the next line. It won't affect anything as
+    # validNeighbor is saved already
+    qi_n = np.where(validNeighbor, qi[:, n], pi[:, 0])
+    qj_n = np.where(validNeighbor, qj[:, n], pj[:, 0])
 
     # Not edge
-    NotEdge = (edge[pi[:, 0], pj[:, 0]] == 0) * (edge[qi_tmp[:, n], qj_tmp[:, n]] == 0)
-
-    # Boundary constraint
-    Boundary = holeMask[qi_tmp[:, n], qj_tmp[:, n]] == 0
-    valid = validNeighbor * NotEdge * Boundary
-    J_tmp = pind[valid, :]
-
-    # num of equations: len(J_tmp)
-    e_stop = e_start + len(J_tmp)
-    I_tmp = np.arange(e_start, e_stop, dtype=np.float32).reshape(-1, 1)
-    e_start = e_stop
-
-    S_tmp = np.ones(J_tmp.shape, dtype=np.float32)
-
-    if n == 0:
-        b_tmp = - imgSrc_gx[pi[valid, 0], pj[valid, 0], :] + imgTrg[qi[valid, n], qj[valid, n], :]
-    elif n == 2:
-        b_tmp = imgSrc_gx[pi[valid, 0], pj[valid, 0] - 1, :] + imgTrg[qi[valid, n], qj[valid, n], :]
-    elif n == 1:
-        b_tmp = - imgSrc_gy[pi[valid, 0], pj[valid, 0], :] + imgTrg[qi[valid, n], qj[valid, n], :]
-    elif n == 3:
-        b_tmp = imgSrc_gy[pi[valid, 0] - 1, pj[valid, 0], :] + imgTrg[qi[valid, n], qj[valid, n], :]
-
-    I = np.concatenate((I, I_tmp))
-    J = np.concatenate((J, J_tmp))
-    S = np.concatenate((S, S_tmp))
-    b = np.concatenate((b, b_tmp))
-
-
-    # Non-boundary constraint
-    NonBoundary = holeMask[qi_tmp[:, n], qj_tmp[:, n]] == 1
-    valid = validNeighbor * NotEdge * NonBoundary
-
-    J_tmp = pind[valid, :]
-
-    # num of equations: len(J_tmp)
-    e_stop = e_start + len(J_tmp)
-    I_tmp = np.arange(e_start, e_stop, dtype=np.float32).reshape(-1, 1)
-    e_start = e_stop
-
-    S_tmp = np.ones(J_tmp.shape, dtype=np.float32)
-
-    if n == 0:
-        b_tmp = - imgSrc_gx[pi[valid, 0], pj[valid, 0], :]
-    elif n == 2:
-        b_tmp = imgSrc_gx[pi[valid, 0], pj[valid, 0] - 1, :]
-    elif n == 1:
-        b_tmp = - imgSrc_gy[pi[valid, 0], pj[valid, 0], :]
-    elif n == 3:
-        b_tmp = imgSrc_gy[pi[valid, 0] - 1, pj[valid, 0], :]
-
-    I = np.concatenate((I, I_tmp))
-    J = np.concatenate((J, J_tmp))
-    S = np.concatenate((S, S_tmp))
-    b = np.concatenate((b, b_tmp))
-
-    S_tmp = - np.ones(J_tmp.shape, dtype=np.float32)
-    J_tmp = qind[valid, n, None]
-
-    I = np.concatenate((I, I_tmp))
-    J = np.concatenate((J, J_tmp))
-    S = np.concatenate((S, S_tmp))
-
-    return I, J, S, b, e_start, e_stop
+    NotEdge = (edge[pi[:, 0], pj[:, 0]] == 0) & (edge[qi_n, qj_n] == 0)
+    valid = validNeighbor & NotEdge
+    NonBoundary = holeMask[qi_n, qj_n] == 1
+
+    # Boundary constraint: x(p) = trg(q) - grad, and non-boundary
+    # constraint: x(p) - x(q) = - grad
+    for boundary in [True, False]:
+        sel = np.where(valid & (NonBoundary != boundary))[0]
+        k = len(sel)
+
+        if n == 0:
+            grad = - imgSrc_gx[pi[sel, 0], pj[sel, 0], :]
+        elif n == 2:
+            grad = imgSrc_gx[pi[sel, 0], pj[sel, 0] - 1, :]
+        elif n == 1:
+            grad = - imgSrc_gy[pi[sel, 0], pj[sel, 0], :]
+        elif n == 3:
+            grad = imgSrc_gy[pi[sel, 0] - 1, pj[sel, 0], :]
+
+        rows = np.arange(nEqn, nEqn + k)
+        I[nnz : nnz + k] = rows
+        J[nnz : nnz + k] = sel
+        S[nnz : nnz + k] = 1
+        nnz += k
+
+        if boundary:
+            b[nEqn : nEqn + k] = grad + imgTrg[qi[sel, n], qj[sel, n], :]
+        else:
+            b[nEqn : nEqn + k] = grad
+            # The unknowns are sorted by pixel index.
+            I[nnz : nnz + k] = rows
+            J[nnz : nnz + k] = np.searchsorted(pind[:, 0], qind[sel, n])
+            S[nnz : nnz + k] = -1
+            nnz += k
+
+        nEqn += k
+
+    return nEqn, nnz
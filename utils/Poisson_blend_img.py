@@ -10,13 +10,14 @@ import copy
 import cv2
 import os
 import argparse
+from utils.Poisson_blend import holeIndices
 
 
 def sub2ind(pi, pj, imgH, imgW):
     return pj + pi * imgW
 
 
-def Poisson_blend_img(imgTrg, imgSrc_gx, imgSrc_gy, holeMask, gradientMask=None, edge=None):
+def Poisson_blend_img(imgTrg, imgSrc_gx, imgSrc_gy, holeMask, gradientMask=None, edge=None, indices=None):
 
     imgH, imgW, nCh = imgTrg.shape
 
@@ -31,7 +32,7 @@ def Poisson_blend_img(imgTrg, imgSrc_gx, imgSrc_gy, holeMask, gradientMask=None,
 
     # prepare discrete Poisson equation
     A, b, UnfilledMask = solvePoisson(holeMask, imgSrc_gx, imgSrc_gy, imgTrg,
-                                                  gradientMask, edge)
+                                                  gradientMask, edge, indices)
 
     # Independently process each channel
     for ch in range(nCh):
@@ -75,7 +76,7 @@ def Poisson_blend_img(imgTrg, imgSrc_gx, imgSrc_gy, holeMask, gradientMask=None,
     return imgBlend, UnfilledMask
 
 def solvePoisson(holeMask, imgSrc_gx, imgSrc_gy, imgTrg,
-                           gradientMask, edge):
+                           gradientMask, edge, indices=None):
 
     # UnfilledMask indicates the region that is not completed
     UnfilledMask_topleft = copy.deepcopy(holeMask)
@@ -88,17 +89,6 @@ def solvePoisson(holeMask, imgSrc_gx, imgSrc_gy, imgTrg,
     # Number of unknown variables
     numUnknownPix = holeMask.sum()
 
-    # 4-neighbors: dx and dy
-    dx = [1, 0, -1,  0]
-    dy = [0, 1,  0, -1]
-
-    #      3
-    #      |
-    # 2 -- * -- 0
-    #      |
-    #      1
-    #
-
     # Initialize (I, J, S), for sparse matrix A where A(I(k), J(k)) = S(k)
     I = np.empty((0, 1), dtype=np.float32)
     J = np.empty((0, 1), dtype=np.float32)
@@ -107,32 +97,11 @@ def solvePoisson(holeMask, imgSrc_gx, imgSrc_gy, imgTrg,
     # Initialize b
     b = np.empty((0, 3), dtype=np.float32)
 
-    # Precompute unkonwn pixel position
-    pi = np.expand_dims(np.where(holeMask == 1)[0], axis=1) # y, i
-    pj = np.expand_dims(np.where(holeMask == 1)[1], axis=1) # x, j
-    pind = sub2ind(pi, pj, imgH, imgW)
-
-    # |--------------------|
-    # |        y (i)       |
-    # |   x (j)  *         |
-    # |                    |
-    # |--------------------|
-    # p[y, x]
-
-    qi = np.concatenate((pi + dy[0],
-                         pi + dy[1],
-                         pi + dy[2],
-                         pi + dy[3]), axis=1)
-
-    qj = np.concatenate((pj + dx[0],
-                         pj + dx[1],
-                         pj + dx[2],
-                         pj + dx[3]), axis=1)
-
-    # Handling cases at image borders
-    validN = (qi >= 0) & (qi <= imgH - 1) & (qj >= 0) & (qj <= imgW - 1)
-    qind = np.zeros((validN.shape), dtype=np.float32)
-    qind[validN] = sub2ind(qi[validN], qj[validN], imgH, imgW)
+    # Unknown pixels and their 4 neighbors only depend on the hole mask, they
+    # are shared with Poisson_blend (utils/Poisson_blend.py).
+    if indices is None:
+        indices = holeIndices(holeMask)
+    pi, pj, pind, qi, qj, validN, qind = indices
 
     e_start = 0  # equation counter start
     e_stop  = 0  # equation stop
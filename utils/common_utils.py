@@ -7,6 +7,9 @@ import numpy as np
 import sys
 import os
 import time
+import gc
+import ctypes
+import tempfile
 from PIL import Image
 import scipy.ndimage
 
@@ -56,6 +59,158 @@ def create_dir(dir):
         os.makedirs(dir)
 
 
+def create_array(shape, dtype=np.float32, scratch_dir=None, fill=0):
+    """Allocates a (video sized) array.
+
+    If scratch_dir is given, the array is backed by an anonymous temporary file
+    in scratch_dir (np.memmap) instead of RAM, and the file is removed as soon
+    as the array is released. File backed arrays use Fortran order so that the
+    last (frame) axis is the slowest one, i.e. arr[..., t] is one contiguous
+    block on disk and frame-sequential loops stream through the file.
+    Empty arrays (e.g. the non-local flows without --Nonlocal) stay in RAM, an
+    empty file can not be mapped.
+    """
+    if scratch_dir is None or np.prod(shape) == 0:
+        if fill == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.full(shape, fill, dtype=dtype)
+
+    create_dir(scratch_dir)
+    arr = np.memmap(tempfile.TemporaryFile(dir=scratch_dir), dtype=dtype,
+                    mode='w+', shape=tuple(shape), order='F')
+    if fill != 0:
+        arr[...] = fill
+    return arr
+
+
+def static_mask(mask_img, nFrame):
+    """Returns a (read-only) imgH x imgW x nFrame view of a mask that is the
+    same in every frame. The mask is stored only once.
+    """
+    mask_img = np.array(mask_img, dtype=bool)
+    return np.broadcast_to(mask_img[:, :, None], mask_img.shape + (nFrame, ))
+
+
+def is_static_mask(mask):
+    """Checks whether the mask is a static_mask view, i.e. the same in every frame.
+    """
+    return mask.ndim == 3 and mask.strides[-1] == 0
+
+
+class HoleIndex(object):
+    """Hole pixels of a video mask (imgH x imgW x nFrame), sorted by frame.
+
+    sub:     numPix x [y, x, t] (int32)
+    offsets: the hole pixels of frame t are the rows offsets[t]:offsets[t + 1]
+             of sub (CSR-style)
+    lookup(y, x, t) gives the row of the pixels [y, x, t] in sub, -1 outside
+    of the hole. For a static_mask, the lookup table is a single frame.
+    """
+
+    def __init__(self, mask, scratch_dir=None):
+        imgH, imgW, nFrame = mask.shape
+        self.static = is_static_mask(mask)
+        if self.static:
+            y, x = np.nonzero(mask[:, :, 0])
+            numPixFrame = len(y)
+            self.sub = np.empty((numPixFrame * nFrame, 3), dtype=np.int32)
+            self.sub[:, 0] = np.tile(y, nFrame)
+            self.sub[:, 1] = np.tile(x, nFrame)
+            self.sub[:, 2] = np.repeat(np.arange(nFrame), numPixFrame)
+            self.offsets = np.arange(nFrame + 1, dtype=np.int64) * numPixFrame
+            self.index = np.full((imgH, imgW), -1, dtype=np.int32)
+            self.index[y, x] = np.arange(numPixFrame, dtype=np.int32)
+        else:
+            # Frame-major order, i.e. sorted by frame.
+            t, y, x = np.nonzero(np.moveaxis(np.asarray(mask), 2, 0))
+            self.sub = np.stack((y, x, t), axis=1).astype(np.int32)
+            self.offsets = np.searchsorted(t, np.arange(nFrame + 1)).astype(np.int64)
+            self.index = create_array((imgH, imgW, nFrame), np.int32, scratch_dir, fill=-1)
+            self.index[y, x, t] = np.arange(len(t), dtype=np.int32)
+        self.numPix = len(self.sub)
+
+    def frame(self, t):
+        """Hole pixels [y, x, t] of frame t (a view of sub).
+        """
+        return self.sub[self.offsets[t]:self.offsets[t + 1]]
+
+    def rows(self, t):
+        """Rows of sub of the hole pixels of frame t.
+        """
+        return np.arange(self.offsets[t], self.offsets[t + 1])
+
+    def lookup(self, y, x, t):
+        if self.static:
+            idx = self.index[y, x]
+            return np.where(idx >= 0, idx + self.offsets[t], -1)
+        return self.index[y, x, t]
+
+
+def memory_usage():
+    """Returns the resident memory of the process and the GPU memory reserved
+    by torch, in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        # Without procfs only the peak resident memory is available.
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        rss *= 1 if sys.platform == 'darwin' else 1024
+
+    gpu = torch.cuda.memory_reserved() if torch.cuda.is_available() else 0
+
+    return rss, gpu
+
+
+def release_memory():
+    """Hands the memory of the released objects back to the system.
+    """
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    try:
+        # glibc keeps freed heap memory in its arenas.
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class MemoryStages(object):
+    """Reports the memory reclaimed at the stage boundaries of a pipeline.
+
+    Call end(stage) once a stage is done, drop the references to the models
+    and intermediates that are not needed anymore, then call release().
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.stage = None
+        self.usage = None
+
+    def end(self, stage):
+        self.stage = stage
+        self.usage = memory_usage()
+
+    def release(self):
+        release_memory()
+        rss, gpu = memory_usage()
+        self.stages.append((self.stage,
+                            self.usage[0] - rss, self.usage[1] - gpu, rss, gpu))
+        print('{0}: reclaimed {1:.1f} MB (CPU) {2:.1f} MB (GPU)'
+              .format(self.stage, (self.usage[0] - rss) / 2 ** 20,
+                      (self.usage[1] - gpu) / 2 ** 20))
+
+    def summary(self):
+        print('\n{0:24s} {1:>14s} {2:>14s} {3:>12s} {4:>12s}'
+              .format('Stage', 'CPU freed (MB)', 'GPU freed (MB)', 'CPU (MB)', 'GPU (MB)'))
+        for stage, rss_freed, gpu_freed, rss, gpu in self.stages:
+            print('{0:24s} {1:14.1f} {2:14.1f} {3:12.1f} {4:12.1f}'
+                  .format(stage, rss_freed / 2 ** 20, gpu_freed / 2 ** 20,
+                          rss / 2 ** 20, gpu / 2 ** 20))
+
+
 def bboxes_mask(imgH, imgW, type='ori'):
     mask = np.zeros((imgH, imgW), dtype=np.float32)
     factor = 1920 * 2 // imgW
@@ -113,6 +268,92 @@ def flow_edge(flow, mask=None):
         return edge_canny
 
 
+def fast_canny(img, sigma=2, mask=None, low_threshold=0.1, high_threshold=0.2):
+    """OpenCV implementation of skimage.feature.canny for float images.
+
+    Same steps as skimage: smoothing with zero padding normalised by the
+    smoothed mask, Sobel gradients with reflected borders, bilinear
+    non-maximum suppression and hysteresis on the 8-connected segments above
+    low_threshold that reach high_threshold.
+    """
+    img = np.asarray(img, dtype=np.float32)
+    if mask is None:
+        mask = np.ones(img.shape, dtype=bool)
+    mask = mask.astype(bool)
+
+    # Gaussian smoothing, truncated at 4 sigma with zero padding.
+    ksize = 2 * int(4 * sigma + 0.5) + 1
+    smoothed = cv2.GaussianBlur(img * mask, (ksize, ksize), sigma, borderType=cv2.BORDER_CONSTANT)
+    bleed_over = cv2.GaussianBlur(mask.astype(np.float32), (ksize, ksize), sigma, borderType=cv2.BORDER_CONSTANT)
+    smoothed /= bleed_over + np.finfo(np.float32).eps
+
+    jsobel = cv2.Sobel(smoothed, cv2.CV_32F, 1, 0, ksize=3, borderType=cv2.BORDER_REFLECT)
+    isobel = cv2.Sobel(smoothed, cv2.CV_32F, 0, 1, ksize=3, borderType=cv2.BORDER_REFLECT)
+    magnitude = isobel * isobel
+    magnitude += jsobel * jsobel
+    np.sqrt(magnitude, out=magnitude)
+
+    # Same as skimage, there is no edge at the border of the mask.
+    eroded_mask = cv2.erode(mask.astype(np.uint8), np.ones((3, 3), dtype=np.uint8),
+                            borderType=cv2.BORDER_CONSTANT, borderValue=0) > 0
+
+    low_masked = nonmaximum_suppression(isobel, jsobel, magnitude, eroded_mask, low_threshold)
+
+    # Keep the segments of the low mask that have a pixel above high_threshold.
+    numLabel, labels = cv2.connectedComponents((low_masked > 0).astype(np.uint8), connectivity=8)
+    good_label = np.zeros(numLabel, dtype=bool)
+    good_label[labels[low_masked >= high_threshold]] = True
+    good_label[0] = False
+
+    return good_label[labels]
+
+
+def nonmaximum_suppression(isobel, jsobel, magnitude, eroded_mask, low_threshold):
+    """Bilinear non-maximum suppression of skimage.feature.canny: the
+    magnitude of the pixels of eroded_mask above low_threshold that are not
+    below the magnitude interpolated at either side along the gradient.
+    """
+    out = np.zeros_like(magnitude)
+    y, x = np.nonzero(eroded_mask & (magnitude >= low_threshold))
+    gi, gj, m = isobel[y, x], jsobel[y, x], magnitude[y, x]
+    up, down, right, left = gi >= 0, gi <= 0, gj >= 0, gj <= 0
+    cond1 = (up & right) | (down & left)
+    cond2 = np.invert(cond1) & ((down & right) | (up & left))
+    abs_isobel, abs_jsobel = np.abs(gi), np.abs(gj)
+
+    # Per gradient sector: the offsets [y, x] of the two neighbors the
+    # magnitude is interpolated between (the other side is opposite), and the
+    # weight of the second one.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sectors = ((cond1 & (abs_isobel > abs_jsobel), (1, 0), (1, 1), abs_jsobel / abs_isobel),
+                   (cond1 & (abs_isobel <= abs_jsobel), (0, 1), (1, 1), abs_isobel / abs_jsobel),
+                   (cond2 & (abs_isobel < abs_jsobel), (0, 1), (-1, 1), abs_isobel / abs_jsobel),
+                   (cond2 & (abs_isobel >= abs_jsobel), (-1, 0), (-1, 1), abs_jsobel / abs_isobel))
+
+    keep = np.zeros(len(y), dtype=bool)
+    for Ind, (dy1, dx1), (dy2, dx2), w in sectors:
+        Ind = np.where(Ind)[0]
+        ys, xs, ms, ws = y[Ind], x[Ind], m[Ind], w[Ind]
+        c_plus = magnitude[ys + dy2, xs + dx2] * ws + magnitude[ys + dy1, xs + dx1] * (1 - ws) <= ms
+        c_minus = magnitude[ys - dy2, xs - dx2] * ws + magnitude[ys - dy1, xs - dx1] * (1 - ws) <= ms
+        keep[Ind] = c_plus & c_minus
+
+    out[y[keep], x[keep]] = m[keep]
+    return out
+
+
+def edge_mismatch(edge1, edge2, radius=1):
+    """Fraction of the edge pixels of the two edge maps that are not within
+    radius pixels of an edge of the other map.
+    """
+    kernel = np.ones((2 * radius + 1, 2 * radius + 1), dtype=np.uint8)
+    edge1_dilated = cv2.dilate(edge1.astype(np.uint8), kernel) > 0
+    edge2_dilated = cv2.dilate(edge2.astype(np.uint8), kernel) > 0
+
+    numMismatch = np.sum(edge1 & ~edge2_dilated) + np.sum(edge2 & ~edge1_dilated)
+    return numMismatch / max(np.sum(edge1) + np.sum(edge2), 1)
+
+
 def np_to_torch(img_np):
     '''Converts image in numpy.array to torch.Tensor.
     From C x W x H [0..1] to  C x W x H [0..1]
@@ -171,6 +412,32 @@ def interp(img, x, y):
     return mapped_img
 
 
+def interp_holes(img, x, y, holes, t, values):
+    """interp of the frame t (img) in which the hole pixels of holes take their
+    rows of values (numPix x C) instead, without composing the frame: the
+    corners in the hole are patched with the bilinear weights of cv2.remap
+    (coordinates rounded to 1/32 of a pixel).
+    """
+    imgH, imgW = img.shape[:2]
+    mapped_img = interp(img, x, y)
+
+    ix = np.rint(x.astype(np.float32) * np.float32(32)).astype(np.int64)
+    iy = np.rint(y.astype(np.float32) * np.float32(32)).astype(np.int64)
+    x0, fx = ix >> 5, (ix & 31).astype(np.float32) / 32
+    y0, fy = iy >> 5, (iy & 31).astype(np.float32) / 32
+
+    for dy, wy in ((0, 1 - fy), (1, fy)):
+        for dx, wx in ((0, 1 - fx), (1, fx)):
+            cy, cx = y0 + dy, x0 + dx
+            Ind = np.where((cy >= 0) & (cy < imgH) & (cx >= 0) & (cx < imgW))[0]
+            rows = holes.lookup(cy[Ind], cx[Ind], t)
+            Ind, rows = Ind[rows >= 0], rows[rows >= 0]
+            mapped_img[Ind] += (wy[Ind] * wx[Ind]).reshape((-1,) + (1,) * (img.ndim - 2)) * \
+                (values[rows] - img[cy[Ind], cx[Ind]])
+
+    return mapped_img
+
+
 def imsave(img, path):
     im = Image.fromarray(img.cpu().numpy().astype(np.uint8).squeeze())
     im.save(path)
@@ -254,31 +521,45 @@ def consistCheck(flowF, flowB):
     return BFdiff, np.stack((u, v), axis=2)
 
 
-def get_KeySourceFrame_flowNN(sub,
-                              indFrame,
-                              mask,
-                              videoNonLocalFlowB,
-                              videoNonLocalFlowF,
-                              video,
-                              consistencyThres):
+def consistCheckAt(flowF, flowB, holepixPos):
+    """consistCheck(flowF, flowB) at the pixels [y, x, ...] of holepixPos only.
+    """
+    fx = holepixPos[:, 1].astype(np.float32)
+    fy = holepixPos[:, 0].astype(np.float32)
+    fxx = fx + flowB[holepixPos[:, 0], holepixPos[:, 1], 0]  # horizontal
+    fyy = fy + flowB[holepixPos[:, 0], holepixPos[:, 1], 1]  # vertical
+
+    u = (fxx + interp(flowF[:, :, 0], fxx, fyy) - fx)
+    v = (fyy + interp(flowF[:, :, 1], fxx, fyy) - fy)
+    BFdiff = (u ** 2 + v ** 2) ** 0.5
 
+    return BFdiff, np.stack((u, v), axis=1)
+
+
+def KeySourceFrame_flowNN(holepixPos,
+                          indFrame,
+                          mask,
+                          videoNonLocalFlowB,
+                          videoNonLocalFlowF,
+                          videos,
+                          consistencyThres,
+                          border=0):
+    """Key source frame candidates of the hole pixels of frame indFrame, as
+    numPix x 3 flags and, for each of videos, numPix x C x 3 values (the pixel
+    itself without). border: 1 for the gradients, whose last row and column
+    are not valid.
+    """
     imgH, imgW, _, _, nFrame = videoNonLocalFlowF.shape
     KeySourceFrame = [0, nFrame // 2, nFrame - 1]
 
-    # Bool indicator of missing pixels at frame t
-    holepixPosInd = (sub[:, 2] == indFrame)
-
-    # Hole pixel location at frame t, i.e. [x, y, t]
-    holepixPos = sub[holepixPosInd, :]
-
-    HaveKeySourceFrameFlowNN = np.zeros((imgH, imgW, 3))
-    imgKeySourceFrameFlowNN = np.zeros((imgH, imgW, 3, 3))
+    HaveKeySourceFrameFlowNN = np.zeros((len(holepixPos), 3), dtype=bool)
+    imgKeySourceFrameFlowNN = [np.repeat(video[holepixPos[:, 0], holepixPos[:, 1], :, indFrame, None], 3, axis=2)
+                               for video in videos]
 
     for KeySourceFrameIdx in range(3):
 
         # flowF_neighbor
-        flowF_neighbor = copy.deepcopy(holepixPos)
-        flowF_neighbor = flowF_neighbor.astype(np.float32)
+        flowF_neighbor = holepixPos.astype(np.float32)
         flowF_vertical = videoNonLocalFlowF[:, :, 1, KeySourceFrameIdx, indFrame]
         flowF_horizont = videoNonLocalFlowF[:, :, 0, KeySourceFrameIdx, indFrame]
         flowB_vertical = videoNonLocalFlowB[:, :, 1, KeySourceFrameIdx, indFrame]
@@ -289,7 +570,7 @@ def get_KeySourceFrame_flowNN(sub,
         flowF_neighbor[:, 2] = KeySourceFrame[KeySourceFrameIdx]
 
         # Round the forward flow neighbor location
-        flow_neighbor_int = np.round(copy.deepcopy(flowF_neighbor)).astype(np.int32)
+        flow_neighbor_int = np.round(flowF_neighbor).astype(np.int32)
 
         # Check the forawrd/backward consistency
         IsConsist, _ = FBconsistCheck(flowF_neighbor, flowB_vertical,
@@ -298,123 +579,30 @@ def get_KeySourceFrame_flowNN(sub,
         # Check out-of-boundary
         ValidPos = np.logical_and(
             np.logical_and(flow_neighbor_int[:, 0] >= 0,
-                           flow_neighbor_int[:, 0] < imgH),
+                           flow_neighbor_int[:, 0] < imgH - border),
             np.logical_and(flow_neighbor_int[:, 1] >= 0,
-                           flow_neighbor_int[:, 1] < imgW))
+                           flow_neighbor_int[:, 1] < imgW - border))
 
-        holepixPos_ = copy.deepcopy(holepixPos)[ValidPos, :]
-        flow_neighbor_int = flow_neighbor_int[ValidPos, :]
-        flowF_neighbor = flowF_neighbor[ValidPos, :]
-        IsConsist = IsConsist[ValidPos]
+        # Change the out-of-boundary value to 0, in order to run mask[y,x,t]
+        # in the next line. It won't affect anything as ValidPos is saved already
+        flow_neighbor_int[np.invert(ValidPos), :2] = 0
 
         KnownInd = mask[flow_neighbor_int[:, 0],
                         flow_neighbor_int[:, 1],
                         KeySourceFrame[KeySourceFrameIdx]] == 0
 
-        KnownInd = np.logical_and(KnownInd, IsConsist)
-
-        imgKeySourceFrameFlowNN[:, :, :, KeySourceFrameIdx] = \
-            copy.deepcopy(video[:, :, :, indFrame])
+        KnownInd = np.logical_and.reduce((KnownInd, IsConsist, ValidPos))
 
-        imgKeySourceFrameFlowNN[holepixPos_[KnownInd, 0],
-                                holepixPos_[KnownInd, 1],
-                             :, KeySourceFrameIdx] = \
+        for video, img in zip(videos, imgKeySourceFrameFlowNN):
+            img[KnownInd, :, KeySourceFrameIdx] = \
                          interp(video[:, :, :, KeySourceFrame[KeySourceFrameIdx]],
                                 flowF_neighbor[KnownInd, 1].reshape(-1),
                                 flowF_neighbor[KnownInd, 0].reshape(-1))
 
-        HaveKeySourceFrameFlowNN[holepixPos_[KnownInd, 0],
-                                 holepixPos_[KnownInd, 1],
-                                 KeySourceFrameIdx] = 1
+        HaveKeySourceFrameFlowNN[KnownInd, KeySourceFrameIdx] = True
 
     return HaveKeySourceFrameFlowNN, imgKeySourceFrameFlowNN
-#
-def get_KeySourceFrame_flowNN_gradient(sub,
-                                      indFrame,
-                                      mask,
-                                      videoNonLocalFlowB,
-                                      videoNonLocalFlowF,
-                                      gradient_x,
-                                      gradient_y,
-                                      consistencyThres):
-
-    imgH, imgW, _, _, nFrame = videoNonLocalFlowF.shape
-    KeySourceFrame = [0, nFrame // 2, nFrame - 1]
-
-    # Bool indicator of missing pixels at frame t
-    holepixPosInd = (sub[:, 2] == indFrame)
-
-    # Hole pixel location at frame t, i.e. [x, y, t]
-    holepixPos = sub[holepixPosInd, :]
-
-    HaveKeySourceFrameFlowNN = np.zeros((imgH, imgW, 3))
-    gradient_x_KeySourceFrameFlowNN = np.zeros((imgH, imgW, 3, 3))
-    gradient_y_KeySourceFrameFlowNN = np.zeros((imgH, imgW, 3, 3))
-
-    for KeySourceFrameIdx in range(3):
-
-        # flowF_neighbor
-        flowF_neighbor = copy.deepcopy(holepixPos)
-        flowF_neighbor = flowF_neighbor.astype(np.float32)
-
-        flowF_vertical = videoNonLocalFlowF[:, :, 1, KeySourceFrameIdx, indFrame]
-        flowF_horizont = videoNonLocalFlowF[:, :, 0, KeySourceFrameIdx, indFrame]
-        flowB_vertical = videoNonLocalFlowB[:, :, 1, KeySourceFrameIdx, indFrame]
-        flowB_horizont = videoNonLocalFlowB[:, :, 0, KeySourceFrameIdx, indFrame]
-
-        flowF_neighbor[:, 0] += flowF_vertical[holepixPos[:, 0], holepixPos[:, 1]]
-        flowF_neighbor[:, 1] += flowF_horizont[holepixPos[:, 0], holepixPos[:, 1]]
-        flowF_neighbor[:, 2] = KeySourceFrame[KeySourceFrameIdx]
-
-        # Round the forward flow neighbor location
-        flow_neighbor_int = np.round(copy.deepcopy(flowF_neighbor)).astype(np.int32)
-
-        # Check the forawrd/backward consistency
-        IsConsist, _ = FBconsistCheck(flowF_neighbor, flowB_vertical,
-                                    flowB_horizont, holepixPos, consistencyThres)
-
-        # Check out-of-boundary
-        ValidPos = np.logical_and(
-            np.logical_and(flow_neighbor_int[:, 0] >= 0,
-                           flow_neighbor_int[:, 0] < imgH - 1),
-            np.logical_and(flow_neighbor_int[:, 1] >= 0,
-                           flow_neighbor_int[:, 1] < imgW - 1))
-
-        holepixPos_ = copy.deepcopy(holepixPos)[ValidPos, :]
-        flow_neighbor_int = flow_neighbor_int[ValidPos, :]
-        flowF_neighbor = flowF_neighbor[ValidPos, :]
-        IsConsist = IsConsist[ValidPos]
-
-        KnownInd = mask[flow_neighbor_int[:, 0],
-                        flow_neighbor_int[:, 1],
-                        KeySourceFrame[KeySourceFrameIdx]] == 0
-
-        KnownInd = np.logical_and(KnownInd, IsConsist)
-
-        gradient_x_KeySourceFrameFlowNN[:, :, :, KeySourceFrameIdx] = \
-            copy.deepcopy(gradient_x[:, :, :, indFrame])
-        gradient_y_KeySourceFrameFlowNN[:, :, :, KeySourceFrameIdx] = \
-            copy.deepcopy(gradient_y[:, :, :, indFrame])
-
-        gradient_x_KeySourceFrameFlowNN[holepixPos_[KnownInd, 0],
-                                        holepixPos_[KnownInd, 1],
-                                     :, KeySourceFrameIdx] = \
-                                 interp(gradient_x[:, :, :, KeySourceFrame[KeySourceFrameIdx]],
-                                        flowF_neighbor[KnownInd, 1].reshape(-1),
-                                        flowF_neighbor[KnownInd, 0].reshape(-1))
-
-        gradient_y_KeySourceFrameFlowNN[holepixPos_[KnownInd, 0],
-                                        holepixPos_[KnownInd, 1],
-                                     :, KeySourceFrameIdx] = \
-                                 interp(gradient_y[:, :, :, KeySourceFrame[KeySourceFrameIdx]],
-                                        flowF_neighbor[KnownInd, 1].reshape(-1),
-                                        flowF_neighbor[KnownInd, 0].reshape(-1))
-
-        HaveKeySourceFrameFlowNN[holepixPos_[KnownInd, 0],
-                                 holepixPos_[KnownInd, 1],
-                                 KeySourceFrameIdx] = 1
 
-    return HaveKeySourceFrameFlowNN, gradient_x_KeySourceFrameFlowNN, gradient_y_KeySourceFrameFlowNN
 
 class Progbar(object):
     """Displays a progress bar.
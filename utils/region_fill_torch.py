@@ -0,0 +1,146 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def regionfill_batch(images, masks, tol=1e-5, max_iter=200, device='cpu'):
+    """Fills the masked region of a batch of images with the solution of the
+    Laplace equation, like utils.region_fill.regionfill (same discrete system),
+    for all the images and channels at once.
+
+    images: B x imgH x imgW x nCh
+    masks:  B x imgH x imgW
+
+    The systems are solved together on torch tensors by the conjugate gradient
+    preconditioned with a multigrid V-cycle, until the largest correction of a
+    Jacobi step is below tol times the range of the known values.
+    """
+    images = np.asarray(images)
+    masks = np.asarray(masks).astype(bool)
+    result = np.array(images, dtype=np.float32)
+    if not masks.any():
+        return result
+    B, imgH, imgW, nCh = images.shape
+
+    # Union bounding box of the holes plus the one-pixel ring of boundary pixels.
+    rows = np.where(masks.any(axis=(0, 2)))[0]
+    cols = np.where(masks.any(axis=(0, 1)))[0]
+    y0, y1 = max(rows[0] - 1, 0), min(rows[-1] + 2, imgH)
+    x0, x1 = max(cols[0] - 1, 0), min(cols[-1] + 2, imgW)
+
+    # (B x nCh) x 1 x H x W, every channel is an independent image.
+    x = torch.from_numpy(np.ascontiguousarray(result[:, y0:y1, x0:x1].transpose(0, 3, 1, 2)))
+    x = x.reshape(B * nCh, 1, y1 - y0, x1 - x0).to(device)
+    m = torch.from_numpy(np.ascontiguousarray(masks[:, y0:y1, x0:x1]))
+    m = m[:, None].repeat_interleave(nCh, dim=0).to(device)
+
+    # The ring pixels are known, so the hole pixels are on the crop border
+    # only where it is the frame border, and the neighbor counts are the same
+    # as in the whole frame.
+    levels = buildLevels(m, torch.ones((1, 1, y1 - y0, x1 - x0), device=device))
+    count = levels[0][1]
+
+    known = torch.where(m, torch.zeros_like(x), x)
+    scale = torch.where(m, torch.full_like(x, -np.inf), x).amax(dim=(1, 2, 3), keepdim=True) - \
+            torch.where(m, torch.full_like(x, np.inf), x).amin(dim=(1, 2, 3), keepdim=True)
+    tol = tol * torch.nan_to_num(scale, nan=1., posinf=1., neginf=1.).clamp(min=1e-12)
+
+    # Unknowns u (zero outside of the hole): count * u - neighborSum(u) = b.
+    b = torch.where(m, neighborSum(known), torch.zeros_like(x))
+    u = torch.zeros_like(x)
+    r = b
+    z = vcycle(r, levels, 0)
+    p = z
+    rz = dot(r, z)
+    for _ in range(max_iter):
+        # Largest correction of a Jacobi step.
+        if bool(((r / count).abs() <= tol).all()):
+            break
+        Ap = laplace(p, levels[0])
+        pAp = dot(p, Ap)
+        alpha = torch.where(pAp > 0, rz / pAp.clamp(min=1e-30), torch.zeros_like(pAp))
+        u = u + alpha * p
+        r = r - alpha * Ap
+        z = vcycle(r, levels, 0)
+        rz_new = dot(r, z)
+        beta = torch.where(rz > 0, rz_new / rz.clamp(min=1e-30), torch.zeros_like(rz))
+        p = z + beta * p
+        rz = rz_new
+
+    u = u.reshape(B, nCh, y1 - y0, x1 - x0).permute(0, 2, 3, 1).cpu().numpy()
+    hole = masks[:, y0:y1, x0:x1]
+    result[:, y0:y1, x0:x1][hole] = u[hole]
+
+    return result
+
+
+def dot(x, y):
+    return (x * y).sum(dim=(1, 2, 3), keepdim=True)
+
+
+def neighborSum(x):
+    # Shifted additions are much faster than a 3 x 3 conv2d with one channel.
+    x = F.pad(x, (1, 1, 1, 1))
+    return x[:, :, :-2, 1:-1] + x[:, :, 2:, 1:-1] + x[:, :, 1:-1, :-2] + x[:, :, 1:-1, 2:]
+
+
+def laplace(x, level):
+    mask, count, _ = level
+    return mask * (count * x - neighborSum(x))
+
+
+def buildLevels(mask, valid):
+    """Masks, neighbor counts and red-black masks of the multigrid levels
+    (as float tensors).
+    """
+    levels = []
+    while True:
+        count = neighborSum(valid)
+        count = torch.where(count > 0, count, torch.ones_like(count))
+        H, W = mask.shape[-2:]
+        yy = torch.arange(H, device=mask.device).view(-1, 1)
+        xx = torch.arange(W, device=mask.device).view(1, -1)
+        red = ((yy + xx) % 2 == 0)[None, None]
+        levels.append((mask.float(), count, ((mask & red).float(), (mask & ~red).float())))
+        if min(H, W) <= 4:
+            break
+        # A coarse cell is unknown if any of its 2 x 2 fine pixels is unknown.
+        mask = F.max_pool2d(mask.float(), 2, ceil_mode=True) > 0
+        valid = F.max_pool2d(valid, 2, ceil_mode=True)
+    return levels
+
+
+def smooth(x, f, level, colors):
+    """Gauss-Seidel sweeps on count * x - neighborSum(x) = f, one per color
+    (0: red, 1: black).
+    """
+    _, count, update = level
+    for color in colors:
+        x = x + update[color] * ((neighborSum(x) + f) / count - x)
+    return x
+
+
+def vcycle(f, levels, l):
+    """Symmetric multigrid approximation of the solution of laplace(x) = f.
+    """
+    mask = levels[l][0]
+    if l == len(levels) - 1:
+        # Coarsest level.
+        return smooth(torch.zeros_like(f), f, levels[l], [0, 1] * 20 + [1, 0] * 20)
+
+    x = smooth(torch.zeros_like(f), f, levels[l], [0, 1])
+
+    # The coarse cells aggregate 2 x 2 pixels. Their Galerkin operator is
+    # twice the same stencil on the coarse grid, hence the residual sum / 2.
+    r = f - laplace(x, levels[l])
+    H, W = r.shape[-2:]
+    r = F.pad(r, (0, W % 2, 0, H % 2))
+    r = (r[:, :, 0::2, 0::2] + r[:, :, 1::2, 0::2] + r[:, :, 0::2, 1::2] + r[:, :, 1::2, 1::2]) / 2
+
+    e = vcycle(r, levels, l + 1)
+
+    # Piecewise constant prolongation of the correction.
+    e = F.interpolate(e, scale_factor=2, mode='nearest')[:, :, :H, :W]
+    x = x + mask * e
+
+    return smooth(x, f, levels[l], [1, 0])